@@ -17,6 +17,10 @@ Created on Fri Jan 22 09:08:13 2021
 from hilltoppy import web_service as ws
 import pandas as pd
 import datetime
+import time
+import random
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 # Set URL
 base_url = 'http://wateruse.ecan.govt.nz'
@@ -38,126 +42,144 @@ first_year = 1900
 # Choose whether to sort by calendar or water year, WY (WY2021 = 1 July 2020 to 30 June 2021)
 year_choice = 'water year' # 'water year' or 'calendar'
 
-##############################################################################
+'''
+Choose whether to download the data of every site/measurement pair to count
+samples ('full'), or to take From/To from the measurement list and only
+download the data of the measurements in detail_measurements ('metadata').
+Sample counts, actual (non-*) counts and the distribution by year are only
+available for downloaded pairs. WQ Sample is always counted since it is
+downloaded for the sample parameter results
+'''
+summary_mode = 'full' # options = 'full', 'metadata'
+detail_measurements = ['Nitrate Nitrogen','E. coli']
 
-# Generate a dataframe of all sites in the server file with location data
-hts_sites_df = ws.site_list(base_url,hts,location=True)
-# Export hts sites table to csv file
-hts_sites_df.to_csv('Sites in hts file.csv',index=False)
+# Set number of sites summarised at the same time (1 to summarise one site at a time)
+workers = 8
 
-# Generate a list of all sites in the server file
-hts_sites_list = sorted(hts_sites_df.SiteName.tolist(),key=str.lower)
+# Set number of times a failed request is retried, and the wait before the
+# first retry in seconds (doubled for each further retry)
+retries = 3
+backoff = 1.0
 
-# Generate a measurement summary and sample parameter summary for all sites
-# Initialise empty lists
-site_measurement_summary = []
-site_sample_parameter_summary = []
-sample_parameter_results = []
+# Set file the sample counts of each site are written to as the sites are completed
+counts_file = 'Site Measurement Counts.csv'
 
-# Loop through all sites in the hts file
-for site in hts_sites_list:
-    # Call site-specific measurement list
-    measurement_summary = ws.measurement_list(base_url,hts,site)
-    # Append list to measurement summary table
-    site_measurement_summary.append(measurement_summary)
-    # Try calling the site-specific sample parameter list
-    try:
-        sample_parameter_summary = ws.wq_sample_parameter_list(base_url,hts,site)
-        # Append list to sample parameter summary table
-        site_sample_parameter_summary.append(sample_parameter_summary)
-    # Some sites have measurements but no sample parameters
-    except ValueError:
-        continue
-    # Try SQ21274
-    except UnboundLocalError:
-        continue
-    # Try calling 'WQ Sample' to get full list of sample parameters
-    data = ws.get_data(base_url,hts,site,'WQ Sample',from_date='1001-01-01',to_date='9999-01-01').unstack('Parameter')
-    data.columns = data.columns.droplevel()
-    sample_parameter_results.append(data)
-    
-
-# Concatenate summary lists into pandas dataframes
-site_measurement_summary_df = pd.concat(site_measurement_summary,sort = False)
-site_sample_parameter_summary_df = pd.concat(site_sample_parameter_summary,sort = False)
-sample_parameter_results_df = pd.concat(sample_parameter_results,sort = False)
-# Export measurement and sample parameter summaries to csv files
-site_measurement_summary_df.to_csv('Site Measurement Summary.csv')
-site_sample_parameter_summary_df.to_csv('Site Sample Parameter Summary.csv')
-sample_parameter_results_df.to_csv('Sample Parameter Results.csv')
+# Set whether to print each site (and any failure) as it is completed
+verbose = False
 
-# Generate the list of sites with measurements
-sites_with_measurements = site_measurement_summary_df.index.unique(0).tolist()
+##############################################################################
 
-# Generate the list of sites without measurements
-sites_without_measurements = [site for site in hts_sites_list if site not in sites_with_measurements]
-# Obtain location data for sites without measurements
-sites_without_measurements_df = hts_sites_df[hts_sites_df['SiteName'].isin(sites_without_measurements)]
-# Export table of sites without measurements to csv file
-sites_without_measurements_df.to_csv('Sites in hts file without measurements.csv',index=False)
+def retry(func, *args, **kwargs):
+    '''
+    Call a web service function, retrying failed requests with exponential
+    backoff. ValueError (no results) and UnboundLocalError (no sample
+    parameters, i.e. SQ21274) are returned by the server and not retried
+    '''
+    for attempt in range(retries+1):
+        try:
+            return func(*args, **kwargs)
+        except (ValueError, UnboundLocalError):
+            raise
+        except Exception:
+            if attempt == retries:
+                raise
+            # Randomise the wait so that sites retrying together are spread out
+            time.sleep(backoff*2**attempt*random.uniform(0.5,1.5))
 
-# Call each site/measurement pair to determine number of measurements for each site
-# Initialise empty list
-site_measurement_counts = []
+def year_distribution(dates_df):
+    '''
+    Count the samples, days, months, or quarters sampled in each calendar/water
+    year for all site/measurement pairs at once. Returns a table indexed by
+    Site and Measurement with one column for each year
+    '''
+    dates = dates_df['DateTime'].dt
+    # Set the calendar/water year of each date (WY2021 = 1 July 2020 to 30 June 2021)
+    year = dates.year
+    if year_choice == 'water year':
+        year = year + (dates.month >= 7)
+    keys_df = dates_df[['Site','Measurement']].assign(Year=year)
+    # Count each day, month, or quarter sampled once per year
+    if wateryear_count == 'days':
+        keys_df = keys_df.assign(Unit=dates.dayofyear).drop_duplicates()
+    elif wateryear_count == 'months':
+        keys_df = keys_df.assign(Unit=dates.month).drop_duplicates()
+    elif wateryear_count == 'quarters':
+        keys_df = keys_df.assign(Unit=dates.quarter).drop_duplicates()
+    # Count the dates of each pair and year, with one column for each year
+    counts_df = keys_df.groupby(['Site','Measurement','Year'],sort=False).size().unstack('Year',fill_value=0)
+    counts_df = counts_df.reindex(columns=range(first_year,current_year + 1),fill_value=0)
+    counts_df.columns = cols[8:]
+    return counts_df
 
-# Determine current water/calendar year
-if datetime.datetime.now().month >= 7 and year_choice == 'water year':
-    current_year = datetime.datetime.now().year + 1
-else:
-    current_year = datetime.datetime.now().year
+def site_summary(site):
+    '''
+    Summarise the measurements, sample parameters and sample counts of a site.
+    The 'WQ Sample' results are requested once and used for both the sample
+    parameter results and the 'WQ Sample' sample counts
+    '''
+    summary = {'Measurements':None,'SampleParameters':None,'SampleResults':None,'Counts':[],'Dates':[]}
+    # Call site-specific measurement list
+    measurement_summary = retry(ws.measurement_list,base_url,hts,site)
+    summary['Measurements'] = measurement_summary
+    sample_data = None
+    # Try calling the site-specific sample parameter list
+    try:
+        summary['SampleParameters'] = retry(ws.wq_sample_parameter_list,base_url,hts,site)
+    # Some sites have measurements but no sample parameters (i.e. SQ21274)
+    except (ValueError, UnboundLocalError):
+        pass
+    else:
+        # Try calling 'WQ Sample' to get full list of sample parameters
+        try:
+            sample_data = retry(ws.get_data,base_url,hts,site,'WQ Sample',from_date='1001-01-01',to_date='9999-01-01')
+        except ValueError:
+            sample_data = pd.DataFrame()
+        if not sample_data.empty:
+            data = sample_data.unstack('Parameter')
+            data.columns = data.columns.droplevel()
+            summary['SampleResults'] = data
 
-# Loop through each site that has measurements
-for site in site_measurement_summary_df.index.unique(0).tolist():
-    print(site)
+    # Check if there is any measurement data
+    if measurement_summary.empty:
+        return summary
     # Loop through each measurement listed at the site
-    for measurement in site_measurement_summary_df.loc[site].index.tolist():
+    for measurement in measurement_summary.loc[site].index.tolist():
         # Record site measurement to which sample count data is to be appended
         counts = [site,measurement]
         # WQ Sample pulls sample metadata, counts are calculated as unique dates listed
         if measurement == 'WQ Sample':
-            data = ws.get_data(base_url,hts,site,measurement,from_date='1001-01-01',to_date='9999-01-01')
-            sample_dates = data.index.unique(level=2)
+            # Sites without sample parameters have not requested the sample metadata yet
+            if sample_data is None:
+                try:
+                    sample_data = retry(ws.get_data,base_url,hts,site,measurement,from_date='1001-01-01',to_date='9999-01-01')
+                except ValueError:
+                    sample_data = pd.DataFrame()
+            sample_dates = sample_data.index.unique(level=2) if not sample_data.empty else pd.DatetimeIndex([])
             # Error with SQ21274 not having WQ Sample info
             if sample_dates.empty == True:
                 counts += ['']*6
-                for year in range(first_year,current_year + 1):
-                    counts.append(0)
             else:
                 counts += [min(sample_dates),max(sample_dates),len(sample_dates),'','','']
-                # Obtain sample distribution by calendar/water year
-                for year in range(first_year,current_year + 1):
-                    if year_choice == 'calendar':
-                        start_date = '{}-1-1'.format(year)
-                        end_date = '{}-12-31 23:59'.format(year)
-                    elif year_choice == 'water year':
-                        start_date = '{}-7-1'.format(year-1)
-                        end_date = '{}-6-30 23:59'.format(year)
-                    annual_dates = sample_dates[(sample_dates >= start_date) & (sample_dates <= end_date)]
-                    if wateryear_count == 'samples':
-                        counts.append(len(annual_dates))
-                    elif wateryear_count == 'days':
-                        counts.append(len(set(annual_dates.dayofyear)))
-                    elif wateryear_count == 'months':
-                        counts.append(len(set(annual_dates.month)))
-                    elif wateryear_count == 'quarters':
-                        counts.append(len(set(annual_dates.quarter)))
-            site_measurement_counts.append(counts)
+                # Keep sample dates for the distribution by calendar/water year
+                summary['Dates'].append(pd.DataFrame({'Site':site,'Measurement':measurement,'DateTime':sample_dates}))
+            summary['Counts'].append(counts)
+            continue
+        # Take the timeframe of other measurements from the measurement list
+        if (summary_mode == 'metadata') and (measurement not in detail_measurements):
+            metadata = measurement_summary.loc[(site,measurement)]
+            # The measurement list has no sample counts, so Sample Count is left empty
+            counts += [metadata['From'],metadata['To'],None,None,None,None]
+            summary['Counts'].append(counts)
             continue
         # Call the data for the specified site and measurement
-        code = 'OK'
-        data = 0.0
-        while code == 'OK' and type(data) == float:    
-            try:
-                data = ws.get_data(base_url,hts,site,measurement,from_date='1001-01-01',to_date='9999-01-01')
-            # Some measurements have no data (ie. BX23/0035 - Benzo[a]anthracene)
-            except ValueError:
-                code = 'ValueError'
-                data = pd.DataFrame()
-            except:
-                continue
+        try:
+            data = retry(ws.get_data,base_url,hts,site,measurement,from_date='1001-01-01',to_date='9999-01-01')
+        # Some measurements have no data (ie. BX23/0035 - Benzo[a]anthracene)
+        except ValueError:
+            data = pd.DataFrame()
         # Check if data exists for site and measurement
         if data.empty:
-            counts += ([None]*2+[0])*2 + [None]*(current_year-first_year)
+            counts += ([None]*2+[0])*2
         else:
             # Format data to filter by date
             measurement_dates = data.index.get_level_values(2)
@@ -170,31 +192,44 @@ for site in site_measurement_summary_df.index.unique(0).tolist():
             # Check that actual data exists
             if data_actual.empty:
                 # Measurement only contains * values (ie. BU24/0002 - Filtration, Unpreserved)
-                counts += [None]*2+[0] + [None]*(current_year-first_year)
+                counts += [None]*2+[0]
             else:
                 measurement_dates = data_actual.index.get_level_values(2)
                 # Record the min, max, and count of dates with non-* samples
                 counts += [min(measurement_dates),
                            max(measurement_dates),
                            len(measurement_dates)]
-                for year in range(first_year,current_year + 1):
-                    if year_choice == 'calendar':
-                        start_date = '{}-1-1'.format(year)
-                        end_date = '{}-12-31 23:59'.format(year)
-                    elif year_choice == 'water year':
-                        start_date = '{}-7-1'.format(year-1)
-                        end_date = '{}-6-30 23:59'.format(year)
-                    annual_dates = measurement_dates[(measurement_dates >= start_date) & (measurement_dates <= end_date)]
-                    if wateryear_count == 'samples':
-                        counts.append(len(annual_dates))
-                    elif wateryear_count == 'days':
-                        counts.append(len(set(annual_dates.dayofyear)))
-                    elif wateryear_count == 'months':
-                        counts.append(len(set(annual_dates.month)))
-                    elif wateryear_count == 'quarters':
-                        counts.append(len(set(annual_dates.quarter)))
+                # Keep non-* dates for the distribution by calendar/water year
+                summary['Dates'].append(pd.DataFrame({'Site':site,'Measurement':measurement,'DateTime':measurement_dates}))
         # Append the site-measurement sample count data to list
-        site_measurement_counts.append(counts)
+        summary['Counts'].append(counts)
+
+    return summary
+
+def safe_site_summary(site):
+    '''
+    Summarise a site with site_summary(), returning the exception instead of raising it
+    '''
+    try:
+        return site_summary(site)
+    except Exception as error:
+        return error
+
+##############################################################################
+
+# Generate a dataframe of all sites in the server file with location data
+hts_sites_df = retry(ws.site_list,base_url,hts,location=True)
+# Export hts sites table to csv file
+hts_sites_df.to_csv('Sites in hts file.csv',index=False)
+
+# Generate a list of all sites in the server file
+hts_sites_list = sorted(hts_sites_df.SiteName.tolist(),key=str.lower)
+
+# Determine current water/calendar year
+if datetime.datetime.now().month >= 7 and year_choice == 'water year':
+    current_year = datetime.datetime.now().year + 1
+else:
+    current_year = datetime.datetime.now().year
 
 # Name columns
 cols=['Site','Measurement','From(Check)','To(Check)','Sample Count',
@@ -205,11 +240,82 @@ for year in range(first_year,current_year + 1):
     elif year_choice == 'water year':
         cols.append('WY{}'.format(year))
 
+# Generate a measurement summary, sample parameter summary and sample counts for all sites
+# Initialise empty lists
+site_measurement_summary = []
+site_sample_parameter_summary = []
+sample_parameter_results = []
+site_measurement_counts = []
+site_distributions = []
+failed_sites = []
+
+# Start the sample counts file, which is appended to as each site is completed.
+# The distribution by calendar/water year is added once all sites are complete
+pd.DataFrame(columns=cols[:8]).to_csv(counts_file,index=False)
+
+# Summarise sites at the same time. Results are returned in the order of the site list
+with ThreadPoolExecutor(max_workers=workers) as executor:
+    for site, summary in zip(hts_sites_list,executor.map(safe_site_summary,hts_sites_list)):
+        if verbose:
+            print(site if not isinstance(summary, Exception) else '{} failed: {}'.format(site,summary))
+        # Sites that fail after all retries are reported at the end
+        if isinstance(summary, Exception):
+            failed_sites.append([site,repr(summary)])
+            continue
+        # Append lists to summary tables
+        site_measurement_summary.append(summary['Measurements'])
+        if summary['SampleParameters'] is not None:
+            site_sample_parameter_summary.append(summary['SampleParameters'])
+        if summary['SampleResults'] is not None:
+            sample_parameter_results.append(summary['SampleResults'])
+        site_measurement_counts += summary['Counts']
+        # Count the site's samples by calendar/water year, so that only the
+        # counts and not the sample dates of every site are kept in memory
+        if summary['Dates']:
+            site_distributions.append(year_distribution(pd.concat(summary['Dates'],ignore_index=True)))
+        # Stream the site sample counts to file
+        pd.DataFrame(summary['Counts'],columns=cols[:8]).to_csv(counts_file,mode='a',header=False,index=False)
+
+# Export table of sites that could not be summarised
+if failed_sites:
+    pd.DataFrame(failed_sites,columns=['SiteName','Error']).to_csv('Sites in hts file that failed.csv',index=False)
+elif os.path.isfile('Sites in hts file that failed.csv'):
+    os.remove('Sites in hts file that failed.csv')
+
+# Concatenate summary lists into pandas dataframes
+site_measurement_summary_df = pd.concat(site_measurement_summary,sort = False)
+site_sample_parameter_summary_df = pd.concat(site_sample_parameter_summary,sort = False)
+sample_parameter_results_df = pd.concat(sample_parameter_results,sort = False)
+# Export measurement and sample parameter summaries to csv files
+site_measurement_summary_df.to_csv('Site Measurement Summary.csv')
+site_sample_parameter_summary_df.to_csv('Site Sample Parameter Summary.csv')
+sample_parameter_results_df.to_csv('Sample Parameter Results.csv')
+
+# Generate the list of sites with measurements
+sites_with_measurements = site_measurement_summary_df.index.unique(0).tolist()
+
+# Generate the list of sites without measurements
+sites_without_measurements = [site for site in hts_sites_list if site not in sites_with_measurements]
+# Obtain location data for sites without measurements
+sites_without_measurements_df = hts_sites_df[hts_sites_df['SiteName'].isin(sites_without_measurements)]
+# Export table of sites without measurements to csv file
+sites_without_measurements_df.to_csv('Sites in hts file without measurements.csv',index=False)
+
 # Convert data to a dateframe
-site_measurement_counts_df = pd.DataFrame(site_measurement_counts,columns=cols)
+site_measurement_counts_df = pd.DataFrame(site_measurement_counts,columns=cols[:8])
 # Set sample count dataframe index to match format of the site measurement summary dataframe
 site_measurement_counts_df = site_measurement_counts_df.set_index(['Site','Measurement'])
 
+# Combine the sample distribution by calendar/water year of all sites. Pairs
+# without non-* data have no distribution, apart from WQ Sample which is
+# counted as 0 samples
+dates_df = pd.DataFrame({'Site':[],'Measurement':[],'DateTime':pd.DatetimeIndex([])})
+distribution_df = pd.concat(site_distributions+[year_distribution(dates_df)])
+site_measurement_counts_df = site_measurement_counts_df.join(distribution_df)
+no_samples = (site_measurement_counts_df.index.get_level_values('Measurement') == 'WQ Sample') & ~site_measurement_counts_df.index.isin(distribution_df.index)
+site_measurement_counts_df.loc[no_samples,cols[8:]] = 0
+site_measurement_counts_df[cols[8:]] = site_measurement_counts_df[cols[8:]].astype('Int64')
+
 # Merge the sample count dataframe to site measurement summary dataframe
 merged_summary_df = pd.merge(site_measurement_summary_df,site_measurement_counts_df,how = 'left',on = ['Site','Measurement'])
 #Export site measurement summary data with sample count data
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Python Script to benchmark the indicator and trend functions on synthetic
+data at several dataset sizes
+
+Each function is timed on the output of the previous stages, as in the
+indicator scripts. Throughput (input rows per second) and peak memory are
+reported, and timings and outputs are compared to a stored baseline so that
+optimisations can be shown to keep the same results.
+
+Created on Sat Oct 17 01:22:27 2026
+"""
+
+# import python modules
+import pandas as pd
+import numpy as np
+import os
+import time
+import tracemalloc
+from Functions import stacked_data,sample_freq,Hazen_percentile,reduce_to_monthly,annual_max,annual_percentile,multiyear_percentile,trend_format,trends,grades,grade_check
+from SyntheticData import synthetic_wq_data,measurement_specs
+
+##############################################################################
+'''
+Set benchmark sizes and settings
+'''
+
+# Set dataset sizes as number of synthetic sites, and the hydro years and seed
+sizes = [100,1000,3000]
+first_year = 1990
+last_year = 2021
+seed = 0
+
+# Set measurement to benchmark
+measurement = 'Nitrate Nitrogen'
+bins = [0,1,5.65,11.3,np.inf]
+
+# Set number of timed runs of each stage (the fastest run is reported)
+repeats = 3
+
+# Set baseline folder. Timings and outputs are stored if no baseline exists
+# (or update_baseline is True), and compared to the baseline otherwise
+baseline_folder = 'Benchmark-Baseline'
+update_baseline = False
+
+# Set results file of this run
+results_file = 'Benchmark.csv'
+
+##############################################################################
+'''
+Set benchmark stages
+'''
+
+# Each stage has a name, the stage its input is taken from, and the function
+# run on that input. Functions are given copies so runs do not interact
+stages = [
+    ['stacked_data','WQData',lambda df: stacked_data(df,[measurement],{measurement:measurement_specs[measurement]['Units']})],
+    ['sample_freq','stacked_data',lambda df: sample_freq(df,True)],
+    ['Hazen_percentile','stacked_data',lambda df: Hazen_percentile(df,50,['Site','HydroYear'],'Censor','Numeric','HazenCensor','HazenNumeric')],
+    ['reduce_to_monthly','stacked_data',lambda df: reduce_to_monthly(df.copy())],
+    ['annual_max','stacked_data',lambda df: annual_max(df.copy())],
+    ['annual_percentile','reduce_to_monthly',lambda df: annual_percentile(df.copy(),50)],
+    ['multiyear_percentile','reduce_to_monthly',lambda df: multiyear_percentile(df.copy(),50,5,['Monthly','Quarterly','Semi-annual','Annual'],[48,16,8,4])],
+    ['trend_format','reduce_to_monthly',lambda df: trend_format(df.copy(),['Annual','Quarterly','Monthly'])],
+    ['trends','trend_format',lambda df: trends(df,[i for i in range(5,31)],[last_year],0.80)],
+    ['grades','annual_max',lambda df: grades(df.copy(),bins)],
+    ['grade_check','grades',lambda df: grade_check(df.copy(),outputs['stacked_data'][['Site','HydroYear','Censor','Numeric']],bins,'All')],
+    ]
+
+##############################################################################
+'''
+Run benchmark
+'''
+
+def same_output(df, baseline_df):
+    '''
+    Check an output against the baseline output, ignoring dtypes and the
+    row order of ties
+    '''
+    df = df.reset_index(drop=True)
+    baseline_df = baseline_df.reset_index(drop=True)
+    if list(df.columns) != list(baseline_df.columns):
+        return False
+    try:
+        pd.testing.assert_frame_equal(df,baseline_df,check_dtype=False,check_categorical=False)
+        return True
+    except AssertionError:
+        columns = list(df.columns)
+        df = df.astype(str).sort_values(columns).reset_index(drop=True)
+        baseline_df = baseline_df.astype(str).sort_values(columns).reset_index(drop=True)
+        return df.equals(baseline_df)
+
+Benchmark = []
+for size in sizes:
+    outputs = {'WQData':synthetic_wq_data(size,first_year,last_year,[measurement],seed=seed)}
+    size_folder = os.path.join(baseline_folder,str(size))
+    for stage, source, func in stages:
+        input_df = outputs[source]
+        # Time the stage, keeping the fastest run
+        times = []
+        for i in range(repeats):
+            start, cpu_start = time.perf_counter(), time.process_time()
+            output_df = func(input_df)
+            times.append([time.perf_counter()-start,time.process_time()-cpu_start])
+        wall, cpu = min(times)
+        # Measure peak memory in a separate run, as tracing slows the stage
+        tracemalloc.start()
+        func(input_df)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        outputs[stage] = output_df
+        # Store or compare the output with the baseline
+        baseline_file = os.path.join(size_folder,stage+'.parquet')
+        if update_baseline or not os.path.isfile(baseline_file):
+            os.makedirs(size_folder,exist_ok=True)
+            output_df.reset_index(drop=True).to_parquet(baseline_file)
+            matches = np.nan
+        else:
+            matches = same_output(output_df,pd.read_parquet(baseline_file))
+        Benchmark.append([size,stage,len(input_df),len(output_df),wall,cpu,len(input_df)/wall,peak/2**20,matches])
+        print('{:>6} sites {:<22}{:>10.3f} s{:>14,.0f} rows/s{:>10.1f} MiB{}'.format(size,stage,wall,len(input_df)/wall,peak/2**20,'' if pd.isna(matches) else ('  same' if matches else '  CHANGED')))
+Benchmark_df = pd.DataFrame(Benchmark,columns=['Sites','Stage','RowsIn','RowsOut','WallTime','CPUTime','RowsPerSecond','PeakMemoryMiB','SameAsBaseline'])
+
+##############################################################################
+'''
+Compare with baseline timings and export
+'''
+
+timings_file = os.path.join(baseline_folder,'timings.csv')
+if update_baseline or not os.path.isfile(timings_file):
+    Benchmark_df.to_csv(timings_file,index=False)
+else:
+    baseline_df = pd.read_csv(timings_file)[['Sites','Stage','WallTime','PeakMemoryMiB']]
+    Benchmark_df = Benchmark_df.merge(baseline_df,on=['Sites','Stage'],how='left',suffixes=('','Baseline'))
+    Benchmark_df['Speedup'] = Benchmark_df['WallTimeBaseline']/Benchmark_df['WallTime']
+    print(Benchmark_df[['Sites','Stage','WallTime','WallTimeBaseline','Speedup','PeakMemoryMiB','PeakMemoryMiBBaseline','SameAsBaseline']].to_string(index=False))
+Benchmark_df.to_csv(results_file,index=False)
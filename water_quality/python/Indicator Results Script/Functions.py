@@ -11,11 +11,498 @@ Created on Fri Jun 6 09:08:13 2021
 from hilltoppy import web_service as ws
 import pandas as pd
 import numpy as np
-import math
-import pymannkendall as mk
+import os
+import glob
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
 from scipy import stats
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import repeat
+from collections import deque
+from urllib.parse import urlparse
+import sys
+import json
+import cProfile
+import functools
+try:
+    import resource
+except ImportError:
+    resource = None
 
-def hilltop_data(base_url, hts, sites, measurements):
+def peak_rss():
+    '''
+    Return the peak resident memory of the process in MiB (nan if unknown)
+    '''
+    # The resource module is not available on Windows, where psutil is used if installed
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB and macOS reports bytes
+        return peak/2**20 if sys.platform == 'darwin' else peak/2**10
+    try:
+        import psutil
+    except ImportError:
+        return np.nan
+    memory = psutil.Process().memory_info()
+    return getattr(memory,'peak_wset',memory.rss)/2**20
+
+def table_rows(value):
+    '''
+    Return the number of rows of a table (or the first table of a tuple)
+    '''
+    if isinstance(value, tuple):
+        value = next((v for v in value if isinstance(v, (pd.DataFrame, pd.Series))),None)
+    return len(value) if isinstance(value, (pd.DataFrame, pd.Series)) else np.nan
+
+class RunProfiler:
+    """
+    Profile of an indicator run. Records the wall time, CPU time, rows in and
+    out and peak resident memory of script stages and Functions.py entry
+    points, and the latency of each web service request. Started and
+    stopped with start_profile() and stop_profile().
+
+    CPU time of functions is the time of the calling thread, so work done in
+    worker processes is not included.
+
+    Parameters
+    ----------
+    cprofile_file : str or None
+        file to dump cProfile statistics of the main thread to. None to not
+        run cProfile
+    """
+
+    columns = ['Kind','Name','Site','Measurement','Thread','Depth','Start','WallTime','CPUTime','RowsIn','RowsOut','PeakRSS','Cached','Error']
+
+    def __init__(self, cprofile_file=None):
+        self.start_time = time.perf_counter()
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.current_stage = None
+        self.cprofile_file = cprofile_file
+        self.cprofile = cProfile.Profile() if cprofile_file else None
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+    def record(self, kind, name, start, wall, cpu=np.nan, rows_in=np.nan, rows_out=np.nan, site=None, measurement=None, cached=None, error=None):
+        '''
+        Add a record to the profile
+        '''
+        with self.lock:
+            self.records.append([kind,name,site,measurement,threading.current_thread().name,getattr(self.local,'depth',0),
+                                 start-self.start_time,wall,cpu,rows_in,rows_out,peak_rss(),cached,error])
+
+    def call(self, func, args, kwargs):
+        '''
+        Call a function and record it
+        '''
+        rows_in = next((len(a) for a in args if isinstance(a, (pd.DataFrame, pd.Series))),np.nan)
+        self.local.depth = getattr(self.local,'depth',0) + 1
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            output = func(*args, **kwargs)
+        finally:
+            self.local.depth -= 1
+        self.record('function',func.__name__,start,time.perf_counter()-start,time.thread_time()-cpu_start,rows_in,table_rows(output))
+        return output
+
+    def stage(self, name, rows=np.nan):
+        '''
+        End the current script stage and start the next (None to only end the
+        current stage). rows is the number of rows the stage starts with
+        '''
+        now, cpu_now = time.perf_counter(), time.process_time()
+        if self.current_stage is not None:
+            stage_name, start, cpu_start, rows_in = self.current_stage
+            # The rows out of a stage are the rows the next stage starts with
+            self.record('stage',stage_name,start,now-start,cpu_now-cpu_start,rows_in,rows)
+        self.current_stage = None if name is None else [name,now,cpu_now,rows]
+
+    def stop(self):
+        '''
+        End the current stage and stop cProfile
+        '''
+        self.stage(None)
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_file)
+
+    def frame(self):
+        '''
+        Return the profile as a dataframe
+        '''
+        with self.lock:
+            return pd.DataFrame(self.records,columns=self.columns)
+
+    def write(self, profile_file):
+        '''
+        Write the profile to a .csv file, or to a .json file with a summary of
+        the stages, functions and web service requests
+        '''
+        profile_df = self.frame()
+        if profile_file.endswith('.csv'):
+            profile_df.to_csv(profile_file,index=False)
+            return
+        http_df = profile_df[profile_df['Kind']=='http']
+        summary = {'WallTime':time.perf_counter()-self.start_time,
+                   'PeakRSS':peak_rss(),
+                   'Functions':profile_df[profile_df['Kind']=='function'].groupby('Name').agg(Calls=('WallTime','count'),WallTime=('WallTime','sum'),CPUTime=('CPUTime','sum')).to_dict(orient='index'),
+                   'Requests':{'Count':len(http_df),'Cached':int(http_df['Cached'].fillna(False).sum()),'Errors':int(http_df['Error'].notna().sum()),
+                               'Latency':http_df.loc[http_df['Cached']!=True,'WallTime'].describe(percentiles=[0.5,0.9,0.99]).to_dict()}}
+        with open(profile_file,'w') as f:
+            json.dump({'Summary':summary,'Records':profile_df.to_dict(orient='records')},f,indent=1,default=str)
+
+# Profiler of the current run, set by start_profile(). Profiling is off by default
+run_profiler = None
+
+def start_profile(cprofile_file=None):
+    """
+    Function to start profiling the indicator run. Functions.py entry points
+    and web service requests are recorded until stop_profile() is called
+
+    Parameters
+    ----------
+    cprofile_file : str or None
+        file to dump cProfile statistics to (e.g. for snakeviz). None to not
+        run cProfile
+
+    Returns
+    -------
+    RunProfiler
+    """
+    global run_profiler
+    run_profiler = RunProfiler(cprofile_file)
+    return run_profiler
+
+def profile_stage(name, rows=np.nan):
+    '''
+    Function to mark the start of a script stage (ending the previous stage)
+    when profiling is on
+    '''
+    if run_profiler is not None:
+        run_profiler.stage(name,rows)
+
+def stop_profile(profile_file=None):
+    """
+    Function to stop profiling and write the run profile
+
+    Parameters
+    ----------
+    profile_file : str or None
+        .json or .csv file to write the profile to. None to not write it
+
+    Returns
+    -------
+    DataFrame or None
+        profile records, None if profiling was not started
+    """
+    global run_profiler
+    profiler, run_profiler = run_profiler, None
+    if profiler is None:
+        return None
+    profiler.stop()
+    if profile_file:
+        profiler.write(profile_file)
+    return profiler.frame()
+
+def profiled(func):
+    '''
+    Decorator to record calls of a function when profiling is on
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if run_profiler is None:
+            return func(*args, **kwargs)
+        return run_profiler.call(func,args,kwargs)
+    return wrapper
+
+class RateLimiter:
+    """
+    Thread-safe limiter to space out requests made to a Hilltop server
+
+    Parameters
+    ----------
+    rate : float
+        maximum number of requests per second
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0/rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        '''
+        Block until the next request to the server is allowed
+        '''
+        # Reserve the next time slot and release the lock before sleeping
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+# Share one limiter per host so that simultaneous pulls use the same budget
+host_limiters = {}
+host_limiters_lock = threading.Lock()
+
+def host_limiter(base_url, rate):
+    """
+    Function to obtain the rate limiter of the host in a base url
+
+    Parameters
+    ----------
+    base_url : str
+        root url str. e.g. http://wateruse.ecan.govt.nz
+    rate : float
+        maximum number of requests per second to the host
+
+    Returns
+    -------
+    RateLimiter
+        limiter shared by all requests to the host
+    """
+    host = urlparse(base_url).netloc or base_url
+    with host_limiters_lock:
+        if host not in host_limiters:
+            host_limiters[host] = RateLimiter(rate)
+        # Use the most recently requested rate for the host
+        host_limiters[host].interval = 1.0/rate
+    return host_limiters[host]
+
+class WebServiceCache:
+    """
+    On-disk cache of Hilltop web service responses. Each response is stored
+    in its own folder as parquet files, keyed by the web service function and
+    all of its arguments (base url, hts file, site, measurement, dates,
+    parameter and quality code flags).
+
+    Parameters
+    ----------
+    cache_dir : str
+        folder to store the cached responses in
+    ttl : float or None
+        number of seconds a response is kept before it is requested again.
+        None to keep responses until evicted by size
+    max_size : float or None
+        maximum size of the cache in bytes. The least recently used responses
+        are removed first. None for no limit
+    """
+
+    def __init__(self, cache_dir, ttl=None, max_size=None):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir,exist_ok=True)
+
+    def key(self, func, args, kwargs):
+        '''
+        Create the cache key of a web service request
+        '''
+        request = repr((func.__name__,args,sorted(kwargs.items())))
+        return hashlib.sha1(request.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''
+        Read a cached response. Returns whether the response was found and
+        the response (DataFrame, tuple of DataFrames, or ValueError)
+        '''
+        path = os.path.join(self.cache_dir,key)
+        files = sorted(glob.glob(os.path.join(path,'*')))
+        if not files:
+            return False, None
+        # Responses older than the time to live are requested again
+        if (self.ttl is not None) and (time.time() - os.path.getmtime(files[0]) > self.ttl):
+            return False, None
+        try:
+            if files[0].endswith('error.txt'):
+                with open(files[0]) as f:
+                    output = ValueError(f.read())
+            else:
+                output = [pd.read_parquet(file) for file in files if not file.endswith('tuple.txt')]
+                output = tuple(output) if os.path.isfile(os.path.join(path,'tuple.txt')) else output[0]
+        # The entry may have been evicted by another thread while reading
+        except (OSError, ValueError):
+            return False, None
+        # Mark the response as recently used for size based eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True, output
+
+    def put(self, key, output):
+        '''
+        Write a response to the cache and evict responses if needed
+        '''
+        path = os.path.join(self.cache_dir,key)
+        # Write to a temporary folder that is renamed once complete
+        temp_path = tempfile.mkdtemp(dir=self.cache_dir,prefix='.tmp-')
+        if isinstance(output, ValueError):
+            with open(os.path.join(temp_path,'error.txt'),'w') as f:
+                f.write(str(output))
+        else:
+            if isinstance(output, tuple):
+                open(os.path.join(temp_path,'tuple.txt'),'w').close()
+            for i, df in enumerate(output if isinstance(output, tuple) else [output]):
+                df.to_parquet(os.path.join(temp_path,'{}.parquet'.format(i)))
+        with self.lock:
+            shutil.rmtree(path,ignore_errors=True)
+            os.rename(temp_path,path)
+            self.evict()
+
+    def evict(self):
+        '''
+        Remove expired responses and the least recently used responses until
+        the cache is within the maximum size
+        '''
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith('.tmp-') or not entry.is_dir():
+                continue
+            files = [f for f in os.scandir(entry.path) if f.is_file()]
+            if not files:
+                continue
+            created = min([f.stat().st_mtime for f in files])
+            # Remove responses older than the time to live
+            if (self.ttl is not None) and (time.time() - created > self.ttl):
+                shutil.rmtree(entry.path,ignore_errors=True)
+                continue
+            entries.append([entry.stat().st_mtime,sum([f.stat().st_size for f in files]),entry.path])
+        if self.max_size is None:
+            return
+        # Remove least recently used responses first
+        total = sum([entry[1] for entry in entries])
+        for last_used, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path,ignore_errors=True)
+            total -= size
+
+def request(limiter, cache, func, *args, **kwargs):
+    """
+    Function to call a web service function, using the cached response if one
+    exists and otherwise waiting until the rate limiter allows the request
+
+    Parameters
+    ----------
+    limiter : RateLimiter or None
+        limiter of the host. None to call immediately
+    cache : WebServiceCache or None
+        cache of web service responses. None to always call the server
+    func : function
+        hilltoppy web service function
+    *args, **kwargs
+        arguments passed to func
+
+    Returns
+    -------
+    output of func
+    """
+    # Return the cached response if it exists
+    if cache is not None:
+        key = cache.key(func,args,kwargs)
+        start = time.perf_counter()
+        found, output = cache.get(key)
+        if found:
+            if run_profiler is not None:
+                run_profiler.record('http',func.__name__,start,time.perf_counter()-start,site=(args[2:3] or [None])[0],measurement=(args[3:4] or [None])[0],cached=True)
+            if isinstance(output, ValueError):
+                raise output
+            return output
+    if limiter is not None:
+        limiter.wait()
+    start = time.perf_counter()
+    try:
+        output = func(*args, **kwargs)
+    # The web service raises ValueError when there are no results, which is
+    # cached as well so that empty requests are not repeated
+    except ValueError as error:
+        if run_profiler is not None:
+            run_profiler.record('http',func.__name__,start,time.perf_counter()-start,site=(args[2:3] or [None])[0],measurement=(args[3:4] or [None])[0],cached=False,error=str(error))
+        if cache is not None:
+            cache.put(key,error)
+        raise
+    if run_profiler is not None:
+        run_profiler.record('http',func.__name__,start,time.perf_counter()-start,rows_out=table_rows(output),site=(args[2:3] or [None])[0],measurement=(args[3:4] or [None])[0],cached=False)
+    if cache is not None:
+        cache.put(key,output)
+    return output
+
+@profiled
+def site_data(base_url, hts, site, measurements, limiter=None, cache=None, from_dates={}, units_df=None):
+    """
+    Function to query a Hilltop server for the sample parameters and
+    measurement results of a single site in an hts file.
+
+    Parameters
+    ----------
+    base_url : str
+        root url str. e.g. http://wateruse.ecan.govt.nz
+    hts : str
+        hts file name including the .hts extension.
+    site : str
+        site to pull from the hts file
+    measurements : list of str
+        list of measurements to pull from the site
+    limiter : RateLimiter or None
+        limiter used to space out requests to the server
+    cache : WebServiceCache or None
+        cache of web service responses
+    from_dates : dictionary
+        dictionary matching measurements (or 'WQ Sample') to the date from
+        which to pull data. Data is pulled from the start of the record otherwise
+    units_df : DataFrame or None
+        measurement list of the site, if already requested from the server
+
+    Returns
+    -------
+    DataFrame
+        indexed by Site and DateTime
+    """
+    try:
+        # Obtain the sample parameter metadata
+        sample_data = request(limiter,cache,ws.get_data,base_url,hts,site,'WQ Sample',from_date=from_dates.get('WQ Sample','1001-01-01'),to_date='9999-01-01').unstack('Parameter')
+        sample_data.columns = sample_data.columns.droplevel()
+    except ValueError:
+        sample_data = pd.DataFrame()
+    # Create list of sample parameters
+    sample_parameters = sample_data.columns
+    # Rearrange dataframe
+    sample_data = pd.concat([sample_data],axis=1,keys=['Sample Parameters'])
+    # Create dataframe for units
+    # The measurement list is not cached, so new records at the site are found
+    if units_df is None:
+        units_df = request(limiter,None,ws.measurement_list,base_url,hts,site)
+    
+    # Check if there is any measurement data
+    if units_df.empty:
+        pass
+    else:
+        # Obtain the desired measurement results
+        for measurement in measurements:
+            # Check if site has measurement
+            if measurement in units_df.index.get_level_values(1):
+                # Obtain measurement data from Hilltop
+                data = request(limiter,cache,ws.get_data,base_url,hts,site,measurement,from_date=from_dates.get(measurement,'1001-01-01'),to_date='9999-01-01',parameters=True,quality_codes=True)
+                # Format measurement results, measurement metadata and join to the sample metadata
+                meta_data = data[1].unstack('Parameter').droplevel(1)
+                meta_data.columns = meta_data.columns.droplevel()
+                meta_data = meta_data.drop([x for x in sample_parameters if x in meta_data.columns],axis=1)
+                data = data[0].droplevel(1)
+                data.columns = ['({})'.format(units_df['Units'].loc[site,measurement])]
+                data = pd.concat([data,meta_data],axis=1)
+                data = pd.concat([data],axis=1,keys=[measurement])
+                sample_data = pd.concat([sample_data,data],axis=1)
+    
+    return sample_data
+
+@profiled
+def hilltop_data(base_url, hts, sites, measurements, workers=1, rate_limit=None, cache=None):
     """
     Function to query a Hilltop server for the measurement summary of selected
     sites and measurement in an hts file.
@@ -30,6 +517,12 @@ def hilltop_data(base_url, hts, sites, measurements):
         list of sites to pull from the hts file
     measurements : list of str
         list of measurements to pull from the selected sites
+    workers : int
+        number of sites to request from the server at the same time
+    rate_limit : float or None
+        maximum number of requests per second to the server. None for no limit
+    cache : WebServiceCache or None
+        cache of web service responses. None to request everything from the server
 
     Returns
     -------
@@ -39,44 +532,128 @@ def hilltop_data(base_url, hts, sites, measurements):
     '''
     Format WQ table to match view in Hilltop Manager on site basis
     '''
-    # Initiate empty list of dataframes
-    WQData = []
-    #Extract Nitrate Nitrogen and E.coli data with measurement and sample parameters
-    for site in sites:
-        print(site)
-        try:
-            # Obtain the sample parameter metadata
-            sample_data = ws.get_data(base_url,hts,site,'WQ Sample',from_date='1001-01-01',to_date='9999-01-01').unstack('Parameter')
-            sample_data.columns = sample_data.columns.droplevel()
-        except ValueError:
-            sample_data = pd.DataFrame()
-        # Create list of sample parameters
-        sample_parameters = sample_data.columns
-        # Rearrange dataframe
-        sample_data = pd.concat([sample_data],axis=1,keys=['Sample Parameters'])
-        # Create dataframe for units
-        units_df = ws.measurement_list(base_url,hts,site)
-        
-        # Check if there is any measurement data
-        if units_df.empty:
-            pass
+    # Set the rate limiter for the server
+    limiter = host_limiter(base_url,rate_limit) if rate_limit else None
+    # Extract measurement data with measurement and sample parameters for each site
+    if workers > 1:
+        # Sites are requested concurrently, but results keep the order of the site list
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            WQData = list(executor.map(lambda site: site_data(base_url,hts,site,measurements,limiter,cache),sites))
+    else:
+        WQData = [site_data(base_url,hts,site,measurements,limiter,cache) for site in sites]
+    
+    # Create WQ times series dataframe from list of site dataframes
+    WQData_df = pd.concat(WQData,sort = False)
+    WQData_df = WQData_df.reindex(['Sample Parameters']+measurements,axis=1,level=0)
+
+    return WQData_df
+
+@profiled
+def site_update(base_url, hts, site, measurements, site_df, limiter=None):
+    """
+    Function to update the data of a single site with results added to the
+    Hilltop server since the data was pulled. Measurements where the server
+    record ends before the latest result already held are not requested, and
+    the site is skipped entirely if no measurements have moved.
+
+    Parameters
+    ----------
+    base_url : str
+        root url str. e.g. http://wateruse.ecan.govt.nz
+    hts : str
+        hts file name including the .hts extension.
+    site : str
+        site to pull from the hts file
+    measurements : list of str
+        list of measurements to pull from the site
+    site_df : DataFrame
+        data previously held for the site in the format output from site_data()
+    limiter : RateLimiter or None
+        limiter used to space out requests to the server
+
+    Returns
+    -------
+    DataFrame
+        indexed by Site and DateTime
+    """
+    # The measurement list is always requested from the server to see which
+    # records have moved since the last pull
+    units_df = request(limiter,None,ws.measurement_list,base_url,hts,site)
+    if units_df.empty:
+        return site_df
+    # Find the latest result held for each measurement and compare to the
+    # end of the record on the server
+    from_dates = {}
+    for measurement in measurements:
+        if measurement not in units_df.index.get_level_values(1):
+            continue
+        units = '({})'.format(units_df['Units'].loc[site,measurement])
+        if (measurement,units) in site_df.columns:
+            latest = site_df[measurement,units].dropna().index.get_level_values('DateTime').max()
         else:
-            # Obtain the desired measurement results
-            for measurement in measurements:
-                # Check if site has measurement
-                if measurement in units_df.index.get_level_values(1):
-                    # Obtain measurement data from Hilltop
-                    data = ws.get_data(base_url,hts,site,measurement,from_date='1001-01-01',to_date='9999-01-01',parameters=True,quality_codes=True)
-                    # Format measurement results, measurement metadata and join to the sample metadata
-                    meta_data = data[1].unstack('Parameter').droplevel(1)
-                    meta_data.columns = meta_data.columns.droplevel()
-                    meta_data = meta_data.drop([x for x in sample_parameters if x in meta_data.columns],axis=1)
-                    data = data[0].droplevel(1)
-                    data.columns = ['({})'.format(units_df['Units'].loc[site,measurement])]
-                    data = pd.concat([data,meta_data],axis=1)
-                    data = pd.concat([data],axis=1,keys=[measurement])
-                    sample_data = pd.concat([sample_data,data],axis=1)
-        WQData.append(sample_data)
+            latest = pd.NaT
+        # Pull the full record for measurements that are not held yet
+        if pd.isna(latest):
+            from_dates[measurement] = '1001-01-01'
+        # Pull from the day of the latest result (results on that day are replaced)
+        elif units_df['To'].loc[site,measurement] > latest:
+            from_dates[measurement] = latest.strftime('%Y-%m-%d')
+    # Skip the site if no records have moved
+    if not from_dates:
+        return site_df
+    update_measurements = list(from_dates.keys())
+    # Sample parameters are needed from the earliest date of any measurement pulled
+    from_dates['WQ Sample'] = min(from_dates.values())
+    new_df = site_data(base_url,hts,site,update_measurements,limiter,None,from_dates,units_df)
+    # Merge the new results into the held data, with new values taking priority
+    return new_df.combine_first(site_df)
+
+@profiled
+def hilltop_data_update(base_url, hts, sites, measurements, WQData_df, workers=1, rate_limit=None):
+    """
+    Function to update a dataframe output from hilltop_data() with results
+    added to the Hilltop server since it was pulled, rather than pulling the
+    full record of every site again.
+
+    Parameters
+    ----------
+    base_url : str
+        root url str. e.g. http://wateruse.ecan.govt.nz
+    hts : str
+        hts file name including the .hts extension.
+    sites : list of str
+        list of sites to pull from the hts file
+    measurements : list of str
+        list of measurements to pull from the selected sites
+    WQData_df : DataFrame
+        dataframe previously output from hilltop_data()
+    workers : int
+        number of sites to request from the server at the same time
+    rate_limit : float or None
+        maximum number of requests per second to the server. None for no limit
+
+    Returns
+    -------
+    DataFrame
+        indexed by Site and DateTime
+    """
+    # Set the rate limiter for the server
+    limiter = host_limiter(base_url,rate_limit) if rate_limit else None
+    held_sites = set(WQData_df.index.get_level_values('Site'))
+    
+    def update(site):
+        # Sites that are not held yet are pulled in full
+        if site not in held_sites:
+            return site_data(base_url,hts,site,measurements,limiter)
+        # Only keep columns that have data at the site
+        site_df = WQData_df.xs(site,level='Site',drop_level=False).dropna(axis=1,how='all')
+        return site_update(base_url,hts,site,measurements,site_df,limiter)
+    
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            WQData = list(executor.map(update,sites))
+    else:
+        WQData = [update(site) for site in sites]
     
     # Create WQ times series dataframe from list of site dataframes
     WQData_df = pd.concat(WQData,sort = False)
@@ -84,6 +661,208 @@ def hilltop_data(base_url, hts, sites, measurements):
 
     return WQData_df
 
+# Columns of the long format records of a site, as output from site_records()
+record_columns = ['Site','DateTime','Measurement','Parameter','Value']
+
+def site_records(site_df):
+    """
+    Function to convert the data of a site to long format records with one
+    row for each value. Results are stored under their units as parameter
+    (i.e., '(mg/L)') and sample parameters under the measurement
+    'Sample Parameters', matching the columns output from hilltop_data()
+
+    Parameters
+    ----------
+    site_df : DataFrame
+        data of a site in the format output from site_data()
+
+    Returns
+    -------
+    DataFrame
+        with columns Site, DateTime, Measurement, Parameter and Value (str)
+    """
+    if site_df.empty:
+        return pd.DataFrame(columns=record_columns)
+    # Stack both column levels, dropping empty values. Empty values are dropped
+    # after stacking as newer pandas versions keep them in stack()
+    records = site_df.stack([0,1]).dropna()
+    records = records.rename_axis(record_columns[:-1]).rename('Value')
+    records_df = records.reset_index()
+    # Values are stored as text since Hilltop values can be of mixed types
+    records_df['Value'] = records_df['Value'].astype(str)
+    return records_df
+
+def hilltop_records(base_url, hts, sites, measurements, workers=1, rate_limit=None, cache=None):
+    """
+    Generator of the long format records of each site in an hts file. Only
+    as many sites as workers are pulled ahead of the site being returned, so
+    memory is bounded by the largest sites rather than the whole hts file
+
+    Parameters
+    ----------
+    base_url : str
+        root url str. e.g. http://wateruse.ecan.govt.nz
+    hts : str
+        hts file name including the .hts extension.
+    sites : list of str
+        list of sites to pull from the hts file
+    measurements : list of str
+        list of measurements to pull from the selected sites
+    workers : int
+        number of sites to request from the server at the same time
+    rate_limit : float or None
+        maximum number of requests per second to the server. None for no limit
+    cache : WebServiceCache or None
+        cache of web service responses. None to request everything from the server
+
+    Yields
+    ------
+    DataFrame
+        records of each site in the order of the site list, as output from
+        site_records()
+    """
+    # Set the rate limiter for the server
+    limiter = host_limiter(base_url,rate_limit) if rate_limit else None
+    
+    def pull(site):
+        return site_records(site_data(base_url,hts,site,measurements,limiter,cache))
+    
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for site in sites:
+                pending.append(executor.submit(pull,site))
+                # Wait for the oldest site once all workers are busy
+                if len(pending) >= workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    else:
+        for site in sites:
+            yield pull(site)
+
+@profiled
+def hilltop_store(base_url, hts, sites, measurements, store, workers=1, rate_limit=None, cache=None):
+    """
+    Function to pull sites from a Hilltop server into a Parquet file of long
+    format records. Each site is written as it is pulled (one row group per
+    site), so the data of the hts file is never held in memory at once
+
+    Parameters
+    ----------
+    base_url : str
+        root url str. e.g. http://wateruse.ecan.govt.nz
+    hts : str
+        hts file name including the .hts extension.
+    sites : list of str
+        list of sites to pull from the hts file
+    measurements : list of str
+        list of measurements to pull from the selected sites
+    store : str
+        Parquet file to write the records to. It is replaced once all sites
+        have been pulled
+    workers : int
+        number of sites to request from the server at the same time
+    rate_limit : float or None
+        maximum number of requests per second to the server. None for no limit
+    cache : WebServiceCache or None
+        cache of web service responses. None to request everything from the server
+
+    Returns
+    -------
+    int
+        number of records written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([('Site',pa.string()),('DateTime',pa.timestamp('ns')),('Measurement',pa.string()),
+                        ('Parameter',pa.string()),('Value',pa.string())])
+    # Write to a temporary file so that a failed pull keeps the previous store
+    temp_file = store + '.tmp'
+    rows = 0
+    with pq.ParquetWriter(temp_file,schema) as writer:
+        for records_df in hilltop_records(base_url,hts,sites,measurements,workers,rate_limit,cache):
+            if records_df.empty:
+                continue
+            writer.write_table(pa.Table.from_pandas(records_df,schema=schema,preserve_index=False))
+            rows += len(records_df)
+    os.replace(temp_file,store)
+    
+    return rows
+
+@profiled
+def read_hilltop_store(store, measurements=None, sites=None):
+    """
+    Function to read records written by hilltop_store() into the format output
+    from hilltop_data(). Only the selected measurements and sites are read
+
+    Parameters
+    ----------
+    store : str
+        Parquet file written by hilltop_store()
+    measurements : list of str or None
+        list of measurements to read. None for all measurements
+    sites : list of str or None
+        list of sites to read. None for all sites
+
+    Returns
+    -------
+    DataFrame
+        indexed by Site and DateTime
+    """
+    filters = []
+    if measurements is not None:
+        filters.append(('Measurement','in',['Sample Parameters']+list(measurements)))
+    if sites is not None:
+        filters.append(('Site','in',list(sites)))
+    records_df = pd.read_parquet(store,filters=filters or None)
+    # Unstack the measurement and parameter of each value into columns
+    WQData_df = records_df.set_index(record_columns[:-1])['Value'].unstack(['Measurement','Parameter'])
+    WQData_df.columns.names = [None,None]
+    if measurements is not None:
+        WQData_df = WQData_df.reindex(['Sample Parameters']+list(measurements),axis=1,level=0)
+    
+    return WQData_df
+
+class ResultCollector:
+    """
+    Collector of result dataframes that are combined into one table with a
+    fixed set of columns and data types. Results are only concatenated once
+    when the table is requested, instead of copying the table for each result
+
+    Parameters
+    ----------
+    columns : list of str
+        columns of the combined table, in order
+    dtypes : dict
+        data types to set on columns of the combined table
+    """
+
+    def __init__(self, columns, dtypes={}):
+        self.columns = list(columns)
+        self.dtypes = dict(dtypes)
+        self.chunks = []
+
+    def append(self, df):
+        '''
+        Add a dataframe of results. Columns that are not in the table are
+        dropped and missing columns are filled with NaN
+        '''
+        # Empty results do not change the table
+        if len(df) > 0:
+            self.chunks.append(df.reindex(columns=self.columns).rename_axis(columns=None))
+
+    def frame(self, ignore_index=False):
+        '''
+        Combine the collected results into one dataframe
+        '''
+        if self.chunks:
+            df = pd.concat(self.chunks,ignore_index=ignore_index,sort=False)
+        else:
+            df = pd.DataFrame(columns=self.columns)
+        return df.astype(self.dtypes)
+
+@profiled
 def stacked_data(df, measurements, units_dict):
     """
     Function to transform Hilltop view of dataframe to stacked and filtered
@@ -101,11 +880,13 @@ def stacked_data(df, measurements, units_dict):
     Returns
     -------
     DataFrame
-        dataframe of measurement results that can be used in indicator stats
+        dataframe of measurement results that can be used in indicator stats.
+        Site, Measurement and Units are categorical and Censor holds the
+        censor codes output by censor_codes()
     """
     
     # Set dataframe structure
-    StatsData_df = pd.DataFrame(columns=['Site','Measurement','Units','HydroYear','DateTime','Observation','Censor','Numeric'])
+    StatsData = ResultCollector(['Site','Measurement','Units','HydroYear','DateTime','Observation','Censor','Numeric'])
     
     for measurement in measurements:
         MeasurementData = df[measurement,'({})'.format(units_dict[measurement])]
@@ -115,7 +896,8 @@ def stacked_data(df, measurements, units_dict):
         MeasurementData_df = MeasurementData.to_frame().reset_index()
         MeasurementData_df['Measurement'] = measurement
         MeasurementData_df['Units'] = units_dict[measurement]
-        StatsData_df = StatsData_df.append(MeasurementData_df)
+        StatsData.append(MeasurementData_df)
+    StatsData_df = StatsData.frame()
     
     # Create HydroYear column from year and month
     StatsData_df['HydroYear'] = np.where(StatsData_df.DateTime.dt.month <= 6,
@@ -123,12 +905,13 @@ def stacked_data(df, measurements, units_dict):
                                                      StatsData_df.DateTime.dt.year+1)
     
     # Split censor component from numeric component of observation
-    StatsData_df['Censor'] = np.where(StatsData_df['Observation'].str.startswith(tuple(['<','>'])),StatsData_df['Observation'].str[0],None)
-    StatsData_df['Numeric'] = StatsData_df['Observation'].map(lambda x: x.replace('<','').replace('>',''))
-    StatsData_df['Numeric'] = pd.to_numeric(StatsData_df['Numeric'])
+    StatsData_df['Censor'], StatsData_df['Numeric'] = censor_split(StatsData_df['Observation'])
+    # Store repeated labels as categories
+    StatsData_df[['Site','Measurement','Units']] = StatsData_df[['Site','Measurement','Units']].astype('category')
 
     return StatsData_df
 
+@profiled
 def sample_freq(df,semiannual):
     """
     Function to estimate data collection frequency for each hydro year
@@ -148,45 +931,105 @@ def sample_freq(df,semiannual):
         dataframe of measurement results with estimated sampling frequency
     """
     
-   # Initiate sample frequency dataframe
-    Frequency_df = df.copy()
-    # Add semester, quarter, month, and day columns
-    if semiannual:
-        Frequency_df['Semester'] = np.where(Frequency_df['HydroYear']==Frequency_df['DateTime'].dt.year,2,1)
-    Frequency_df['Quarter'] = Frequency_df['DateTime'].dt.quarter
-    Frequency_df['Month'] = Frequency_df['DateTime'].dt.month
+    # Sort samples by hydro year and time once. Within a hydro year, samples
+    # with the same time, day, month, quarter, or semester are then adjacent
+    group_ids = df.groupby(['Site','Measurement','HydroYear'],sort=True,observed=True).ngroup().to_numpy()
+    order = np.lexsort((df['DateTime'].to_numpy(),group_ids))
+    group_ids = group_ids[order]
+    DateTime = pd.DatetimeIndex(df['DateTime'].to_numpy()[order])
+    # Flag the first sample of each run of equal values
+    def changes(values):
+        values = np.asarray(values)
+        flags = np.ones(len(values),dtype=bool)
+        flags[1:] = values[1:] != values[:-1]
+        return flags
+    new_group = changes(group_ids)
+    starts = np.flatnonzero(new_group)
+    # Count the number of distinct values in each hydro year
+    def distinct(values):
+        return np.bincount(np.cumsum(new_group)-1,weights=new_group|changes(values),minlength=len(starts)).astype(np.int64)
+    # Initiate sample frequency dataframe with one row for each hydro year
+    Frequency_df = df[['Site','Measurement','HydroYear']].iloc[order[starts]]
+    Frequency_df = pd.DataFrame(index=pd.MultiIndex.from_frame(Frequency_df))
+    # Add sample, day, month, and quarter counts for each hydro year.
     # Leap year can cause 1 July and 30 June to have the same dayofyear integer
     # A new index is created to prevent this.
-    Frequency_df['Day'] = Frequency_df['DateTime'].dt.month*31 + Frequency_df['DateTime'].dt.day
-    # Add sample count column for each hydro year
-    Samples = Frequency_df.groupby(['Site','Measurement','HydroYear']).agg({"DateTime": "nunique"}).rename(columns={'DateTime':'Samples'})
-    DaysSampled = Frequency_df.groupby(['Site','Measurement','HydroYear']).agg({"Day": "nunique"}).rename(columns={'Day':'DaysSampled'})
-    MonthsSampled = Frequency_df.groupby(['Site','Measurement','HydroYear']).agg({"Month": "nunique"}).rename(columns={'Month':'MonthsSampled'})
-    QuartersSampled = Frequency_df.groupby(['Site','Measurement','HydroYear']).agg({"Quarter": "nunique"}).rename(columns={'Quarter':'QuartersSampled'})
-    if semiannual:
-        SemestersSampled = Frequency_df.groupby(['Site','Measurement','HydroYear']).agg({"Semester": "nunique"}).rename(columns={'Semester':'SemestersSampled'})
-    Frequency_df = pd.merge(Samples,DaysSampled,on=['Site','Measurement','HydroYear'],how='outer')
-    Frequency_df = pd.merge(Frequency_df,MonthsSampled,on=['Site','Measurement','HydroYear'],how='outer')
-    Frequency_df = pd.merge(Frequency_df,QuartersSampled,on=['Site','Measurement','HydroYear'],how='outer')
+    Frequency_df['Samples'] = distinct(DateTime)
+    Frequency_df['DaysSampled'] = distinct(DateTime.month*31 + DateTime.day)
+    Frequency_df['MonthsSampled'] = distinct(DateTime.month)
+    Frequency_df['QuartersSampled'] = distinct(DateTime.quarter)
+    # Semesters are split by the calendar year within the hydro year
     if semiannual:
-        Frequency_df = pd.merge(Frequency_df,SemestersSampled,on=['Site','Measurement','HydroYear'],how='outer')
-    # Set rules for estimating sampling frequency
-    Frequency_df['Frequency'] = np.where(Frequency_df['QuartersSampled']==1,'A',None)
-    Frequency_df['Frequency'] = np.where(Frequency_df['QuartersSampled']==2,'Q',Frequency_df['Frequency'])
+        Frequency_df['SemestersSampled'] = distinct(DateTime.year)
+    # Set rules for estimating sampling frequency. Rules are listed from
+    # highest to lowest priority
+    rules = [(Frequency_df['MonthsSampled']>=6,'M'),(Frequency_df['QuartersSampled']>2,'Q')]
     if semiannual:
-        Frequency_df['Frequency'] = np.where(Frequency_df['SemestersSampled']==2,'S',Frequency_df['Frequency'])
-    Frequency_df['Frequency'] = np.where(Frequency_df['QuartersSampled']>2,'Q',Frequency_df['Frequency'])
-    Frequency_df['Frequency'] = np.where(Frequency_df['MonthsSampled']>=6,'M',Frequency_df['Frequency'])
-
+        rules.append((Frequency_df['SemestersSampled']==2,'S'))
+    rules += [(Frequency_df['QuartersSampled']==2,'Q'),(Frequency_df['QuartersSampled']==1,'A')]
+    Frequency_df['Frequency'] = np.select([rule for rule,freq in rules],[freq for rule,freq in rules],None)
     
     return Frequency_df
 
 def round_half_up(n, decimals=0):
-    out = n
-    if ~np.isnan(out):
-        multiplier = 10 ** decimals
-        out = math.floor(n*multiplier + 0.5) / multiplier
-    return out
+    '''
+    Function to round values half up (i.e., 0.125 to 0.13 for 2 decimals)
+    
+    Parameters
+    ----------
+    n : float, array, or Series
+        values to round. NaN values are returned as NaN
+    decimals : int
+        number of decimals to round to
+    
+    Returns
+    -------
+    float, array, or Series
+        rounded values
+    '''
+    multiplier = 10 ** decimals
+    return np.floor(n*multiplier + 0.5) / multiplier
+
+def round_ladder(numeric,ladder,inclusive=False,keep=[]):
+    '''
+    Function to round values to match measurement precision, with reduced
+    precision for higher values
+    
+    Parameters
+    ----------
+    numeric : array or Series
+        values to round
+    ladder : list of [float, int]
+        rounding steps applied in order, each with the threshold above which
+        values are rounded (None to round all values) and the number of decimals
+    inclusive : bool
+        whether values equal to a threshold are rounded by that step
+    keep : list of float
+        values that should not be rounded (i.e., grade cutoffs)
+    
+    Returns
+    -------
+    array or Series
+        rounded values
+    '''
+    
+    values = np.array(numeric,dtype=np.float64)
+    for threshold, decimals in ladder:
+        # Determine values to round in this step. Thresholds are compared to
+        # the values rounded by the previous steps
+        if threshold is None:
+            step = np.ones(len(values),dtype=bool)
+        elif inclusive:
+            step = values >= threshold
+        else:
+            step = values > threshold
+        step &= ~np.isin(values,keep)
+        # Only round the values in this step
+        values[step] = round_half_up(values[step],decimals)
+    
+    if isinstance(numeric,pd.Series):
+        return pd.Series(values,index=numeric.index,name=numeric.name)
+    return values
 
 def sort_censors(df,censor,numeric,ascending):
     '''
@@ -198,8 +1041,10 @@ def sort_censors(df,censor,numeric,ascending):
     ----------
     df : DataFrame
         dataframe to sort
-    column : str
-        column to use to sort the dataframe
+    censor : str
+        column of censor codes as output by censor_codes()
+    numeric : str
+        column of numeric components
     ascending : True/False
         if True, least to greatest. if False, greatest to least.
     
@@ -209,33 +1054,350 @@ def sort_censors(df,censor,numeric,ascending):
         Sorted by column
     '''
     
-    # Rank censors for sorting
-    df['CensorRank1'] = df[censor].map({'>':2,None:1,'<':1})
-    df['CensorRank2'] = df[censor].map({'>':100,None:10,'<':1})
+    codes = censor_codes(df[censor].to_numpy()).astype(np.int64)
+    values = df[numeric].to_numpy(dtype=np.float64)
+    # Flip the keys to sort from greatest to least
+    sign = 1 if ascending else -1
     # Sort by '>' vs other, then by numeric component, then by None vs '<'
-    df = df.sort_values(by=['CensorRank1',numeric,'CensorRank2'],ascending=ascending)
-    df = df.drop(columns=['CensorRank1','CensorRank2'])
+    # Equal values stay in the order they are given
+    order = np.lexsort((sign*codes,sign*values,sign*(codes==1)))
     
-    return df
+    return df.iloc[order]
 
-def Hazen_percentile(df,percentile,group_columns,censor_column_in,numeric_column_in,censor_column_out,numeric_column_out):
+def censor_codes(censor):
     """
-    Function to calculate percentile or medians
+    Function to convert censor components to integer codes. Codes are ordered
+    such that '<' < None < '>', with 'Error' given its own code.
 
     Parameters
     ----------
-    df : DataFrame
-        dataframe
-    percentile : float
-        percentile to calculate (i.e., 95 or 50 for median)
+    censor : array-like
+        censor components (<, >, Error, or None). Integer codes are returned as is
+
+    Returns
+    -------
+    array of int8
+        -1 for '<', 0 for None, 1 for '>', and 2 for 'Error'
+    """
+    censor = np.asarray(censor)
+    if np.issubdtype(censor.dtype, np.integer):
+        return censor.astype(np.int8)
+    codes = np.zeros(len(censor),dtype=np.int8)
+    codes[censor == '<'] = -1
+    codes[censor == '>'] = 1
+    codes[censor == 'Error'] = 2
+    return codes
+
+def censor_labels(codes):
+    """
+    Function to convert integer censor codes back to censor components
+
+    Parameters
+    ----------
+    codes : array of int
+        codes as output by censor_codes()
+
+    Returns
+    -------
+    array of object
+        censor components (<, >, Error, or None)
+    """
+    return np.array(['<',None,'>','Error'],dtype=object)[np.asarray(codes)+1]
+
+def censor_split(observations):
+    """
+    Function to split observations into censor codes and numeric components
+
+    Parameters
+    ----------
+    observations : array-like of str
+        observations as stored in Hilltop (e.g., <0.5, >2400, 1.2)
+
+    Returns
+    -------
+    array of int8
+        censor codes as output by censor_codes()
+    array of float
+        numeric component of each observation
+    """
+    # Work on the bytes of each observation so that all values are parsed at once
+    observations = np.asarray(observations).astype('S')
+    chars = observations.view(np.uint8).reshape(len(observations),observations.itemsize)
+    # Censor component is the first character of the observation
+    codes = np.zeros(len(observations),dtype=np.int8)
+    codes[chars[:,0] == ord('<')] = -1
+    codes[chars[:,0] == ord('>')] = 1
+    # Blank out censor characters to leave the numeric component
+    chars[(chars == ord('<')) | (chars == ord('>'))] = ord(' ')
+    numeric = observations.astype(np.float64)
+    return codes, numeric
+
+def censor_results(censor,numeric):
+    """
+    Function to combine censor codes and numeric components into result strings
+
+    Parameters
+    ----------
+    censor : Series
+        censor codes as output by censor_codes()
+    numeric : Series
+        numeric components
+
+    Returns
+    -------
+    Series
+        results as strings (e.g., <0.5, 1.2)
+    """
+    prefix = np.array(['<','','>','Error'],dtype=object)[censor_codes(censor.to_numpy()).astype(int)+1]
+    return pd.Series(prefix,index=numeric.index)+numeric.astype(str)
+
+def censor_order(group_ids, censor, numeric):
+    """
+    Function to sort censored values within groups from least to greatest.
+    Censored values are placed as high as their range allows.
+
+    Parameters
+    ----------
+    group_ids : array of int
+        group number of each value
+    censor : array of int
+        censor codes as output by censor_codes()
+    numeric : array of float
+        numeric component of each value
+
+    Returns
+    -------
+    array of int
+        indices that sort the values
+    """
+    # Sort by group, then by '>' vs other, then by numeric component, then by
+    # None vs '<'. Error censors are placed last. The sort columns are combined
+    # into a single integer key, which is much faster to sort than several columns
+    values, numeric_rank = np.unique(numeric,return_inverse=True)
+    key = ((np.asarray(group_ids,dtype=np.int64)*3 + np.where(censor==2,2,censor==1))*len(values) + numeric_rank)*4 + (censor+1)
+    return np.argsort(key)
+
+def hazen_rank(samples, percentile):
+    """
+    Function to determine the Hazen rank used to calculate a percentile
+
+    Parameters
+    ----------
+    samples : array of int
+        number of values the percentile is calculated from
+    percentile : float
+        percentile to calculate (i.e., 95 or 50 for median)
+
+    Returns
+    -------
+    array of float
+        Hazen rank, or nan if there are not enough values for the percentile
+    """
+    # Calculate required sample size for percentile
+    if percentile >= 50:
+        required = int(np.ceil(100/(2*(100-percentile))))
+    elif percentile < 50:
+        required = int(np.ceil(100/(2*percentile)))
+    # Ensure the minimum numbered of samples required is satisfied
+    return np.where(np.asarray(samples)>=required,0.5+percentile/100*np.asarray(samples),np.nan)
+
+def hazen_values(censor, numeric, rank_out, lower, upper):
+    """
+    Function to combine the ranked values that contribute to Hazen percentiles
+
+    Parameters
+    ----------
+    censor : array of int
+        censor codes of the values, sorted using censor_order()
+    numeric : array of float
+        numeric components of the values, sorted using censor_order()
+    rank_out : array of float
+        Hazen rank of each percentile as output by hazen_rank()
+    lower : array of int
+        position of the value at the Hazen rank rounded down
+    upper : array of int
+        position of the value at the Hazen rank rounded up
+
+    Returns
+    -------
+    tuple of arrays
+        censor code (int8) and numeric component (float) of each percentile
+    """
+    valid = ~np.isnan(rank_out)
+    rank = np.floor(rank_out)
+    decimal = valid & (rank_out != rank)
+    lower = np.where(valid,lower,0)
+    upper = np.where(decimal,upper,lower)
+    
+    # if Hazen rank is an integer, then percentile is the ranked value
+    numeric_out = np.where(valid,numeric[lower],np.nan)
+    censor_out = np.where(valid,censor[lower],0)
+    # if Hazen Rank is a decimal, then percentile is combination of two values
+    lower_contribution = (1-(rank_out-rank))*numeric[lower]
+    upper_contribution = (1-((rank+1)-rank_out))*numeric[upper]
+    # Missing contributions are skipped
+    combined = np.where(np.isnan(lower_contribution),upper_contribution,
+               np.where(np.isnan(upper_contribution),lower_contribution,
+                        lower_contribution+upper_contribution))
+    numeric_out = np.where(decimal,combined,numeric_out)
+    # Combine censors of contributing values. '<' and None is '<', '>' and
+    # None is '>', and '<' with '>' is an Error. Values with an Error censor
+    # do not contribute a censor
+    lower_censor = censor[lower]
+    upper_censor = censor[upper]
+    no_censor = (lower_censor==2) & (upper_censor==2)
+    lower_censor = np.where(lower_censor==2,upper_censor,lower_censor)
+    upper_censor = np.where(upper_censor==2,lower_censor,upper_censor)
+    combined = np.where(lower_censor*upper_censor == -1,2,np.sign(lower_censor+upper_censor))
+    censor_out = np.where(decimal,np.where(no_censor,0,combined),np.where(censor_out==2,0,censor_out)).astype(np.int8)
+    
+    return censor_out, numeric_out
+
+def hazen_kernel(group_ids, censor, numeric, percentile):
+    """
+    Function to calculate Hazen percentiles of groups of values. Values are
+    sorted once by group and censored value, and the percentile of each group
+    is read from the group offsets in the sorted arrays.
+
+    Parameters
+    ----------
+    group_ids : array of int
+        group number (0 to number of groups - 1) of each value
+    censor : array of int
+        censor codes as output by censor_codes()
+    numeric : array of float
+        numeric component of each value
+    percentile : float
+        percentile to calculate (i.e., 95 or 50 for median)
+
+    Returns
+    -------
+    tuple of arrays
+        censor code (int8) and numeric component (float) of the percentile of
+        each group. Groups without enough values have a numeric of nan
+    """
+    
+    group_ids = np.asarray(group_ids)
+    censor = censor_codes(censor)
+    numeric = np.asarray(numeric,dtype=float)
+    # Sort values from least to greatest within each group
+    order = censor_order(group_ids,censor,numeric)
+    # Define the number of values within the groups and the group offsets
+    samples = np.bincount(group_ids,minlength=(group_ids.max()+1 if len(group_ids) else 0))
+    starts = np.cumsum(samples) - samples
+    # Determine Hazen Rank and the positions of the contributing values
+    rank_out = hazen_rank(samples,percentile)
+    lower = (starts + np.nan_to_num(np.floor(rank_out)) - 1).astype(int)
+    
+    return hazen_values(censor[order],numeric[order],rank_out,lower,lower+1)
+
+def rolling_hazen(years, censor, numeric, indicator_years, window, percentile):
+    """
+    Function to calculate Hazen percentiles of the values of a single site
+    over rolling windows of hydro years. Values are sorted by hydro year and
+    each window takes its values as a block of the sorted values, so memory
+    grows with the number of values rather than the number of windows.
+
+    Parameters
+    ----------
+    years : array of int
+        hydro year of each value
+    censor : array of int
+        censor codes as output by censor_codes()
+    numeric : array of float
+        numeric component of each value
+    indicator_years : array of int
+        final hydro year of each window
+    window : int
+        number of hydro years in each window
+    percentile : float
+        percentile to calculate (i.e., 95 or 50 for median)
+
+    Returns
+    -------
+    tuple of arrays
+        number of values, censor code (int8) and numeric component (float)
+        of the percentile of each window
+    """
+    
+    censor = censor_codes(censor)
+    numeric = np.asarray(numeric,dtype=float)
+    indicator_years = np.asarray(indicator_years)
+    # Sort values by hydro year and find the block of values in each window
+    order = np.argsort(years,kind='stable')
+    years = np.asarray(years)[order]
+    starts = np.searchsorted(years,indicator_years-window,side='right')
+    samples = np.searchsorted(years,indicator_years,side='right') - starts
+    # Join the blocks of the windows with values. Each value is in at most
+    # 'window' blocks
+    filled = samples > 0
+    block_ids = np.repeat(np.arange(filled.sum()),samples[filled])
+    offsets = np.cumsum(samples[filled]) - samples[filled]
+    positions = order[np.repeat(starts[filled],samples[filled]) + np.arange(len(block_ids)) - offsets[block_ids]]
+    # Calculate the percentile of each block
+    censor_out = np.zeros(len(indicator_years),dtype=np.int8)
+    numeric_out = np.full(len(indicator_years),np.nan)
+    censor_out[filled], numeric_out[filled] = hazen_kernel(block_ids,censor[positions],numeric[positions],percentile)
+    
+    return samples, censor_out, numeric_out
+
+def hazen_groups(df,percentile,group_columns,censor_column_in,numeric_column_in,censor_column_out,numeric_column_out):
+    """
+    Function to calculate percentile or medians with one row per group
+
+    Parameters
+    ----------
+    df : DataFrame
+        dataframe
+    percentile : float
+        percentile to calculate (i.e., 95 or 50 for median)
+    groupby : list of str
+        list of columns to groupby data by
+    censor_column_in : str
+        censor component input (censor codes as output by censor_codes())
+    numeric_column_in : float
+        numeric component input
+    censor_column_out : str
+        censor component output (censor codes as output by censor_codes())
+    numeric_column_out : float
+        numeric component input
+    
+    Returns
+    -------
+    DataFrame
+        dataframe of Hazen percentile results with one row per group
+    """
+    
+    group_ids = df.groupby(group_columns,sort=False,observed=True).ngroup().to_numpy()
+    # Rows with missing group values are not part of any group
+    keep = group_ids >= 0
+    censor, numeric = hazen_kernel(group_ids[keep],df[censor_column_in].to_numpy()[keep],df[numeric_column_in].to_numpy()[keep],percentile)
+    # Groups are numbered in order of first appearance
+    groups_df = df.loc[keep,group_columns].drop_duplicates().reset_index(drop=True)
+    groups_df[censor_column_out] = censor
+    groups_df[numeric_column_out] = numeric
+    
+    return groups_df
+
+@profiled
+def Hazen_percentile(df,percentile,group_columns,censor_column_in,numeric_column_in,censor_column_out,numeric_column_out):
+    """
+    Function to calculate percentile or medians
+
+    Parameters
+    ----------
+    df : DataFrame
+        dataframe
+    percentile : float
+        percentile to calculate (i.e., 95 or 50 for median)
     groupby : list of str
         list of columns to groupby data by
     censor_column_in : str
-        censor component input (<, >, or None)
+        censor component input (censor codes as output by censor_codes())
     numeric_column_in : float
         numeric component input
     censor_column_out : str
-        censor component input (<, >, or None)
+        censor component output (censor codes as output by censor_codes())
     numeric_column_out : float
         numeric component input
     
@@ -246,218 +1408,619 @@ def Hazen_percentile(df,percentile,group_columns,censor_column_in,numeric_column
         dataframe of Hazen percentile results grouped and joined to original table
     """
     
-    # Calculate required sample size for percentile
-    if percentile >= 50:
-        required = int(np.ceil(100/(2*(100-percentile))))
-    elif percentile < 50:
-        required = int(np.ceil(100/(2*percentile)))
-    
-    # Filter measurement and drop DateTime column
     hazen_df = df.copy()
-    # Sort dataframe from least to greatest
-    hazen_df = sort_censors(hazen_df, censor_column_in, numeric_column_in, ascending=True)
-    # Rank values when grouped by chosen columns from largest to smallest
-    hazen_df['Rank'] = hazen_df.groupby(group_columns).cumcount()+1
-    # Define the number of values within the groups and join to dataframe
-    hazen_df = pd.merge(hazen_df,hazen_df.groupby(group_columns)['Rank'].max().rename('Samples'),on=group_columns,how='outer')
-    # Determine Hazen Rank to be used to calculate the percentile
-    # Ensure the minimum numbered of samples required is satisfied
-    hazen_df['HazenRank'] = np.where(hazen_df['Samples']>=required,0.5+percentile/100*hazen_df['Samples'],np.nan)
-    # Set numerical values for censors
-    hazen_df['CensorRank'] = hazen_df[censor_column_in].map({'>':100,None:10,'<':1})
+    # Number the groups, then calculate the percentile of each group
+    group_ids = hazen_df.groupby(group_columns,sort=False,observed=True).ngroup().to_numpy()
+    keep = group_ids >= 0
+    censor, numeric = hazen_kernel(group_ids[keep],hazen_df[censor_column_in].to_numpy()[keep],hazen_df[numeric_column_in].to_numpy()[keep],percentile)
+    # Join the group results back to each row in the group
+    censor = np.append(censor,np.int8(0))
+    numeric = np.append(numeric,np.nan)
+    hazen_df[censor_column_out] = censor[group_ids]
+    hazen_df[numeric_column_out] = numeric[group_ids]
     
-    # Determine the contribution of each value towards the percentile
-    # if Hazen rank is an integer, then percentile is the ranked value
-    hazen_df['CensorRankContribution'] = np.where(hazen_df['HazenRank']==hazen_df['Rank'],hazen_df['CensorRank'],np.nan)
-    hazen_df['NumericContribution'] = np.where(hazen_df['HazenRank']==hazen_df['Rank'],hazen_df[numeric_column_in],np.nan)
-    # if Hazen Rank is a decimal, then percentile is combination of two values
-    # Define the contribution from the lower rank value
-    hazen_df['CensorRankContribution'] = np.where((((hazen_df['HazenRank']-hazen_df['Rank'])>0) & ((hazen_df['HazenRank']-hazen_df['Rank'])<1)),hazen_df['CensorRank'],hazen_df['CensorRankContribution'])
-    hazen_df['NumericContribution'] = np.where((((hazen_df['HazenRank']-hazen_df['Rank'])>0) & ((hazen_df['HazenRank']-hazen_df['Rank'])<1)),(1-(hazen_df['HazenRank']-hazen_df['Rank']))*hazen_df[numeric_column_in],hazen_df['NumericContribution'])
-    # Define the contribution from the higher rank value
-    hazen_df['CensorRankContribution'] = np.where((((hazen_df['Rank']-hazen_df['HazenRank'])>0) & ((hazen_df['Rank']-hazen_df['HazenRank'])<1)),hazen_df['CensorRank'],hazen_df['CensorRankContribution'])
-    hazen_df['NumericContribution'] = np.where((((hazen_df['Rank']-hazen_df['HazenRank'])>0) & ((hazen_df['Rank']-hazen_df['HazenRank'])<1)),(1-(hazen_df['Rank']-hazen_df['HazenRank']))*hazen_df[numeric_column_in],hazen_df['NumericContribution'])
-    # Sum the contributing values to create the Hazen percentile
-    hazen_df = pd.merge(hazen_df,hazen_df.groupby(group_columns).sum(min_count=1)[['CensorRankContribution','NumericContribution']].rename(columns={'CensorRankContribution':'CensorRankOut','NumericContribution':numeric_column_out}),on=group_columns,how='outer')
-    # Return appropriate censor value based on censor rank or sum of censor ranks from contributing values
-    hazen_df[censor_column_out] = hazen_df['CensorRankOut'].map({200:'>',110:'>',101:'Error',100:'>',20:None,11:'<',10:None,2:'<',1:'<'})
-    # Drop extraneous columnes
-    hazen_df = hazen_df.drop(columns=['CensorRank','Rank','Samples','HazenRank','CensorRankContribution','NumericContribution','CensorRankOut'])
+    return hazen_df
+
+@profiled
+def reduce_to_monthly(df):
+    '''
+    Function to reduce DateTime sample results to monthly values, which is the
+    most frequent monitoring regime for most ECan programmes.
+    First take median of results taken on the same day (this ensures that duplicate
+    samples taken for NEMS are combined first and do not bias outputs). Then
+    take the median of all daily results to obtain a monthly result.
+    
+    Parameters
+    ----------
+    df : DataFrame
+        dataframe should include columns as output by stacked_data
+    
+    Returns
+    -------
+    Dataframe
+        With monthly results
+    '''
+    
+    # Determine the Month and day for each sample in the given hydro year.
+    # Note that due to the use of hydro years, a custom day of year value is
+    # used since leap years cause 1 july and 30 June to be the same day of the year.
+    df['Month'] = (df['DateTime'].dt.month + 6 - 1)%12 + 1
+    df['Day'] = (df['DateTime'].dt.month*31 + df['DateTime'].dt.day + 31*6 - 1)%(31*12) + 1
+    
+    # Obtain daily values by taking median of samples collected in a day
+    df = Hazen_percentile(df,50,['Site','HydroYear','Day'],'Censor','Numeric','DayCensor','DayNumeric')
+    # Drop unnecessary columns and duplicates
+    df = df.drop(columns=['DateTime','Observation','Censor','Numeric']).drop_duplicates()
+    
+    # Obtain monthly values by taking median of samples collected within a month
+    df = Hazen_percentile(df,50,['Site','HydroYear','Month'],'DayCensor','DayNumeric','MonthCensor','MonthNumeric')
+    # Drop unnecessary columns and duplicates
+    df = df.drop(columns=['Day','DayCensor','DayNumeric']).drop_duplicates()
+    # Sort by Site and hydroyear
+    df = df.sort_values(by=['Site','HydroYear'],ascending=True)
+    
+    return df
+
+@profiled
+def trend_format(df,frequency):
+    '''
+    Function to format monthly data into stacked dataframe with quarterly
+    and annual data frequency as well. Quarterly and annual values obtained by
+    taking median of monthly values within the quarter or year, respectively.
+    
+    Parameters
+    ----------
+    df : DataFrame
+        dataframe should include columns as output by reduced_to_monthly
+    frequency : list of str
+        sampling frequency upon which to calculate trends. Should be from
+        ['Annual','Quarterly','Monthly']
+    
+    Returns
+    -------
+    Dataframe
+        with values assigned to a frequency and an interval within each hydro year
+        at a site
+    '''
+    
+    # Indicate the quarter for each monthly value
+    df['Quarter'] = np.where(df['Month']>=10,2,
+                    np.where(df['Month']>=7,1,
+                    np.where(df['Month']>=4,4,3)))
+    # Obtain quarterly values by taking median of monthly values collected within a quarter
+    df = Hazen_percentile(df,50,['Site','HydroYear','Quarter'],'MonthCensor','MonthNumeric','QuarterCensor','QuarterNumeric')
+    # Set interval for annual data (always 1 since 1 year in each hydroyear)
+    df['Year'] = 1
+    # Obtain annual values by taking median of monthly values collected within a year
+    df = Hazen_percentile(df,50,['Site','HydroYear'],'MonthCensor','MonthNumeric','YearCensor','YearNumeric')
+    # Set index such that the interval number, censor, and numeric components can be stacked
+    df = df.set_index(['Site','Measurement','Units','HydroYear'])
+    # Check that the ordering is as such before replacing with multiindex
+    df = df[['Month','MonthCensor','MonthNumeric','Quarter','QuarterCensor','QuarterNumeric','Year','YearCensor','YearNumeric']]
+    # Create multiindex columns in prep for stacking
+    df.columns = pd.MultiIndex.from_tuples(list(zip(*[['Monthly']*3+['Quarterly']*3+['Annual']*3,['Interval','Censor','Numeric']*3])),names=['Frequency','Value'])
+    # Stack columns
+    df = df.stack(level=0)
+    # Reset index and remove duplicates
+    df = df.reset_index().drop_duplicates()
+    # Only keep desired sampling frequency results
+    df = df[df['Frequency'].isin(frequency)]
+    # Convert result to a string
+    df['Censor'] = df['Censor'].astype(np.int8)
+    df['Result'] = censor_results(df['Censor'],df['Numeric'])
+    # Sort by Site and hydroyear
+    df = df.sort_values(by=['Site','Frequency','HydroYear'],ascending=True)
+    
+    return df
+
+def suffix_count(keys):
+    '''
+    Function to count the number of equal keys at or after each position
+    
+    Parameters
+    ----------
+    keys : array of int
+        keys to count
+    
+    Returns
+    -------
+    array of int
+        number of equal keys from each position to the end of the keys
+    '''
+    
+    # Group equal keys with later positions first
+    order = np.lexsort((-np.arange(len(keys)),keys))
+    sorted_keys = keys[order]
+    first = np.r_[True,sorted_keys[1:] != sorted_keys[:-1]]
+    group_start = np.maximum.accumulate(np.where(first,np.arange(len(keys)),0))
+    # Count through each group of keys
+    counts = np.empty(len(keys),dtype=np.int64)
+    counts[order] = np.arange(len(keys)) - group_start + 1
+    
+    return counts
+
+def later_counts(keys,season):
+    '''
+    Function to count the later values in the same season that are smaller
+    and greater than each value. Values are counted merge sort style: at each
+    level, every value in the left half of a block is compared with the sorted
+    right half, for all blocks at once. This takes O(n log n) comparisons
+    rather than the O(n^2) comparisons of every pair of values.
+    
+    Parameters
+    ----------
+    keys : array of int
+        ranks of the values, equal ranks are ties
+    season : array of int
+        season of each value
+    
+    Returns
+    -------
+    tuple of arrays
+        number of later smaller and later greater values of each value
+    '''
+    
+    positions = np.arange(len(keys))
+    smaller = np.zeros(len(keys),dtype=np.int64)
+    greater = np.zeros(len(keys),dtype=np.int64)
+    if len(keys) == 0:
+        return smaller, greater
+    # Combine season and rank so that values are only compared within a season
+    ranks = int(keys.max())+1
+    values = season*ranks + keys
+    span = (int(season.max())+1)*ranks
+    width = 1
+    while width < len(keys):
+        block = positions // (2*width)
+        right = (positions // width) % 2 == 1
+        left = ~right
+        # Offset the right halves by block so they can be searched together
+        right_values = np.sort(block[right]*span + values[right])
+        left_values = block[left]*span + values[left]
+        season_start = block[left]*span + season[left]*ranks
+        lower = np.searchsorted(right_values,left_values,side='left')
+        upper = np.searchsorted(right_values,left_values,side='right')
+        smaller[left] += lower - np.searchsorted(right_values,season_start,side='left')
+        greater[left] += np.searchsorted(right_values,season_start+ranks,side='left') - upper
+        width *= 2
+    
+    return smaller, greater
+
+def slope_key(x,time,season,slope):
+    '''
+    Function to order values such that a later value sorts lower than an
+    earlier value when the slope between them is less than the given slope
+    
+    Parameters
+    ----------
+    x : array of float
+        values
+    time : array of int
+        time of each value
+    season : array of int
+        season of each value
+    slope : float
+        slope to compare pairs of values with, can be -np.inf or np.inf
+    
+    Returns
+    -------
+    array or None
+        sort key of each value, or None if values in the same season are too
+        close to be ordered reliably
+    '''
+    
+    # Infinite slopes order values by time
+    if np.isinf(slope):
+        return -np.sign(slope)*time
+    key = x - slope*time
+    # Check the gaps between the ordered values of each season
+    order = np.lexsort((key,season))
+    gaps = np.diff(key[order])
+    same_season = season[order][1:] == season[order][:-1]
+    if (same_season & (gaps <= 1e-9*(np.abs(x).max()+abs(slope)*time.max()+1))).any():
+        return None
+    
+    return key
+
+def bracket_slopes(x,time,season,lower_key,upper_key,limit):
+    '''
+    Function to list the slopes between the lower and upper slopes used to
+    generate the sort keys. Sorting values from the lower key to the upper key
+    swaps exactly the pairs of values with slopes between the two, so an
+    insertion sort lists them with one swap per slope.
+    
+    Parameters
+    ----------
+    x : array of float
+        values
+    time : array of int
+        time of each value
+    season : array of int
+        season of each value
+    lower_key : array
+        sort key of the lower slope as output by slope_key()
+    upper_key : array
+        sort key of the upper slope as output by slope_key()
+    limit : int
+        maximum number of slopes to list
+    
+    Returns
+    -------
+    list or None
+        slopes between the lower and upper slopes, or None if there are more
+        than the limit
+    '''
+    
+    slopes = []
+    upper_key = upper_key.tolist()
+    for value_season in np.unique(season):
+        members = np.flatnonzero(season==value_season)
+        ordered = members[np.argsort(lower_key[members])].tolist()
+        for k in range(1,len(ordered)):
+            value = ordered[k]
+            m = k
+            while m > 0 and upper_key[ordered[m-1]] > upper_key[value]:
+                other = ordered[m-1]
+                slopes.append((x[value]-x[other])/(time[value]-time[other]))
+                ordered[m] = other
+                m -= 1
+            ordered[m] = value
+            if len(slopes) > limit:
+                return None
+    
+    return slopes
+
+def sen_slope(x,time,season,attempts=3):
+    '''
+    Function to calculate Sen's slope of long series without calculating the
+    slope of every pair of values. Slopes of randomly sampled pairs bracket
+    the median slope, the number of slopes below each end of the bracket is
+    counted with later_counts(), and only the slopes within the bracket are
+    listed. If the bracket misses the median or values are too close to be
+    ordered reliably, the slope of every pair is used.
+    
+    Parameters
+    ----------
+    x : array of float
+        values without missing values
+    time : array of int
+        time of each value
+    season : array of int
+        season of each value. Only pairs of values in the same season are used
+    attempts : int
+        number of random brackets to try before using every pair
+    
+    Returns
+    -------
+    float
+        median slope of pairs of values in the same season
+    '''
+    
+    # Determine the ranks of the median slope (the same rank if odd)
+    seasons = np.bincount(season)
+    pairs = int((seasons*(seasons-1)//2).sum())
+    if pairs == 0:
+        return np.nan
+    median_ranks = [(pairs-1)//2,pairs//2]
+    # Use a seeded generator so results are repeatable
+    rng = np.random.default_rng(len(x))
+    samples = min(pairs,20*len(x))
+    margin = 2*np.sqrt(samples)
+    gap_search = max(1,int(margin/4))
+    limit = max(1000,int(8*pairs/np.sqrt(samples)))
+    for attempt in range(attempts):
+        # Sample slopes of pairs of values in the same season
+        first, second = rng.integers(0,len(x),(2,samples*len(seasons)))
+        keep = (season[first]==season[second]) & (first!=second)
+        sample = np.sort((x[second[keep]]-x[first[keep]])/(time[second[keep]]-time[first[keep]]))
+        if len(sample) == 0:
+            continue
+        # Set bracket ends in the widest gap between sampled slopes near the
+        # median ranks, so they are not close to the slope of any pair
+        ends = []
+        for index in [int(np.floor(median_ranks[0]/pairs*len(sample) - margin)),int(np.ceil((median_ranks[1]+1)/pairs*len(sample) + margin))]:
+            nearby = sample[max(index-gap_search,0):index+gap_search+1]
+            gaps = np.diff(nearby)
+            if (index < 0) or (index >= len(sample)) or (len(gaps) == 0) or (gaps.max() == 0):
+                ends.append(np.nan)
+            else:
+                ends.append(nearby[gaps.argmax()] + gaps.max()*0.41421356)
+        lower = -np.inf if np.isnan(ends[0]) else ends[0]
+        upper = np.inf if np.isnan(ends[1]) else ends[1]
+        lower_key = slope_key(x,time,season,lower)
+        upper_key = slope_key(x,time,season,upper)
+        if (lower_key is None) or (upper_key is None):
+            continue
+        # Count the slopes below each end of the bracket
+        below_lower = 0 if lower == -np.inf else int(later_counts(np.unique(lower_key,return_inverse=True)[1],season)[0].sum())
+        below_upper = pairs if upper == np.inf else int(later_counts(np.unique(upper_key,return_inverse=True)[1],season)[0].sum())
+        if (below_lower > median_ranks[0]) or (below_upper <= median_ranks[1]):
+            continue
+        slopes = bracket_slopes(x,time,season,lower_key,upper_key,limit)
+        if (slopes is None) or (len(slopes) != below_upper-below_lower):
+            continue
+        slopes.sort()
+        return (slopes[median_ranks[0]-below_lower]+slopes[median_ranks[1]-below_lower])/2
+    # Otherwise calculate the slope of every pair of values
+    first, second = np.triu_indices(len(x),1)
+    keep = season[first] == season[second]
     
-    return hazen_df
+    return np.median((x[second[keep]]-x[first[keep]])/(time[second[keep]]-time[first[keep]]))
 
-def reduce_to_monthly(df):
+def mann_kendall(x,starts,period=1,long_series=240):
     '''
-    Function to reduce DateTime sample results to monthly values, which is the
-    most frequent monitoring regime for most ECan programmes.
-    First take median of results taken on the same day (this ensures that duplicate
-    samples taken for NEMS are combined first and do not bias outputs). Then
-    take the median of all daily results to obtain a monthly result.
+    Function to run the Mann-Kendall test and Sen's slope estimate on nested
+    trend periods that end with the same value. The pairwise comparisons of
+    the longest trend period are made once and each trend period sums the
+    comparisons from its start position. Results match pymannkendall
+    original_test (period of 1) and seasonal_test.
     
     Parameters
     ----------
-    df : DataFrame
-        dataframe should include columns as output by stacked_data
+    x : array of float
+        values of the longest trend period, np.nan for intervals without data
+    starts : list of int
+        position of the first value of each trend period
+    period : int
+        number of seasons for the seasonal test, 1 for the non-seasonal test
+    long_series : int
+        series with more values than this for each trend period calculate S by
+        later_counts() and each slope by sen_slope(), rather than comparing
+        every pair of values once for all trend periods
     
     Returns
     -------
-    Dataframe
-        With monthly results
+    list of arrays
+        p-value, z-score, Tau, S, variance of S, slope, and intercept of each
+        trend period
     '''
     
-    # Determine the Month and day for each sample in the given hydro year.
-    # Note that due to the use of hydro years, a custom day of year value is
-    # used since leap years cause 1 july and 30 June to be the same day of the year.
-    df['Month'] = (df['DateTime'].dt.month + 6 - 1)%12 + 1
-    df['Day'] = (df['DateTime'].dt.month*31 + df['DateTime'].dt.day + 31*6 - 1)%(31*12) + 1
+    x = np.asarray(x,dtype=float)
+    starts = np.asarray(starts,dtype=int)
+    positions = np.arange(len(x))
+    valid = ~np.isnan(x)
+    # Values are only compared with later values in the same season. Time
+    # between values is counted in intervals, or in years for seasonal tests
+    season = positions % period
+    time = positions // period
     
-    # Obtain daily values by taking median of samples collected in a day
-    df = Hazen_percentile(df,50,['Site','HydroYear','Day'],'Censor','Numeric','DayCensor','DayNumeric')
-    # Drop unnecessary columns and duplicates
-    df = df.drop(columns=['DateTime','Observation','Censor','Numeric']).drop_duplicates()
+    # Each value adds its comparisons with later values to the S of every
+    # trend period that includes it
+    values, value_rank = np.unique(x[valid],return_inverse=True)
+    fast = len(x) > long_series*len(starts)
+    if fast:
+        smaller, greater = later_counts(value_rank,season[valid])
+        sign = np.zeros(len(x))
+        sign[valid] = greater - smaller
+    else:
+        pairs = (positions[:,None] < positions[None,:]) & (season[:,None] == season[None,:])
+        sign = np.where(pairs,np.nan_to_num(np.sign(x[None,:]-x[:,None])),0).sum(axis=1)
+    s = np.cumsum(sign[::-1])[::-1][starts]
+    # Count later values in the same season, and later values in the same season
+    # with the same value. The variance of S and Tau denominator of a trend
+    # period are sums over the values it includes
+    later = suffix_count(season[valid])
+    later_ties = suffix_count(season[valid]*len(values)+value_rank)
+    f = lambda t: t*(t-1)*(2*t+5)
+    variance = np.zeros(len(x))
+    variance[valid] = (f(later)-f(later-1)) - (f(later_ties)-f(later_ties-1))
+    var_s = np.cumsum(variance[::-1])[::-1][starts]/18
+    denominator = np.zeros(len(x))
+    denominator[valid] = later-1
+    denominator = np.cumsum(denominator[::-1])[::-1][starts]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        Tau = s/denominator
+        z = np.where(s>0,(s-1)/np.sqrt(var_s),np.where(s<0,(s+1)/np.sqrt(var_s),0))
+    p = 2*(1-stats.norm.cdf(np.abs(z)))
     
-    # Obtain monthly values by taking median of samples collected within a month
-    df = Hazen_percentile(df,50,['Site','HydroYear','Month'],'DayCensor','DayNumeric','MonthCensor','MonthNumeric')
-    # Drop unnecessary columns and duplicates
-    df = df.drop(columns=['Day','DayCensor','DayNumeric']).drop_duplicates()
-    # Sort by Site and hydroyear
-    df = df.sort_values(by=['Site','HydroYear'],ascending=True)
+    slope = np.full(len(starts),np.nan)
+    intercept = np.full(len(starts),np.nan)
+    if not fast:
+        # Sort the slopes between all pairs of values once. Each trend period's
+        # slope is the median of the slopes of the pairs starting in the period
+        first, second = np.nonzero(pairs & valid[:,None] & valid[None,:])
+        slopes = (x[second]-x[first])/(time[second]-time[first])
+        order = np.argsort(slopes,kind='stable')
+        slopes, first = slopes[order], first[order]
+    for i, start in enumerate(starts):
+        if fast:
+            slope[i] = sen_slope(x[start:][valid[start:]],time[start:][valid[start:]],season[start:][valid[start:]])
+        else:
+            period_slopes = slopes[first>=start]
+            count = len(period_slopes)
+            if count == 0:
+                continue
+            elif count % 2 == 1:
+                slope[i] = period_slopes[count//2]
+            else:
+                slope[i] = (period_slopes[count//2-1]+period_slopes[count//2])/2
+        if np.isnan(slope[i]):
+            continue
+        # Intercept of the trend line at the start of the trend period
+        intercept[i] = np.median(x[start:][valid[start:]]) - np.median(positions[start:][valid[start:]]-start)/period*slope[i]
     
-    return df
+    return [p,z,Tau,s,var_s,slope,intercept]
 
-def trend_format(df,frequency):
+def trend_grid(years,intervals,censor,numeric,year,trend_period,periods,max_DL,min_QL):
     '''
-    Function to format monthly data into stacked dataframe with quarterly
-    and annual data frequency as well. Quarterly and annual values obtained by
-    taking median of monthly values within the quarter or year, respectively.
+    Function to convert censored values and set the values of a trend period
+    into a grid of hydro years and intervals
     
     Parameters
     ----------
-    df : DataFrame
-        dataframe should include columns as output by reduced_to_monthly
-    frequency : list of str
-        sampling frequency upon which to calculate trends. Should be from
-        ['Annual','Quarterly','Monthly']
+    years : array
+        hydro year of each value in the trend period
+    intervals : array
+        interval of each value within the hydro year
+    censor : array
+        censor code of each value as output by censor_codes()
+    numeric : array
+        numeric component of each value
+    year : int
+        final hydro year of the trend period
+    trend_period : int
+        number of hydro years in the trend period
+    periods : int
+        number of intervals in a hydro year
+    max_DL : float
+        maximum detection limit, np.nan if there are no values below detection
+    min_QL : float
+        minimum quantification limit, np.nan if there are no values above quantification
     
     Returns
     -------
-    Dataframe
-        with values assigned to a frequency and an interval within each hydro year
-        at a site
+    array
+        values with hydro years as rows and intervals as columns
     '''
     
-    # Indicate the quarter for each monthly value
-    df['Quarter'] = np.where(df['Month']>=10,2,
-                    np.where(df['Month']>=7,1,
-                    np.where(df['Month']>=4,4,3)))
-    # Obtain quarterly values by taking median of monthly values collected within a quarter
-    df = Hazen_percentile(df,50,['Site','HydroYear','Quarter'],'MonthCensor','MonthNumeric','QuarterCensor','QuarterNumeric')
-    # Set interval for annual data (always 1 since 1 year in each hydroyear)
-    df['Year'] = 1
-    # Obtain annual values by taking median of monthly values collected within a year
-    df = Hazen_percentile(df,50,['Site','HydroYear'],'MonthCensor','MonthNumeric','YearCensor','YearNumeric')
-    # Set index such that the interval number, censor, and numeric components can be stacked
-    df = df.set_index(['Site','Measurement','Units','HydroYear'])
-    # Check that the ordering is as such before replacing with multiindex
-    df = df[['Month','MonthCensor','MonthNumeric','Quarter','QuarterCensor','QuarterNumeric','Year','YearCensor','YearNumeric']]
-    # Create multiindex columns in prep for stacking
-    df.columns = pd.MultiIndex.from_tuples(list(zip(*[['Monthly']*3+['Quarterly']*3+['Annual']*3,['Interval','Censor','Numeric']*3])),names=['Frequency','Value'])
-    # Stack columns
-    df = df.stack(level=0)
-    # Reset index and remove duplicates
-    df = df.reset_index().drop_duplicates()
-    # Only keep desired sampling frequency results
-    df = df[df['Frequency'].isin(frequency)]
-    # Convert result to a string
-    df['Result'] = df['Censor'].fillna('')+df['Numeric'].astype(str)
-    # Sort by Site and hydroyear
-    df = df.sort_values(by=['Site','Frequency','HydroYear'],ascending=True)
+    # Convert data below the maximum detection limit
+    if ~np.isnan(max_DL):
+        numeric = np.where((censor==-1)|(numeric<max_DL),0.5*max_DL,numeric)
+    # Convert data above the minimum quantification limit
+    if ~np.isnan(min_QL):
+        numeric = np.where((censor==1)|(numeric>min_QL),1.1*min_QL,numeric)
+    # Set each hydroyear and interval to have a value (np.nan for intervals without data)
+    # Reverse assignment order so the first value of repeated intervals is kept
+    trend_data = np.full((trend_period,periods),np.nan)
+    trend_data[(years-(year-trend_period+1))[::-1],(intervals.astype(int)-1)[::-1]] = numeric[::-1]
     
-    return df
+    return trend_data
 
-def trends(df,trend_periods=[5,10,15,20],final_year=[2021],requirement=0.80):
+def trend_result(site,year,frequency,periods,window,MK):
     '''
-    Function to calculate trend analyses on a dataset. Can only handle
-    Monthly, Quarterly, and Annual sampling frequency
+    Function to convert Mann-Kendall results into a trend results row
     
     Parameters
     ----------
-    df : DataFrame
-        dataframe should include columns as output by trends_format()
+    site : str
+        site name
+    year : int
+        final hydro year of the trend period
+    frequency : str
+        Monthly, Quarterly, or Annual
+    periods : int
+        number of intervals in a hydro year
+    window : list
+        trend length, intervals, detection limit, quantification limit,
+        seasonal test p-value, and seasonality of the trend period
+    MK : list
+        p-value, z-score, Tau, S, variance of S, slope, and intercept as
+        output by mann_kendall()
+    
+    Returns
+    -------
+    list
+        trend results row
+    '''
+    
+    trend_period, count, max_DL, min_QL, KWp, seasonality = window
+    p, z, Tau, s, var_s, slope, intercept = MK
+    # Set the trend line start data as the middle of first interval
+    if frequency == 'Monthly':
+        StartDate = pd.to_datetime(str(year-trend_period)+'0715')
+    elif frequency == 'Quarterly':
+        StartDate = pd.to_datetime(str(year-trend_period)+'0815')
+    elif frequency == 'Annual':
+        StartDate = pd.to_datetime(str(year-trend_period+1)+'0101')
+    # If non-seasonal test used, multiply slope result by number of intervals within a year
+    if seasonality == 'Seasonal':
+        TheilSlope = slope
+    else:
+        TheilSlope = slope*periods
+    # Convert Mann-Kendall analysis results to a liklihood that the trend is decreasing
+    if s <= 0:
+        Likelihood = 1 - 0.5*p
+    elif s > 0:
+        Likelihood = 0.5*p
+    # Convert the likelihood of a decreasing trend to a trend category
+    if Likelihood >= 0.90:
+        TrendResult = 'Very Likely Decreasing'
+    elif Likelihood >= 0.67:
+        TrendResult = 'Likely Decreasing'
+    elif Likelihood > 0.33:
+        TrendResult = 'Indeterminate'
+    elif Likelihood > 0.10:
+        TrendResult = 'Likely Increasing'
+    elif Likelihood >= 0.0:
+        TrendResult = 'Very Likely Increasing'
+    # Report relevant data into a list
+    return [site,year,trend_period,frequency,count,max_DL,min_QL,KWp,seasonality,p,z,Tau,s,var_s,Likelihood,TrendResult,StartDate,intercept,TheilSlope,pd.to_datetime('2035'),intercept+TheilSlope*(pd.to_datetime('2035')-StartDate).days/365.25]
+
+def site_trends(site_df,trend_periods,final_year,requirement,year_max):
+    '''
+    Function to calculate trend analyses for a single site. Data for each
+    frequency is sorted once and every trend period is a slice of the
+    sorted data. Trend periods ending in the same year are nested, so their
+    Mann-Kendall tests are run together by mann_kendall(). Defined at module
+    level so that sites can be sent to separate processes by trends().
+    
+    Parameters
+    ----------
+    site_df : DataFrame
+        data of a single site with columns as output by trends_format()
     trend_periods : list of int
         List of trend periods to calculate for
     final_year : list of int
         List of hydroyears to calculate trend results for
     requirements : float
         Percentage of expected intervals represented by values in the trend period
+    year_max : int
+        maximum hydro year. No trend results are calculated past this year
     
     Returns
     -------
-    Dataframe
-        with trends results output and an estimated value for 2035 utilising slope and intercept
+    list
+        list of trend results rows
     '''
     
-    # Set maximum hydro year. No trend results should be calculated for years past this
-    year_max = df['HydroYear'].max()
+    site = site_df['Site'].iloc[0]
+    site_years = site_df['HydroYear'].unique()
+    # Determine the trend years of each trend length. Note that the final year should never be greater than the current hydroyear
+    # and should not be considered if there has been no data collected from the site in the desired trend period
+    period_years = {trend_period:set(final_year).intersection(set([x+i for i in range(trend_period) for x in site_years if x+i<=year_max])) for trend_period in trend_periods}
     # Create empty list to append results
     TrendResults = []
-    # Cycle through sites
-    for site in df['Site'].unique():
-        # Reduce dataset to be specfic to the chosern site
-        site_data = df[df['Site']==site]
-        # Cycle through the desired trend lengths
-        for trend_period in trend_periods:
-            # Cycle through the desired trend year. Note that the final year should never be greater than the current hydroyear
-            # and should not be considered if there has been no data collected from the site in the desired trend period
-            for year in set(final_year).intersection(set([x+i for i in range(trend_period) for x in site_data['HydroYear'].unique() if x+i<=year_max])):
-                # Cycle through the different sampling frequencies that exist in the trend data
-                for frequency in site_data.Frequency.unique():
-                    # Only consider data with the chosen frequency and within the trend period
-                    trend_data = site_data[(site_data['Frequency']==frequency)&(site_data['HydroYear']<=year)&(site_data['HydroYear']>(year-trend_period))][['HydroYear','Interval','Censor','Numeric']].copy()
-                    # Count the number of intervals that are represented by data
-                    count = len(trend_data)
-                    # Determine if there is enough data to run the trend analysis
-                    if (frequency == 'Monthly') & (count/(12*trend_period) < requirement):
-                        continue
-                    elif (frequency == 'Quarterly') & (count/(4*trend_period) < requirement):
-                        continue
-                    elif (frequency == 'Annual') & (count/trend_period < requirement):
-                        continue
-                    # If requirements are loose enough, ensure no trends are run if count is 2  or less
-                    if count <= 2:
-                        continue
-                    # Determine maximum detection limit and minimum quantification limit in the data
-                    max_DL = trend_data[trend_data['Censor']=='<']['Numeric'].max()
-                    min_QL = trend_data[trend_data['Censor']=='>']['Numeric'].min()
-                    # Convert data below the maximum detection limit
-                    if ~np.isnan(max_DL):
-                        trend_data['Numeric'] = np.where((trend_data['Censor']=='<')|(trend_data['Numeric']<max_DL),0.5*max_DL,trend_data['Numeric'])
-                    # Convert data above the minimum quantification limit
-                    if ~np.isnan(min_QL):
-                        trend_data['Numeric'] = np.where((trend_data['Censor']=='>')|(trend_data['Numeric']>min_QL),1.1*min_QL,trend_data['Numeric'])
-                    # Make the HydroYear categorical
-                    trend_data.HydroYear = pd.Categorical(trend_data.HydroYear,categories=[(year-trend_period+1)+i for i in range(trend_period)])
-                    # Make the Interval column categorical and set the trend line start data as the middle of first interval
-                    if frequency == 'Monthly':
-                        StartDate = pd.to_datetime(str(year-trend_period)+'0715')
-                        trend_data.Interval = pd.Categorical(trend_data.Interval,categories=[i+1 for i in range(12)])
-                    elif frequency == 'Quarterly':
-                        StartDate = pd.to_datetime(str(year-trend_period)+'0815')
-                        trend_data.Interval = pd.Categorical(trend_data.Interval,categories=[i+1 for i in range(4)])
-                    elif frequency == 'Annual':
-                        StartDate = pd.to_datetime(str(year-trend_period+1)+'0101')
-                    # Set each hydroyear and interval to have a value (np.nan for intervals without data)
-                    trend_data = trend_data.groupby(['HydroYear','Interval'])['Numeric'].first()
+    # Cycle through the different sampling frequencies that exist in the trend data
+    for frequency in site_df['Frequency'].unique():
+        # Sort data by hydro year once
+        freq_df = site_df[site_df['Frequency']==frequency].sort_values(by=['HydroYear'],kind='stable')
+        years, intervals, censor, numeric = [freq_df[column].to_numpy() for column in ['HydroYear','Interval','Censor','Numeric']]
+        censor = censor_codes(censor)
+        periods = {'Monthly':12,'Quarterly':4,'Annual':1}[frequency]
+        # Cycle through the desired trend years
+        for year in set().union(*period_years.values()):
+            # Group the trend lengths by the limits used to convert censored data
+            limit_groups = {}
+            for trend_period in trend_periods:
+                if year not in period_years[trend_period]:
+                    continue
+                # Only consider data within the trend period
+                window = slice(np.searchsorted(years,year-trend_period,side='right'),np.searchsorted(years,year,side='right'))
+                # Count the number of intervals that are represented by data
+                count = window.stop-window.start
+                # Determine if there is enough data to run the trend analysis
+                if count/(periods*trend_period) < requirement:
+                    continue
+                # If requirements are loose enough, ensure no trends are run if count is 2  or less
+                if count <= 2:
+                    continue
+                # Determine maximum detection limit and minimum quantification limit in the data
+                max_DL = numeric[window][censor[window]==-1].max() if (censor[window]==-1).any() else np.nan
+                min_QL = numeric[window][censor[window]==1].min() if (censor[window]==1).any() else np.nan
+                limit_groups.setdefault((str(max_DL),str(min_QL)),[]).append([trend_period,count,max_DL,min_QL])
+            for windows in limit_groups.values():
+                # Shorter trend lengths are the final hydro years of the longest trend length
+                longest = max([window[0] for window in windows])
+                window = slice(np.searchsorted(years,year-longest,side='right'),np.searchsorted(years,year,side='right'))
+                trend_data = trend_grid(years[window],intervals[window],censor[window],numeric[window],year,longest,periods,windows[0][2],windows[0][3])
+                for window in windows:
                     # If annual frequency, don't run seasonal test
                     if frequency == 'Annual':
                         KWp = np.nan
                     else:
                         # See if data frequency allows for seasonality test
                         try:
-                            if frequency == 'Monthly':
-                                KW = stats.kruskal(*[trend_data.loc[:,month].tolist() for month in range(1,13)],nan_policy='omit')
-                            elif frequency == 'Quarterly':
-                                KW = stats.kruskal(*[trend_data.loc[:,quarter].tolist() for quarter in range(1,5)],nan_policy='omit')
+                            KW = stats.kruskal(*trend_data[longest-window[0]:].T.tolist(),nan_policy='omit')
                             KWp = KW.pvalue
                         # Otherwise run test as non-seasonal
                         except ValueError:
@@ -469,50 +2032,66 @@ def trends(df,trend_periods=[5,10,15,20],final_year=[2021],requirement=0.80):
                         seasonality = 'Seasonal'
                     else:
                         seasonality = 'Non-seasonal'
-                    # Use seasonality to determine which Mann-Kendall test to perform
-                    if seasonality == 'Seasonal':
-                        if frequency == 'Monthly':
-                            MK = mk.seasonal_test(trend_data,period=12)
-                        elif frequency == 'Quarterly':
-                            MK = mk.seasonal_test(trend_data,period=4)
-                        TheilSlope = MK.slope
-                    else:
-                        MK = mk.original_test(trend_data)
-                        # If non-seasonal test used, multiply slope result by number of intervals within a year
-                        if frequency == 'Monthly':
-                            TheilSlope = MK.slope*12
-                        elif frequency == 'Quarterly':
-                            TheilSlope = MK.slope*4
-                        elif frequency == 'Annual':
-                            TheilSlope = MK.slope
-                    # Convert Mann-Kendall analysis results to a liklihood that the trend is decreasing
-                    if MK.s <= 0:
-                        Likelihood = 1 - 0.5*MK.p
-                    elif MK.s > 0:
-                        Likelihood = 0.5*MK.p
-                    # Convert the likelihood of a decreasing trend to a trend category
-                    if Likelihood >= 0.90:
-                        TrendResult = 'Very Likely Decreasing'
-                    elif Likelihood >= 0.67:
-                        TrendResult = 'Likely Decreasing'
-                    elif Likelihood > 0.33:
-                        TrendResult = 'Indeterminate'
-                    elif Likelihood > 0.10:
-                        TrendResult = 'Likely Increasing'
-                    elif Likelihood >= 0.0:
-                        TrendResult = 'Very Likely Increasing'
-                    # Report relevant data into a list and append to trend results list
-                    row_data = [site,year,trend_period,frequency,count,max_DL,min_QL,KWp,seasonality,MK.p,MK.z,MK.Tau,MK.s,MK.var_s,Likelihood,TrendResult,StartDate,MK.intercept,TheilSlope,pd.to_datetime('2035'),MK.intercept+TheilSlope*(pd.to_datetime('2035')-StartDate).days/365.25]
-                    TrendResults.append(row_data)
+                    window += [KWp,seasonality]
+                # Use seasonality to determine which Mann-Kendall test to perform
+                for seasonal in [False,True]:
+                    selected = [window for window in windows if (window[5]=='Seasonal')==seasonal]
+                    if len(selected) == 0:
+                        continue
+                    MK = mann_kendall(trend_data.ravel(),[(longest-window[0])*periods for window in selected],periods if seasonal else 1)
+                    for window, result in zip(selected,zip(*MK)):
+                        TrendResults.append(trend_result(site,year,frequency,periods,window,result))
+    
+    return TrendResults
+
+@profiled
+def trends(df,trend_periods=[5,10,15,20],final_year=[2021],requirement=0.80,workers=1):
+    '''
+    Function to calculate trend analyses on a dataset. Can only handle
+    Monthly, Quarterly, and Annual sampling frequency
+    
+    Parameters
+    ----------
+    df : DataFrame
+        dataframe should include columns as output by trends_format()
+    trend_periods : list of int
+        List of trend periods to calculate for
+    final_year : list of int
+        List of hydroyears to calculate trend results for
+    requirements : float
+        Percentage of expected intervals represented by values in the trend period
+    workers : int
+        number of processes to calculate sites in. Scripts using more than 1
+        worker must be run from within an if __name__ == '__main__': block on
+        Windows
+    
+    Returns
+    -------
+    Dataframe
+        with trends results output and an estimated value for 2035 utilising slope and intercept
+    '''
+    
+    # Set maximum hydro year. No trend results should be calculated for years past this
+    year_max = df['HydroYear'].max()
+    # Split data by site, keeping only the columns needed for the trend analyses
+    site_dfs = [site_df for site,site_df in df[['Site','HydroYear','Frequency','Interval','Censor','Numeric']].groupby('Site',sort=False,observed=True)]
+    # Cycle through sites
+    if workers > 1:
+        # Sites are sent to the processes in chunks to limit communication overhead
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            site_results = list(executor.map(site_trends,site_dfs,repeat(trend_periods),repeat(final_year),repeat(requirement),repeat(year_max),
+                                             chunksize=max(1,len(site_dfs)//(4*workers))))
+    else:
+        site_results = [site_trends(site_df,trend_periods,final_year,requirement,year_max) for site_df in site_dfs]
     # Create DataFrame from results
+    TrendResults = [row_data for site_result in site_results for row_data in site_result]
     Results_df = pd.DataFrame(TrendResults,columns=['Site','HydroYear','TrendLength','DataFrequency','Intervals','MaxDetectionLimit','MinQuantLimit','Seasonal_pvalue','Seasonality','MK_pvalue','MK_Zscore','MK_Tau','MK_S','MK_VarS','DecreasingLikelihood','TrendCategory','TrendLineStartDate','TrendLineStartValue','Slope','TrendLineEndDate','TrendLineEndValue'])
     # Sort values by hydroyear, site, trend length, and data frequency
     Results_df = Results_df.sort_values(by=['HydroYear','Site','TrendLength','DataFrequency'],ascending=True)
     
     return Results_df
 
-
-
+@profiled
 def annual_max(df):
     '''
     Function to obtain the annual maximum for each site and hydroyear.
@@ -531,7 +2110,7 @@ def annual_max(df):
     # Sort values from largest to smallest using censor and numeric components
     max_df = sort_censors(df,'Censor','Numeric',ascending=False)
     # Count number of samples collected in Hydroyear
-    max_df = pd.merge(max_df,max_df.groupby(['Site','HydroYear']).size().rename('SamplesOrIntervals'),on=['Site','HydroYear'],how='outer')
+    max_df = pd.merge(max_df,max_df.groupby(['Site','HydroYear'],observed=True).size().rename('SamplesOrIntervals'),on=['Site','HydroYear'],how='outer')
     # Keep maximum value for each hydro year
     max_df = max_df.drop_duplicates(subset=['Site','HydroYear'],keep='first')
     # Rename Observation column to be Result column and drop DateTime
@@ -541,6 +2120,7 @@ def annual_max(df):
     
     return max_df
 
+@profiled
 def annual_percentile(df,percentile):
     '''
     Function to obtain the percentile for each site and hydroyear from monthly data.
@@ -561,7 +2141,7 @@ def annual_percentile(df,percentile):
     # Obtain annual values by taking median of monthly values collected within a year
     df = Hazen_percentile(df,percentile,['Site','HydroYear'],'MonthCensor','MonthNumeric','AnnualCensor','AnnualNumeric')
     # Count the number of months represented by the data
-    df = pd.merge(df,df.groupby(['Site','HydroYear']).size().rename('Months'),on=['Site','HydroYear'],how='outer')
+    df = pd.merge(df,df.groupby(['Site','HydroYear'],observed=True).size().rename('Months'),on=['Site','HydroYear'],how='outer')
     # Drop rows that don't meet the Hazen percentile requirements (result=nan)
     df = df.dropna(subset=['AnnualNumeric'])
     # Drop unneeded columns
@@ -573,6 +2153,7 @@ def annual_percentile(df,percentile):
     
     return df
 
+@profiled
 def multiyear_percentile(df,percentile,years,frequency,requirements):
     '''
     Function to obtain the percentile for each site and hydroyear from monthly data.
@@ -603,67 +2184,125 @@ def multiyear_percentile(df,percentile,years,frequency,requirements):
     df['Quarter'] = np.where(df['Month']>=10,2,
                                np.where(df['Month']>=7,1,
                             np.where(df['Month']>=4,4,3)))
-    # Every hydro year of data is used in the next 'years' hydroyears for the multiyear percentile
-    # Create column to indicate which years should be included in a given hydroyear's indicator result
-    df['IndicatorYear'] = df['HydroYear']
-    tempdata = df.copy()
-    # Repeat rows years-1 times and add 1,2,3... to IndicatorYear column
-    for i in range(years-1):
-        tempdata['IndicatorYear'] += 1
-        df = df.append(tempdata,ignore_index=True)
-    # Drop rows where IndicatorYear is larger than the largest HydroYear
-    df = df[df['IndicatorYear']<=df['HydroYear'].max()]
-    # Obtain quarterly values by taking median of monthly values collected within a quarter
-    df = Hazen_percentile(df,50,['Site','HydroYear','Quarter'],'MonthCensor','MonthNumeric','QuarterCensor','QuarterNumeric')
-    # Obtain semi-annual values by taking median of monthly values collected within a half year
-    df = Hazen_percentile(df,50,['Site','HydroYear','Semester'],'MonthCensor','MonthNumeric','SemesterCensor','SemesterNumeric')
-    # Obtain annual values by taking median of monthly values collected within a year
-    df = Hazen_percentile(df,50,['Site','HydroYear'],'MonthCensor','MonthNumeric','AnnualCensor','AnnualNumeric')
-    
-    # Count months and calculate the multiyear percentile based on monthly values
-    df = pd.merge(df,df.groupby(['Site','IndicatorYear']).size().rename('Months'),on=['Site','IndicatorYear'],how='outer')
-    df = Hazen_percentile(df,percentile,['Site','IndicatorYear'],'MonthCensor','MonthNumeric','MonthsCensor','MonthsNumeric')
-    df = df.drop(columns=['Month','MonthCensor','MonthNumeric']).drop_duplicates()
-    # Count quarters and calculate the 5-year median based on quarterly values
-    df = pd.merge(df,df.groupby(['Site','IndicatorYear']).size().rename('Quarters'),on=['Site','IndicatorYear'],how='outer')
-    df = Hazen_percentile(df,percentile,['Site','IndicatorYear'],'QuarterCensor','QuarterNumeric','QuartersCensor','QuartersNumeric')
-    df = df.drop(columns=['Quarter','QuarterCensor','QuarterNumeric']).drop_duplicates()
-    # Count semesters and calculate the 5-year median based on semi-annual values
-    df = pd.merge(df,df.groupby(['Site','IndicatorYear']).size().rename('Semesters'),on=['Site','IndicatorYear'],how='outer')
-    df = Hazen_percentile(df,percentile,['Site','IndicatorYear'],'SemesterCensor','SemesterNumeric','SemestersCensor','SemestersNumeric')
-    df = df.drop(columns=['Semester','SemesterCensor','SemesterNumeric']).drop_duplicates()
-    # Count years and calculate the 5-year median based on annual values
-    df = pd.merge(df,df.groupby(['Site','IndicatorYear']).size().rename('Years'),on=['Site','IndicatorYear'],how='outer')
-    df = Hazen_percentile(df,percentile,['Site','IndicatorYear'],'AnnualCensor','AnnualNumeric','YearsCensor','YearsNumeric')
-    df = df.drop(columns=['HydroYear','AnnualCensor','AnnualNumeric']).drop_duplicates().rename(columns={'IndicatorYear':'HydroYear'})
-    
-    # Use months, quarters, semesters, and years to determine sampling frequency
-    # that will be used in the percentile calculation by comparing to required
-    # data thresholds. Ordered to generate finest scale frequency when reqs met
-    
-    # Set base frequency to None
-    df['Frequency'] = None
-    for freq in [['Annual','Years'],['Semi-annual','Semesters'],['Quarterly','Quarters'],['Monthly','Months']]:
+    # Obtain quarterly, semi-annual, and annual values by taking the median of
+    # monthly values collected within each quarter, half year, and year
+    levels = []
+    for freq in [['Annual',['Site','HydroYear']],['Semi-annual',['Site','HydroYear','Semester']],['Quarterly',['Site','HydroYear','Quarter']]]:
         if freq[0] in frequency:
-            df['Frequency'] = np.where(df[freq[1]] >= requirements[frequency.index(freq[0])],freq[0],df['Frequency'])
-    # Choose the appropriately calculated median based on the sampling frequency
-    df[['Censor','Numeric','SamplesOrIntervals']] = \
-        np.where(np.transpose(np.asarray([df['Frequency'] == 'Monthly']*3)),
-                 df[['MonthsCensor','MonthsNumeric','Months']],
-        np.where(np.transpose(np.asarray([df['Frequency'] == 'Quarterly']*3)),
-                 df[['QuartersCensor','QuartersNumeric','Quarters']],
-        np.where(np.transpose(np.asarray([df['Frequency'] == 'Semi-annual']*3)),
-                 df[['SemestersCensor','SemestersNumeric','Semesters']],
-        np.where(np.transpose(np.asarray([df['Frequency'] == 'Annual']*3)),
-                 df[['YearsCensor','YearsNumeric','Years']],
-                 [None,np.nan,np.nan]))))
-    # Drop unnecessary columns and years that don't have enough data for calculation from annual data
-    df = df.drop(columns=['MonthsCensor','MonthsNumeric','Months','QuartersCensor','QuartersNumeric','Quarters','SemestersCensor','SemestersNumeric','Semesters','YearsCensor','YearsNumeric','Years',]).dropna(subset=['Frequency'])
+            levels.append([freq[0],hazen_groups(df,50,freq[1],'MonthCensor','MonthNumeric','Censor','Numeric')])
+    if 'Monthly' in frequency:
+        levels.append(['Monthly',df.rename(columns={'MonthCensor':'Censor','MonthNumeric':'Numeric'})])
+    # Rows of each site at every level of aggregation
+    site_rows = [level_df.groupby('Site',sort=False,observed=True).indices for freq,level_df in levels]
+    
+    # Every hydro year of data is used in the next 'years' hydroyears for the
+    # multiyear percentile. Each site's values are sorted once and the
+    # percentile of each indicator year is taken over a rolling window
+    max_year = df['HydroYear'].max()
+    site_list = []
+    for site, rows in df.groupby('Site',sort=False,observed=True).indices.items():
+        indicator_years = np.unique(df['HydroYear'].to_numpy()[rows,None] + np.arange(years))
+        # Drop indicator years that are larger than the largest HydroYear
+        indicator_years = indicator_years[indicator_years<=max_year]
+        # Set base frequency to None
+        site_df = pd.DataFrame({'Site':site,'HydroYear':indicator_years,'Frequency':None,
+                                'Censor':np.int8(0),'Numeric':np.nan,'SamplesOrIntervals':np.nan})
+        # Use months, quarters, semesters, and years to determine sampling frequency
+        # that will be used in the percentile calculation by comparing to required
+        # data thresholds. Ordered to generate finest scale frequency when reqs met
+        for (freq, level_df), level_rows in zip(levels,site_rows):
+            level_df = level_df.iloc[level_rows[site]]
+            samples, censor, numeric = rolling_hazen(level_df['HydroYear'].to_numpy(),level_df['Censor'].to_numpy(),
+                                                     level_df['Numeric'].to_numpy(),indicator_years,years,percentile)
+            met = samples >= requirements[frequency.index(freq)]
+            # Choose the appropriately calculated percentile based on the sampling frequency
+            site_df['Frequency'] = np.where(met,freq,site_df['Frequency'])
+            site_df['Censor'] = np.where(met,censor,site_df['Censor']).astype(np.int8)
+            site_df['Numeric'] = np.where(met,numeric,site_df['Numeric'])
+            site_df['SamplesOrIntervals'] = np.where(met,samples,site_df['SamplesOrIntervals'])
+        site_list.append(site_df)
+    # Add site details and drop years that don't have enough data for calculation
+    details_df = df.drop(columns=['HydroYear','Month','MonthCensor','MonthNumeric','Semester','Quarter']).drop_duplicates(subset=['Site'])
+    df = pd.merge(details_df,pd.concat(site_list,ignore_index=True),on='Site').dropna(subset=['Frequency'])
     # Sort by Site and hydroyear
     df = df.sort_values(by=['Site','HydroYear'],ascending=True)
     
     return df
 
+@profiled
+def exceedance_percentage(df,years=5,min_years=4,detection_limit=1):
+    '''
+    Function to obtain the percentage of samples with detections over multiple
+    hydroyears for each site and hydroyear (i.e., E. coli detections above the
+    drinking water standard).
+    
+    Parameters
+    ----------
+    df : DataFrame
+        dataframe should include columns as output by stacked_data
+    years : int
+        number of years over which to count samples and detections
+    min_years : int
+        minimum number of years with samples needed for a result
+    detection_limit : float
+        largest detection limit that can be used to determine a non-detection
+    
+    Returns
+    -------
+    Dataframe
+        With percentage of samples with detections for each site/hydroyear
+    '''
+    
+    measurement = df['Measurement'].iloc[0]
+    units = df['Units'].iloc[0]
+    # Drop any detection limits that don't work with the standard
+    # (i.e., drop value of <2 from K38/0408) Detection limit larger than 1
+    censor = censor_codes(df['Censor'].to_numpy())
+    df = df[~((censor==-1)&(df['Numeric']>detection_limit))].copy()
+    
+    # Duplicate samples largely have the same result and should not both be counted.
+    # However, when one sample is <1 and another is >=1, then count them both towards
+    # the percentage calculation
+    
+    # Assign each sample an index for day of the year
+    df['Day'] = df['DateTime'].dt.month*31 + df['DateTime'].dt.day
+    # For each sample, indicate 0 if below detection (<1) and 1 if detected at 1+
+    df['Detection'] = np.where(censor_codes(df['Censor'].to_numpy())==-1,0,1)
+    
+    # Only allow a single detection and single non-detection count towards each day
+    df = df.drop_duplicates(subset=['Site','HydroYear','Day','Detection'],keep='first')
+    # Add columns counting the number of samples and detections each hydro year
+    df['AnnualSamples'] = df.groupby(['Site','HydroYear'],observed=True)['Observation'].transform('count')
+    df['AnnualDetections'] = df.groupby(['Site','HydroYear'],observed=True)['Detection'].transform('sum')
+    # Remove unneeded columns and drop duplicates
+    df = df.drop(columns=['Measurement','Units','DateTime','Observation','Censor','Numeric','Day','Detection']).drop_duplicates()
+    # Years without data can still have a result if the preceeding years have
+    # results. For this reason, we fill the missing years at a site
+    df.Site = pd.Categorical(df.Site).remove_unused_categories()
+    df.HydroYear = pd.Categorical(df.HydroYear)
+    df = df.groupby(['Site','HydroYear']).sum()
+    # In years where no samples are collected, replace the 0 count with nan
+    df['AnnualSamples'] = np.where(df['AnnualSamples']==0,np.nan,df['AnnualSamples'])
+    # For each year, count the past years of samples and exceedances
+    # Rolling sums are grouped by site in the same order as the data
+    df[['Samples5yr','Detections5yr']] = df.groupby(['Site'],observed=True).rolling(window=years,min_periods=min_years).sum()[['AnnualSamples','AnnualDetections']].values
+    # Calculate the percentage by dividing the exceedances by the samples and multiply by 100.
+    df['Result'] = round_half_up(df['Detections5yr']/df['Samples5yr']*100,2)
+    df = df.sort_values(by=['Site','HydroYear'],ascending=True)
+    # Remove unneeded columns, reset index, and set hydro year data type to int
+    df = df.drop(columns=['AnnualSamples','AnnualDetections','Detections5yr']).rename(columns={'Samples5yr':'SamplesOrIntervals'})
+    df = df.dropna().reset_index()
+    df['HydroYear'] = df['HydroYear'].astype(int)
+    # Add columns to complete information for appending to full indicator results
+    df['Numeric'] = df['Result']
+    df['Result'] = df['Result'].astype(str)
+    df['Measurement'] = measurement
+    df['Units'] = units
+    df['Censor'] = np.int8(0)
+    
+    return df
+
+@profiled
 def grades(df,bins):
     '''
     Function to set indicator grades
@@ -692,6 +2331,7 @@ def grades(df,bins):
     
     return df
 
+@profiled
 def grade_check(df,data_df,bins,frequency):
     '''
     Function to check where median censored values are graded below A and
@@ -739,35 +2379,428 @@ def grade_check(df,data_df,bins,frequency):
     if new_ranges[-1] == '{}'.format(bins[0]):
         new_ranges[-1] = '>={}'.format(bins[0])
     # Add new grades and range to categorical columns
-    df['Grade'].cat.add_categories(new_categories=new_grades,inplace=True)
-    df['GradeRange'].cat.add_categories(new_categories=new_ranges,inplace=True)
+    df['Grade'] = df['Grade'].cat.add_categories(new_grades)
+    df['GradeRange'] = df['GradeRange'].cat.add_categories(new_ranges)
     # Reset index for use in locating censored results outside of grade A
     df = df.reset_index(drop=True)
     
+    # Look up combined grades and ranges by their lowest and highest grade
+    combo_grades = np.empty((len(grades),len(grades)),dtype=object)
+    combo_ranges = np.empty((len(grades),len(grades)),dtype=object)
+    for new_grade, new_range in zip(new_grades,new_ranges):
+        combo_grades[grades.index(new_grade[0]),grades.index(new_grade[-1])] = new_grade
+        combo_ranges[grades.index(new_grade[0]),grades.index(new_grade[-1])] = new_range
+    
     # Find where result is censored and not A grade
-    for i in df[(df['Grade']!='A')&(df['Censor']=='<')].index:
-        # Find largest detected value below censor level, if any
-        if frequency == 'Monthly':
-            detect_below_median = data_df[(data_df['Site']==df.iloc[i]['Site'])&
-                     (data_df['HydroYear']==df.iloc[i]['HydroYear'])&
-                     (data_df['MonthNumeric'] < df.iloc[i]['Numeric'])&
-                     (data_df['MonthCensor']!='<')]['MonthNumeric'].max()
-        elif frequency == 'All':
-            detect_below_median = data_df[(data_df['Site']==df.iloc[i]['Site'])&
-                     (data_df['HydroYear']==df.iloc[i]['HydroYear'])&
-                     (data_df['Numeric'] < df.iloc[i]['Numeric'])&
-                     (data_df['Censor']!='<')]['Numeric'].max()
-        # If there is no detection below the median censored result or if the
-        # largest detection is grade A, assign grade A/B/... to censor grade
-        if np.isnan(detect_below_median) or detect_below_median <= bins[1]:
-            df.at[i,'Grade'] = list(filter(lambda k: k[-1] == df.iloc[i]['Grade'], new_grades))[-1]
-            df.at[i,'GradeRange'] = new_ranges[new_grades.index(df.iloc[i]['Grade'])]
-        # Check if highest detection below median is same grade as censored median
-        elif grades[len([x for x in bins if x <= detect_below_median])-1] == df.iloc[i]['Grade']:
-            continue
-        # Otherwise, set grade to be range between highest detect below median grade and censor grade
-        else:
-            df.at[i,'Grade'] = list(filter(lambda k: ((k[0] == grades[len([x for x in bins if x <= detect_below_median])-1])&(k[-1] == df.iloc[i]['Grade'])), new_grades))[0]
-            df.at[i,'GradeRange'] = new_ranges[new_grades.index(df.iloc[i]['Grade'])]
+    censor = censor_codes(df['Censor'].to_numpy())
+    check_df = df[(df['Grade']!='A')&df['Grade'].notna()&(censor==-1)&df['Numeric'].notna()]
+    # Select detected values (not below detection) from the data used for the result
+    numeric_column, censor_column = {'Monthly':('MonthNumeric','MonthCensor'),'All':('Numeric','Censor')}[frequency]
+    detect_df = data_df[(censor_codes(data_df[censor_column].to_numpy())!=-1)&data_df[numeric_column].notna()]
+    # Number each site and hydroyear across the results and detections
+    group_ids = pd.concat([check_df[['Site','HydroYear']],detect_df[['Site','HydroYear']]],ignore_index=True)
+    group_ids = group_ids.groupby(['Site','HydroYear'],sort=False,observed=True).ngroup().to_numpy()
+    # Find largest detected value below censor level, if any
+    results_df = pd.DataFrame({'Group':group_ids[:len(check_df)],'Numeric':check_df['Numeric'].to_numpy(dtype=np.float64),
+                               'Row':check_df.index}).sort_values(by='Numeric')
+    detects_df = pd.DataFrame({'Group':group_ids[len(check_df):],'Detect':detect_df[numeric_column].to_numpy(dtype=np.float64)}).sort_values(by='Detect')
+    detect_below_median = pd.merge_asof(results_df,detects_df,left_on='Numeric',right_on='Detect',by='Group',
+                                        allow_exact_matches=False).set_index('Row')['Detect'].reindex(check_df.index).to_numpy()
+    # If there is no detection below the median censored result or if the
+    # largest detection is grade A, assign grade A/B/... to censor grade.
+    # Otherwise, use the grade of the highest detect below median
+    lowest = np.where(np.isnan(detect_below_median)|(detect_below_median<=bins[1]),0,
+                      np.searchsorted(bins,detect_below_median,side='right')-1)
+    highest = pd.Categorical(check_df['Grade'],categories=grades).codes
+    # Results stay the same where the highest detection below median is the
+    # same grade as the censored median. Otherwise, set grade to be range
+    # between highest detect below median grade and censor grade
+    change = lowest < highest
+    df.loc[check_df.index[change],'Grade'] = combo_grades[lowest[change],highest[change]]
+    df.loc[check_df.index[change],'GradeRange'] = combo_ranges[lowest[change],highest[change]]
             
-    return df
\ No newline at end of file
+    return df
+
+def run_graph(graph,workers=1):
+    '''
+    Function to run a graph of calculations. Each calculation runs once the
+    calculations it depends on are complete, and calculations that do not
+    depend on each other run at the same time.
+    
+    Parameters
+    ----------
+    graph : dict
+        calculations by key. Each calculation is a list of the function, keys
+        of calculations whose results are passed to the function first,
+        positional arguments, and keyword arguments
+    workers : int
+        number of calculations to run at the same time
+    
+    Returns
+    -------
+    dict
+        results by calculation key
+    '''
+    
+    results = {}
+    remaining = dict(graph)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while remaining or running:
+            # Start calculations with complete dependencies. Results are copied
+            # since functions can modify their input dataframes
+            for key in [key for key in remaining if all(dependency in results for dependency in remaining[key][1])]:
+                function, dependencies, args, kwargs = remaining.pop(key)
+                running[executor.submit(function,*[results[dependency].copy() for dependency in dependencies],*args,**kwargs)] = key
+            if not running:
+                raise ValueError('Calculations depend on calculations that are not in the graph: {}'.format(list(remaining)))
+            # Wait for any calculation to complete
+            done, not_done = wait(running,return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    
+    return results
+
+def indicator_format(df,data_df=None,indicator=None):
+    '''
+    Function to round, grade, and label statistic results as set by an
+    indicator specification
+    
+    Parameters
+    ----------
+    df : DataFrame
+        dataframe of statistic results
+    data_df : DataFrame
+        dataframe where the values used to calculate the result are saved,
+        only used if the indicator uses grade_check()
+    indicator : dict
+        indicator specification as described in indicator_results()
+    
+    Returns
+    -------
+    Dataframe
+        With indicator results for each freshwater body type
+    '''
+    
+    # Define indicator and special considerations
+    df['Indicator'] = indicator['Indicator']
+    df['SpecialConsiderations'] = indicator.get('SpecialConsiderations')
+    # Set sample frequency if not set by the statistic
+    if 'Frequency' in indicator:
+        df['Frequency'] = indicator['Frequency']
+    # Appropriately round results to match measurement precision in that range
+    if 'Rounding' in indicator:
+        df['Numeric'] = round_ladder(df['Numeric'],indicator['Rounding'],indicator.get('RoundingInclusive',False),indicator.get('RoundingKeep',[]))
+        # Convert result to a string
+        df['Result'] = censor_results(df['Censor'],df['Numeric'])
+    # Use grades function to set grades and grade range
+    df = grades(df,indicator['Bins'])
+    # Use grade_check to adjust grade results for detected values
+    if indicator.get('GradeCheck'):
+        df = grade_check(df,data_df,indicator['Bins'],indicator['GradeCheck'])
+    # Repeat results for each freshwater body type
+    df = pd.concat([df.assign(FreshwaterBodyType=FWType) for FWType in indicator['FreshwaterBodyType']])
+    
+    return df
+
+@profiled
+def indicator_results(df,indicators,workers=1,data=None):
+    '''
+    Function to calculate indicator results from indicator specifications.
+    Data shared by indicators (i.e., the monthly values of a measurement, or
+    a percentile graded with different bins) is calculated once.
+    
+    Parameters
+    ----------
+    df : DataFrame
+        dataframe should include columns as output by stacked_data
+    indicators : list of dict
+        indicator specifications with keys
+        - Measurement : measurement to calculate the indicator for
+        - Indicator : indicator name
+        - FreshwaterBodyType : list of freshwater body types to report the results for
+        - Statistic : annual_max, annual_percentile, multiyear_percentile, or exceedance_percentage
+        - Parameters : dict of arguments of the statistic function (optional)
+        - Frequency : sample frequency, if not set by the statistic (optional)
+        - Rounding : rounding steps for round_ladder() (optional)
+        - RoundingInclusive, RoundingKeep : arguments for round_ladder() (optional)
+        - Bins : set of values used to separate grades
+        - GradeCheck : frequency used by grade_check(), All or Monthly (optional)
+        - SpecialConsiderations : special considerations (optional)
+    workers : int
+        number of calculations to run at the same time
+    data : dict or None
+        dictionary to save the calculated samples and monthly values of each
+        measurement in, keyed by ('samples',measurement) and ('monthly',measurement)
+    
+    Returns
+    -------
+    Dataframe
+        With indicator results in the order of the specifications
+    '''
+    
+    # Set statistic functions and the data they are calculated from
+    statistics = {'annual_max':[annual_max,'samples'],
+                  'annual_percentile':[annual_percentile,'monthly'],
+                  'multiyear_percentile':[multiyear_percentile,'monthly'],
+                  'exceedance_percentage':[exceedance_percentage,'samples']}
+    # Create graph of calculations. Calculations with the same key are shared
+    graph = {}
+    for i, indicator in enumerate(indicators):
+        measurement = indicator['Measurement']
+        function, source = statistics[indicator['Statistic']]
+        graph['samples',measurement] = [lambda df,measurement : df[df['Measurement']==measurement],[],[df,measurement],{}]
+        if (source == 'monthly') or (indicator.get('GradeCheck') == 'Monthly'):
+            graph['monthly',measurement] = [reduce_to_monthly,[('samples',measurement)],[],{}]
+        parameters = indicator.get('Parameters',{})
+        statistic = ('statistic',measurement,indicator['Statistic'],repr(sorted(parameters.items())))
+        graph[statistic] = [function,[(source,measurement)],[],parameters]
+        dependencies = [statistic]
+        if indicator.get('GradeCheck'):
+            dependencies.append(('samples' if indicator['GradeCheck'] == 'All' else 'monthly',measurement))
+        graph['indicator',i] = [indicator_format,dependencies,[],{'indicator':indicator}]
+    results = run_graph(graph,workers)
+    # Save the samples and monthly values
+    if data is not None:
+        data.update({key:value for key,value in results.items() if key[0] in ['samples','monthly']})
+    
+    return pd.concat([results['indicator',i] for i in range(len(indicators))])
+
+def columnar_table(df):
+    '''
+    Function to prepare a table for columnar files. Column names are set to
+    str and object columns, which can hold mixed types from Hilltop, are
+    stored as text
+    '''
+    df = df.copy()
+    if not isinstance(df.columns,pd.MultiIndex):
+        df.columns = df.columns.map(str)
+    for column in df.columns[df.dtypes.values == object]:
+        df[column] = df[column].where(df[column].isna(),df[column].astype(str))
+    return df
+
+def parquet_writer(df, path, partition_cols=None):
+    '''
+    Function to write a table to a Parquet dataset folder, partitioned into
+    sub-folders by the values of partition_cols (i.e., Measurement=E. coli)
+    '''
+    df = columnar_table(df)
+    if partition_cols:
+        df.to_parquet(path,partition_cols=partition_cols,index=False)
+    else:
+        os.makedirs(path)
+        df.to_parquet(os.path.join(path,'part-0.parquet'))
+
+def arrow_writer(df, path, partition_cols=None):
+    '''
+    Function to write a table to a single Arrow IPC (Feather V2) file.
+    Arrow files are not partitioned
+    '''
+    from pyarrow import feather
+    feather.write_feather(columnar_table(df),path)
+
+# Writers for each export format, with the file extension of each table
+result_writers = {'parquet':[parquet_writer,''],'arrow':[arrow_writer,'.arrow']}
+
+@profiled
+def export_results(tables, folder, file_format='parquet', partitions={}, excel_file=None, excel_sheets=[]):
+    '''
+    Function to export result tables to columnar files, with an optional Excel
+    summary of the small result tables. Censor codes are kept in the columnar
+    files and written as <, >, or blank in Excel
+    
+    Parameters
+    ----------
+    tables : dict of DataFrame
+        tables to export keyed by table name (i.e., IndicatorResults)
+    folder : str
+        folder to write the tables into, one file or dataset per table
+    file_format : str
+        format of the tables, parquet or arrow (keys of result_writers)
+    partitions : dict of list of str
+        columns to partition each Parquet table by (i.e., Measurement, HydroYear)
+    excel_file : str or None
+        Excel file to write a summary to. None to skip the Excel export
+    excel_sheets : list of str
+        names of the tables to include in the Excel summary
+    
+    Returns
+    -------
+    None
+    '''
+    
+    writer, extension = result_writers[file_format]
+    os.makedirs(folder,exist_ok=True)
+    for name, df in tables.items():
+        path = os.path.join(folder,name+extension)
+        # Remove the previous export so old partitions are not kept
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+        writer(df,path,partitions.get(name))
+    
+    if excel_file is not None:
+        excel_summary({name:tables[name] for name in excel_sheets},excel_file)
+
+@profiled
+def excel_summary(tables, excel_file):
+    '''
+    Function to write tables to the sheets of an Excel file, with censor codes
+    written as <, >, or blank
+    
+    Parameters
+    ----------
+    tables : dict of DataFrame
+        tables to write keyed by sheet name
+    excel_file : str
+        Excel file to write
+    
+    Returns
+    -------
+    None
+    '''
+    
+    with pd.ExcelWriter(excel_file) as excel_writer:
+        for name, df in tables.items():
+            if 'Censor' in df.columns:
+                df = df.assign(Censor=censor_labels(censor_codes(df['Censor'].to_numpy())))
+            # Only keep named indexes (i.e., Site and DateTime of HilltopData)
+            df.to_excel(excel_writer,sheet_name=name,index=any(df.index.names))
+
+@profiled
+def read_results(folder, name, file_format='parquet'):
+    '''
+    Function to read a table written by export_results()
+    
+    Parameters
+    ----------
+    folder : str
+        folder the tables were written into
+    name : str
+        name of the table (i.e., TrendData)
+    file_format : str
+        format of the tables, parquet or arrow
+    
+    Returns
+    -------
+    DataFrame
+        the exported table. Partition columns are returned as categorical
+    '''
+    
+    path = os.path.join(folder,name+result_writers[file_format][1])
+    if file_format == 'arrow':
+        from pyarrow import feather
+        return feather.read_feather(path)
+    return pd.read_parquet(path)
+
+@profiled
+def store_results(tables, store, source, run_id=None, partitions={}):
+    '''
+    Function to add the result tables of a run to a results store shared by the
+    indicator scripts. Each table is an append-only Parquet dataset partitioned
+    by Source and RunID, and then by the listed columns of the table. Earlier
+    runs are kept
+    
+    Parameters
+    ----------
+    tables : dict of DataFrame
+        tables to store keyed by table name (i.e., IndicatorResults)
+    store : str
+        folder of the results store
+    source : str
+        name of the script that calculated the results (i.e., GW or SW)
+    run_id : str or None
+        identifier of the run. None to use the current time
+    partitions : dict of list of str
+        columns to partition each table by after Source and RunID
+        (i.e., FreshwaterBodyType, Measurement)
+    
+    Returns
+    -------
+    str
+        identifier of the run
+    '''
+    
+    # Times of day sort in the same order as the runs
+    if run_id is None:
+        run_id = pd.Timestamp.now().strftime('%Y%m%dT%H%M%S%f')
+    for name, df in tables.items():
+        # Categories differ between runs, so store the values of categorical columns
+        df = df.astype({column:object for column in df.columns if df[column].dtype.name == 'category'})
+        df = columnar_table(df.assign(Source=source,RunID=run_id))
+        df.to_parquet(os.path.join(store,name),partition_cols=['Source','RunID']+partitions.get(name,[]),index=False)
+    
+    return run_id
+
+@profiled
+def results_view(store, name, runs=None, run_columns=False):
+    '''
+    Function to combine the results of all sources in the results store. The
+    view is built from the file metadata of the selected runs and only their
+    files are read. Columns are returned in the order they were stored
+    
+    Parameters
+    ----------
+    store : str
+        folder of the results store
+    name : str
+        name of the table (i.e., IndicatorResults)
+    runs : dict or None
+        run identifier to use for each source. None to use the latest run of
+        every source in the store
+    run_columns : boolean
+        True to keep the Source and RunID columns of the store
+    
+    Returns
+    -------
+    DataFrame or None
+        results of the selected runs, None if the table has not been stored
+    '''
+    
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    path = os.path.join(store,name)
+    if not os.path.isdir(path):
+        return None
+    # Find the runs of each source from the partition folders
+    if runs is None:
+        runs = {}
+        for source_dir in os.scandir(path):
+            if source_dir.is_dir() and source_dir.name.startswith('Source='):
+                run_dirs = [run_dir.name[len('RunID='):] for run_dir in os.scandir(source_dir.path) if run_dir.name.startswith('RunID=')]
+                if run_dirs:
+                    runs[source_dir.name[len('Source='):]] = max(run_dirs)
+    # Only list the files in the folders of the selected runs
+    files = []
+    for source, run_id in runs.items():
+        run_path = os.path.join(path,'Source='+source,'RunID='+run_id)
+        files += sorted(glob.glob(os.path.join(run_path,'**','*.parquet'),recursive=True))
+    if not files:
+        return None
+    # Partition values are read from the folder names as text, as stored.
+    # Sources can be partitioned by different columns, so files are grouped
+    # by their partition columns
+    layouts = {}
+    for file in files:
+        keys = tuple(folder.split('=')[0] for folder in os.path.relpath(os.path.dirname(file),path).split(os.sep))
+        layouts.setdefault(keys,[]).append(file)
+    partitionings = {keys:ds.partitioning(pa.schema([(key,pa.string()) for key in keys]),flavor='hive') for keys in layouts}
+    # Sources can store different columns and column types (i.e., empty
+    # columns), so combine the file schemas before reading
+    schemas = [pq.read_schema(file) for file in files]
+    schema = pa.unify_schemas(schemas+[partitioning.schema for partitioning in partitionings.values()],promote_options='permissive')
+    table = pa.concat_tables([ds.dataset(layout_files,schema=schema,format='parquet',partitioning=partitionings[keys],partition_base_dir=path).to_table()
+                              for keys, layout_files in layouts.items()])
+    # Restore the stored column order, which is kept in the pandas metadata
+    # of each file. Columns of every source are kept
+    columns = []
+    for file_schema in schemas:
+        metadata = json.loads((file_schema.metadata or {}).get(b'pandas','{"columns": []}'))
+        columns += [column['name'] for column in metadata['columns'] if column['name'] in table.column_names and column['name'] not in columns]
+    columns += [column for column in table.column_names if column not in columns]
+    if not run_columns:
+        columns = [column for column in columns if column not in ['Source','RunID']]
+    
+    return table.select(columns).to_pandas()
@@ -13,7 +13,8 @@ import pandas as pd
 import numpy as np
 import csv
 import os
-from Functions import hilltop_data,stacked_data,sample_freq,round_half_up,annual_max,grades,grade_check,reduce_to_monthly,multiyear_percentile,trend_format,trends
+import time
+from Functions import WebServiceCache,request,hilltop_data,hilltop_data_update,stacked_data,sample_freq,ResultCollector,indicator_results,trend_format,trends,export_results,excel_summary,store_results,results_view,start_profile,profile_stage,stop_profile,hilltop_store,read_hilltop_store,columnar_table
 
 ##############################################################################
 '''
@@ -38,6 +39,18 @@ with open('GW-ZellaSmithSoESites.csv', 'r', encoding='utf-8-sig') as f:
     # Remove potential leading and tailing spaces
 f.close()
 
+##############################################################################
+'''
+Set run profiling
+'''
+
+# Set file to write a profile of the run to (.json or .csv, None for no
+# profiling), and file to dump cProfile statistics to (None for no cProfile)
+profile_file = None
+cprofile_file = None
+if profile_file:
+    start_profile(cprofile_file)
+
 ##############################################################################
 '''
 Choose Hilltop file
@@ -50,13 +63,40 @@ base_url = 'http://wateruse.ecan.govt.nz'
 # WQGroundwater.hts = \Hilltop01\Data\WQGroundwaterCombined.dsn
 hts = 'WQGroundwater.hts'
 
+# Set number of sites requested from the server at the same time and the
+# maximum number of requests per second
+workers = 8
+rate_limit = 20
+
+# Set folder to cache server data responses in (None to always use the
+# server), how long responses are kept in seconds, and the maximum cache size
+# in bytes. Site and measurement lists are always requested from the server
+cache_dir = None
+cache_ttl = 7*24*60*60
+cache_size = 5e9
+cache = WebServiceCache(cache_dir,ttl=cache_ttl,max_size=cache_size) if cache_dir else None
+
+# Set file to store the pulled data in between runs (None to always pull the
+# full record). If the file exists, only results added to the server since
+# the last run are pulled and merged into it. Backdated, edited and deleted
+# results are only picked up by a full pull, which is made when the file is
+# older than the maximum age in seconds
+data_file = None
+data_max_age = 7*24*60*60
+
+# Set file to stream a full pull into (None to pull into memory). Each site is
+# written to the file as it is pulled, so memory is bounded by the largest
+# sites rather than the whole hts file
+records_file = None
+
 ##############################################################################
 '''
 Set site list as sites within Hilltop file
 '''
 
 # Generate a list of all sites in the server file
-sites = sorted(ws.site_list(base_url,hts).SiteName.tolist(),key=str.lower)
+profile_stage('Site list')
+sites = sorted(request(None,None,ws.site_list,base_url,hts).SiteName.tolist(),key=str.lower)
 # Only include sites that contain '/' in the site name
 sites = [site for site in sites if '/' in site]
 
@@ -66,7 +106,22 @@ sites = [site for site in sites if '/' in site]
 Create WQ table with format to match view in Hilltop Manager on site basis
 '''
 
-WQData_df = hilltop_data(base_url,hts,sites,measurements)
+profile_stage('Hilltop data',len(sites))
+# Only pull new results if the last full pull is within the maximum age
+update = data_file and os.path.isfile(data_file) and time.time()-os.path.getmtime(data_file) < data_max_age
+if update:
+    pulled = os.path.getmtime(data_file)
+    WQData_df = hilltop_data_update(base_url,hts,sites,measurements,pd.read_parquet(data_file),workers=workers,rate_limit=rate_limit)
+elif records_file:
+    hilltop_store(base_url,hts,sites,measurements,records_file,workers=workers,rate_limit=rate_limit,cache=cache)
+    WQData_df = read_hilltop_store(records_file,measurements)
+else:
+    WQData_df = hilltop_data(base_url,hts,sites,measurements,workers=workers,rate_limit=rate_limit,cache=cache)
+# Store the data for the next run, keeping the time of the last full pull
+if data_file:
+    columnar_table(WQData_df).to_parquet(data_file)
+    if update:
+        os.utime(data_file,(pulled,pulled))
 
 ##############################################################################
 '''
@@ -83,6 +138,7 @@ Stack measurement results and create Hydro Year, censor, and numeric values
 '''
 
 # Generate data that has been filter by project code
+profile_stage('Stacked data',len(WQData_df))
 SoEData_df = WQData_df[(WQData_df['Sample Parameters','Project'].isin(project_codes))|((WQData_df.index.get_level_values('Site').isin(ZS_sites))&(WQData_df['Sample Parameters','Project'].isna())&(WQData_df['Sample Parameters','Field Technician']=='Zella Smith')&(WQData_df.index.get_level_values('DateTime').month.isin([9,10]))&(WQData_df.index.get_level_values('DateTime').year.isin([1999,2000,2001,2002])))]
 
 # Take relevant data and append to StatsData_df
@@ -97,6 +153,7 @@ For each hydro year, determine number of samples, days sampled, months sampled,
 and quarters sampled. From this, estimate a sampling frequency.
 '''
 
+profile_stage('Sample frequency',len(StatsData_df))
 Frequency_df = sample_freq(StatsData_df,semiannual=True)
 # Use estimated frequency to create a table with one column for each year
 Unstacked_df = Frequency_df['Frequency'].unstack(level=2)
@@ -106,136 +163,58 @@ Unstacked_df = Frequency_df['Frequency'].unstack(level=2)
 Initiate Indicator Dataframe
 '''
 
-IndicatorResults_df = pd.DataFrame(columns=['FreshwaterBodyType','Measurement','Units','Indicator','Site','HydroYear','Result','Censor','Numeric','GradeRange','Grade','SamplesOrIntervals','Frequency','SpecialConsiderations'])
-IndicatorResults_df['HydroYear'] = IndicatorResults_df['HydroYear'].astype(int)
-IndicatorResults_df['SamplesOrIntervals'] = IndicatorResults_df['SamplesOrIntervals'].astype(int)
-
-##############################################################################
-'''
-Nitrate Nitrogen Annual Maximum indicator
-'''
-
-# Set measurement parameter
-measurement = 'Nitrate Nitrogen'
-# Save sample values in case result is censored value with detection limit
-# in grade B or C range. Depending on the lower ranked detections, the result
-# could be indetermined grade (i.e., A/B, A/B/C, or B/C)
-sample_df = StatsData_df[StatsData_df['Measurement']==measurement][['Site','HydroYear','Censor','Numeric']].copy()
-# Use annual_max function to generate annual max dataframe
-indicator_df = annual_max(StatsData_df[StatsData_df['Measurement']==measurement].copy())
-# Define waterbody, indicator, and special considerations
-indicator_df['FreshwaterBodyType'] = 'Groundwater'
-indicator_df['Indicator'] = 'Annual Maximum'
-indicator_df['SpecialConsiderations'] = None
-# Set sample frequency as 'All' to indicate all samples are used
-indicator_df['Frequency'] = 'All'
-# Set bins for grades
-bins = [0,1,5.65,11.3,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-indicator_df = grade_check(indicator_df,sample_df,bins,'All')
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
+# Collect indicator results and combine them into one table once calculated
+IndicatorResults = ResultCollector(['FreshwaterBodyType','Measurement','Units','Indicator','Site','HydroYear','Result','Censor','Numeric','GradeRange','Grade','SamplesOrIntervals','Frequency','SpecialConsiderations'],
+                                   {'HydroYear':int,'Censor':'int8','Numeric':float,'SamplesOrIntervals':int})
 
 ##############################################################################
 '''
-E. coli 5-yr percent exceedances above drinking water standard for Groundwater
-'''
-
-# Set measurement parameter
-measurement = 'E. coli'
-# Start by only considering the E. coli values
-indicator_df = StatsData_df[(StatsData_df['Measurement'] == 'E. coli')].copy()
-# Drop any detection limits that don't work with drinking water standard
-# (i.e., drop value of <2 from K38/0408) Detection limit larger than 1
-indicator_df = indicator_df[~((indicator_df['Censor']=='<')&(indicator_df['Numeric']>1))]
-
-# Duplicate samples largely have the same result and should not both be counted.
-# However, when one sample is <1 and another is >=1, then count them both towards
-# the percentage calculation
-
-# Assign each sample an index for day of the year
-indicator_df['Day'] = indicator_df['DateTime'].dt.month*31 + indicator_df['DateTime'].dt.day
-# For each sample, indicate 0 if below detection (<1) and 1 if detected at 1+
-indicator_df['Detection'] = np.where(indicator_df['Censor']=='<',0,1)
-
-# Only allow a single detection and single non-detection count towards each day
-indicator_df = indicator_df.drop_duplicates(subset=['Site','HydroYear','Day','Detection'],keep='first')
-# Add columns counting the number of samples and detections each hydro year
-indicator_df['AnnualSamples'] = indicator_df.groupby(['Site','HydroYear'])['Observation'].transform('count')
-indicator_df['AnnualDetections'] = indicator_df.groupby(['Site','HydroYear'])['Detection'].transform('sum')
-# Remove unneeded columns and drop duplicates
-indicator_df = indicator_df.drop(columns=['DateTime','Observation','Censor','Numeric','Day','Detection']).drop_duplicates()
-# Years without data can still have a result if the preceeding 4 years have
-# results. For this reason, we fill the missing years at a site
-indicator_df.HydroYear = pd.Categorical(indicator_df.HydroYear)
-indicator_df = indicator_df.groupby(['Site','HydroYear']).sum()
-# In years where no samples are collected, replace the 0 count with nan
-indicator_df['AnnualSamples'] = np.where(indicator_df['AnnualSamples']==0,np.nan,indicator_df['AnnualSamples'])
-# For each year, count the past 5 years of samples and exceedances
-# Four values are required to generate results
-indicator_df[['Samples5yr','Detections5yr']] = indicator_df.groupby(['Site']).rolling(window=5,min_periods=4).sum()[['AnnualSamples','AnnualDetections']].reset_index().rename(columns={'AnnualSamples':'Samples5yr','AnnualDetections':'Detections5yr'})[['Samples5yr','Detections5yr']].values
-# Calculate the percentage by dividing the exceedances by the samples and multiply by 100.
-indicator_df['Result'] = (indicator_df['Detections5yr']/indicator_df['Samples5yr']*100).apply(lambda x : round_half_up(x,2))
-indicator_df = indicator_df.sort_values(by=['Site','HydroYear'],ascending=True)
-# Remove unneeded columns, reset index, and set hydro year data type to int
-indicator_df = indicator_df.drop(columns=['AnnualSamples','AnnualDetections','Detections5yr']).rename(columns={'Samples5yr':'SamplesOrIntervals'})
-indicator_df = indicator_df.dropna().reset_index()
-indicator_df['HydroYear'] = indicator_df['HydroYear'].astype(int)
-# Add columns to complete information for appending to full indicator results
-indicator_df['FreshwaterBodyType'] = 'Groundwater'
-indicator_df['Indicator'] = '5-yr Exceedance Percentage'
-indicator_df['SpecialConsiderations'] = None
-indicator_df['Numeric'] = indicator_df['Result']
-indicator_df['Result'] = indicator_df['Result'].astype(str)
-indicator_df['Measurement'] = measurement
-indicator_df['Units'] = units_dict[measurement]
-indicator_df['Frequency'] = 'Daily'
-indicator_df['Censor'] = None
-# Set bins for grades
-bins = [0,5,25,50,100]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
+Set indicator specifications
+'''
+
+# Each indicator is described by the keys listed in indicator_results().
+# Data used by more than one indicator is only calculated once
+indicators = [
+    # Nitrate Nitrogen Annual Maximum indicator
+    {'Measurement':'Nitrate Nitrogen','Indicator':'Annual Maximum','FreshwaterBodyType':['Groundwater'],
+     'Statistic':'annual_max','Frequency':'All','Bins':[0,1,5.65,11.3,np.inf],'GradeCheck':'All'},
+    # E. coli 5-yr percent exceedances above drinking water standard for Groundwater
+    {'Measurement':'E. coli','Indicator':'5-yr Exceedance Percentage','FreshwaterBodyType':['Groundwater'],
+     'Statistic':'exceedance_percentage','Parameters':{'years':5,'min_years':4,'detection_limit':1},'Frequency':'Daily',
+     'Bins':[0,5,25,50,100]},
+    # Nitrate Nitrogen 5-yr median
+    # Appropriately round results to match measurement precision in that range
+    # 5.65 should not be rounded since it is a grade cutoff
+    {'Measurement':'Nitrate Nitrogen','Indicator':'5-yr Median','FreshwaterBodyType':['Groundwater'],
+     'Statistic':'multiyear_percentile','Parameters':{'percentile':50,'years':5,'frequency':['Monthly','Quarterly','Semi-annual','Annual'],'requirements':[48,16,8,4]},
+     'Rounding':[[None,3],[0.2,2],[2,1]],'RoundingInclusive':True,'RoundingKeep':[5.65],'Bins':[0,1,5.65,11.3,np.inf]},
+    ]
+
+# Set number of indicator calculations to run at the same time
+indicator_workers = 4
 
 ##############################################################################
 '''
-Nitrate Nitrogen 5-yr median
+Calculate indicator results
 '''
 
-# Set measurement parameter
-measurement = 'Nitrate Nitrogen'
-# Use reduce_to_monthly function to generate monthly values dataframe
-indicator_df = reduce_to_monthly(StatsData_df[(StatsData_df['Measurement'] == measurement)].copy())
-# Use multi_year function to generate 5-yr medians
-indicator_df = multiyear_percentile(indicator_df,50,5,['Monthly','Quarterly','Semi-annual','Annual'],[48,16,8,4])
-# Define waterbody, indicator, and special considerations
-indicator_df['FreshwaterBodyType'] = 'Groundwater'
-indicator_df['Indicator'] = '5-yr Median'
-indicator_df['SpecialConsiderations'] = None
-# Appropriately round results to match measurement precision in that range
-# 5.65 should not be rounded since it is a grade cutoff
-indicator_df['Numeric'] = indicator_df['Numeric'].apply(lambda x : round_half_up(x,3))
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>=0.2,indicator_df['Numeric'].apply(lambda x : round_half_up(x,2)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where((indicator_df['Numeric']>=2)&(indicator_df['Numeric']!=5.65),indicator_df['Numeric'].apply(lambda x : round_half_up(x,1)),indicator_df['Numeric'])
-# Convert result to a string
-indicator_df['Result'] = indicator_df['Censor'].fillna('')+indicator_df['Numeric'].astype(str)
-# Set bins for grades
-bins = [0,1,5.65,11.3,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
+# Use indicator_results function to calculate all indicators and append to
+# indicator results table. Samples and monthly values are saved for trends
+profile_stage('Indicator results',len(StatsData_df))
+IndicatorData = {}
+IndicatorResults.append(indicator_results(StatsData_df,indicators,workers=indicator_workers,data=IndicatorData))
+IndicatorResults_df = IndicatorResults.frame()
 
 ##############################################################################
 '''
 Initiate Indicator Dataframe
 '''
 
-TrendData_df = pd.DataFrame(columns=['Site','Measurement','Units','HydroYear','Frequency','Interval','Censor','Numeric','Result'])
-TrendResults_df = pd.DataFrame(columns=['Site','Measurement','Units','HydroYear','TrendLength','DataFrequency','Intervals','MaxDetectionLimit','MinQuantLimit','Seasonal_pvalue','Seasonality','MK_pvalue','MK_Zscore','MK_Tau','MK_S','MK_VarS','DecreasingLikelihood','TrendCategory','TrendLineStartDate','TrendLineStartValue','Slope','TrendLineEndDate','TrendLineEndValue'])
+# Collect trend data and trend results for each measurement
+TrendData = ResultCollector(['Site','Measurement','Units','HydroYear','Frequency','Interval','Censor','Numeric','Result'],
+                            {'HydroYear':int,'Interval':int,'Censor':'int8','Numeric':float})
+TrendResults = ResultCollector(['Site','Measurement','Units','HydroYear','TrendLength','DataFrequency','Intervals','MaxDetectionLimit','MinQuantLimit','Seasonal_pvalue','Seasonality','MK_pvalue','MK_Zscore','MK_Tau','MK_S','MK_VarS','DecreasingLikelihood','TrendCategory','TrendLineStartDate','TrendLineStartValue','Slope','TrendLineEndDate','TrendLineEndValue'],
+                               {'HydroYear':int,'TrendLength':int,'Intervals':int,'TrendLineStartDate':'datetime64[ns]','TrendLineEndDate':'datetime64[ns]'})
 
 ##############################################################################
 '''
@@ -244,8 +223,9 @@ Nitrate Nitrogen Trends
 
 # Set measurement parameter
 measurement = 'Nitrate Nitrogen'
-# Use reduce_to_monthly function to generate monthly values dataframe
-indicator_df = reduce_to_monthly(StatsData_df[(StatsData_df['Measurement'] == measurement)].copy())
+profile_stage('Trends',len(IndicatorResults_df))
+# Use monthly values dataframe saved from the indicator calculations
+indicator_df = IndicatorData['monthly',measurement].copy()
 # Use trend_format function to generate data format for trend analyses
 # using specified data frequency options
 trend_data_df = trend_format(indicator_df,['Annual','Quarterly','Monthly'])
@@ -257,40 +237,66 @@ trend_results_df = trends(trend_data_df,[i for i in range(5,31)],[2021],0.80)
 trend_results_df['Measurement'] = measurement
 trend_results_df['Units'] = units
 # Append the trend data and trend results to respective tables
-TrendData_df = TrendData_df.append(trend_data_df)      
-TrendResults_df = TrendResults_df.append(trend_results_df)
+TrendData.append(trend_data_df)
+TrendResults.append(trend_results_df)
+
+##############################################################################
+'''
+Combine trend tables
+'''
+
+TrendData_df = TrendData.frame()
+TrendResults_df = TrendResults.frame()
 
 ##############################################################################
 '''
 Export the Results
 '''
 
-# Export results to Excel
-with pd.ExcelWriter('GW-Results.xlsx') as writer:
-    WQData_df.to_excel(writer, sheet_name='HilltopData',index=True)
-    StatsData_df.to_excel(writer, sheet_name='CleanedData',index=False)
-    Frequency_df.reset_index().to_excel(writer, sheet_name='SampleFrequency',index=False)
-    Unstacked_df.reset_index().to_excel(writer, sheet_name='UnstackedFrequency',index=False)
-    IndicatorResults_df.to_excel(writer, sheet_name='IndicatorResults',index=False)
-    TrendData_df.to_excel(writer, sheet_name='TrendData',index=False)
-    TrendResults_df.to_excel(writer, sheet_name='TrendResults',index=False)
+# Set export folder and format (parquet or arrow). Parquet tables are
+# partitioned into folders by the listed columns
+export_folder = 'GW-Results'
+export_format = 'parquet'
+partitions = {'CleanedData':['Measurement','HydroYear'],'SampleFrequency':['Measurement'],'IndicatorResults':['Measurement'],'TrendData':['Measurement'],'TrendResults':['Measurement']}
+# Set Excel summary file (None for no Excel export) and the small result
+# tables to include in it
+excel_file = 'GW-Results.xlsx'
+excel_sheets = ['UnstackedFrequency','IndicatorResults','TrendResults']
+
+# Export all tables to columnar files and the result tables to Excel
+profile_stage('Export',len(IndicatorResults_df))
+tables = {
+    'HilltopData':WQData_df,
+    'CleanedData':StatsData_df,
+    'SampleFrequency':Frequency_df.reset_index(),
+    'UnstackedFrequency':Unstacked_df.reset_index(),
+    'IndicatorResults':IndicatorResults_df,
+    'TrendData':TrendData_df,
+    'TrendResults':TrendResults_df,
+    }
+export_results(tables,export_folder,export_format,partitions,excel_file,excel_sheets)
 
 ##############################################################################
 '''
 Combine GW and SW indicator results
 '''
 
-# Check if SW results exist otherwise don't merge
-if os.path.isfile('SW-Results.xlsx'):
-    with pd.ExcelWriter('Results.xlsx') as writer:
-        # Only merge primary results in output
-        for sheet in ['IndicatorResults','TrendData','TrendResults']:
-            try:
-                GW_df = pd.read_excel('GW-Results.xlsx',sheet_name=sheet)
-                SW_df = pd.read_excel('SW-Results.xlsx',sheet_name=sheet)
-                df = pd.concat([GW_df,SW_df])
-                df.to_excel(writer,sheet_name=sheet,index=False)
-            except NameError:
-                continue
-            except ValueError:
-                continue
\ No newline at end of file
+# Set results store shared with the SW script and the combined Excel file
+# (None for no Excel export)
+results_store = 'Results'
+combined_excel = 'Results.xlsx'
+
+# Add the results of this run to the results store
+profile_stage('Combine results',len(IndicatorResults_df))
+store_results({'IndicatorResults':IndicatorResults_df,'TrendData':TrendData_df,'TrendResults':TrendResults_df},results_store,'GW',
+              partitions={'IndicatorResults':['FreshwaterBodyType','Measurement'],'TrendData':['Measurement'],'TrendResults':['Measurement']})
+
+# Combine the latest GW and SW results in the store. Only primary results are
+# combined and tables that have not been stored by either script are skipped
+Combined = {table:results_view(results_store,table) for table in ['IndicatorResults','TrendData','TrendResults']}
+Combined = {table:df for table,df in Combined.items() if df is not None}
+if combined_excel is not None:
+    excel_summary(Combined,combined_excel)
+
+# Write the run profile
+stop_profile(profile_file)
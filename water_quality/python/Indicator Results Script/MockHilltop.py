@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+"""
+Python Script with a local stand-in for the Hilltop web service, so that
+hilltop_data() and the site summary script can be run and timed offline
+
+The server answers the SiteList, MeasurementList and GetData requests used by
+hilltoppy (http://localhost:port/file.hts?Service=Hilltop&Request=...) with
+Hilltop style XML built from a WQData_df table, as output from hilltop_data()
+and stored by the indicator scripts. Latency and errors can be injected to
+test the concurrent fetch, caching and retry paths.
+
+Created on Sat Oct 17 01:17:12 2026
+"""
+
+# import python modules
+import pandas as pd
+import numpy as np
+import time
+import zlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+from xml.sax.saxutils import escape, quoteattr
+
+# Date format of the Hilltop web service
+date_format = '%Y-%m-%dT%H:%M:%S'
+
+def fixture_data(WQData_df, quality_code=600):
+    """
+    Function to split a dataframe output from hilltop_data() into the site
+    tables served by MockHilltopServer
+
+    Parameters
+    ----------
+    WQData_df : DataFrame
+        indexed by Site and DateTime with 'Sample Parameters' and measurement
+        columns in the format output from hilltop_data()
+    quality_code : int or None
+        quality code of results without a 'QualityCode' measurement parameter.
+        None to not return quality codes
+
+    Returns
+    -------
+    dictionary
+        matching each site to a dictionary with the 'WQ Sample' parameter table
+        and a (units, results table) tuple for each measurement
+    """
+    measurements = [m for m in WQData_df.columns.get_level_values(0).unique() if m != 'Sample Parameters']
+    sites = {}
+    for site, site_df in WQData_df.groupby(level='Site',sort=False):
+        site_df = site_df.droplevel('Site').sort_index()
+        site_tables = {}
+        # Sample parameters are kept for samples with at least one parameter
+        if 'Sample Parameters' in site_df.columns.get_level_values(0):
+            sample_df = site_df['Sample Parameters'].dropna(how='all')
+            sample_df = sample_df.dropna(axis=1,how='all')
+            if not sample_df.empty:
+                site_tables['WQ Sample'] = sample_df
+        for measurement in measurements:
+            measurement_df = site_df[measurement]
+            # The results column is named by the measurement units, e.g. '(mg/L)'
+            units_column = [c for c in measurement_df.columns if c.startswith('(') and c.endswith(')')]
+            if not units_column:
+                continue
+            measurement_df = measurement_df[measurement_df[units_column[0]].notna()]
+            if measurement_df.empty:
+                continue
+            measurement_df = measurement_df.dropna(axis=1,how='all').rename(columns={units_column[0]:'Value'})
+            if 'QualityCode' not in measurement_df.columns:
+                measurement_df['QualityCode'] = quality_code
+            site_tables[measurement] = (units_column[0][1:-1],measurement_df)
+        sites[site] = site_tables
+    return sites
+
+def site_locations(sites):
+    """
+    Function to set a repeatable NZTM location for each site, used when the
+    fixture has no site locations
+
+    Parameters
+    ----------
+    sites : list of str
+        list of site names
+
+    Returns
+    -------
+    DataFrame
+        indexed by site with Easting and Northing columns
+    """
+    # Hash each site name into a location within Canterbury
+    keys = np.array([zlib.crc32(site.encode('utf-8')) for site in sites],dtype=np.int64)
+    return pd.DataFrame({'Easting':1350000+(keys%250000),'Northing':5000000+((keys//250000)%350000)},index=pd.Index(sites,name='SiteName'))
+
+def xml_value(value):
+    '''
+    Convert a table value to web service text
+    '''
+    if isinstance(value, pd.Timestamp):
+        return value.strftime(date_format)
+    # Integer valued floats (e.g. quality codes) are returned without decimals
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return escape(str(value))
+
+def site_list_xml(agency, locations):
+    '''
+    Create the SiteList response
+    '''
+    lines = ['<?xml version="1.0" ?>','<HilltopServer>','<Agency>{}</Agency>'.format(escape(agency))]
+    for site, row in locations.iterrows():
+        if row.isna().all():
+            lines.append('<Site Name={}/>'.format(quoteattr(site)))
+        else:
+            lines.append('<Site Name={}><Easting>{}</Easting><Northing>{}</Northing></Site>'.format(quoteattr(site),xml_value(row['Easting']),xml_value(row['Northing'])))
+    lines.append('</HilltopServer>')
+    return '\n'.join(lines)
+
+def measurement_list_xml(agency, site, site_tables):
+    '''
+    Create the MeasurementList response of a site
+    '''
+    lines = ['<?xml version="1.0" ?>','<HilltopServer>','<Agency>{}</Agency>'.format(escape(agency))]
+    for name, table in site_tables.items():
+        if name == 'WQ Sample':
+            lines.append('<DataSource Name="WQ Sample" NumItems="0"><TSType>StdSeries</TSType><DataType>WQSample</DataType>'
+                         '<Interpolation>Discrete</Interpolation><From>{}</From><To>{}</To></DataSource>'.format(xml_value(table.index.min()),xml_value(table.index.max())))
+        else:
+            units, measurement_df = table
+            lines.append('<DataSource Name={0} NumItems="1"><TSType>StdSeries</TSType><DataType>WQData</DataType>'
+                         '<Interpolation>Discrete</Interpolation><ItemFormat>F</ItemFormat><From>{1}</From><To>{2}</To>'
+                         '<Measurement Name={0}><Units>{3}</Units><ItemNumber>1</ItemNumber><RequestAs>{4}</RequestAs></Measurement>'
+                         '</DataSource>'.format(quoteattr(name),xml_value(measurement_df.index.min()),xml_value(measurement_df.index.max()),escape(units),escape(name)))
+    lines.append('</HilltopServer>')
+    return '\n'.join(lines)
+
+def sample_parameter_list_xml(agency, site, sample_df):
+    '''
+    Create the MeasurementList response of the 'WQ Sample' parameters of a site
+    '''
+    lines = ['<?xml version="1.0" ?>','<HilltopServer>','<Agency>{}</Agency>'.format(escape(agency)),'<Measurement Name="WQ Sample" Site={}>'.format(quoteattr(site))]
+    for parameter in sample_df.columns:
+        dates = sample_df[parameter].dropna().index
+        lines.append('<Parameter Name={}><From>{}</From><To>{}</To></Parameter>'.format(quoteattr(str(parameter)),xml_value(dates.min()),xml_value(dates.max())))
+    lines.extend(['</Measurement>','</HilltopServer>'])
+    return '\n'.join(lines)
+
+def get_data_xml(agency, site, measurement, site_tables, from_date, to_date, quality_codes):
+    '''
+    Create the GetData response of a site measurement between two dates
+    '''
+    lines = ['<?xml version="1.0" ?>','<Hilltop>','<Agency>{}</Agency>'.format(escape(agency))]
+    if measurement not in site_tables:
+        lines.append('</Hilltop>')
+        return '\n'.join(lines)
+    sample_df = site_tables.get('WQ Sample',pd.DataFrame(index=pd.DatetimeIndex([])))
+    if measurement == 'WQ Sample':
+        units, data_df = None, sample_df
+    else:
+        units, data_df = site_tables[measurement]
+    data_df = data_df[(data_df.index >= from_date)&(data_df.index <= to_date)]
+    # Requests without results do not contain a measurement
+    if data_df.empty:
+        lines.append('</Hilltop>')
+        return '\n'.join(lines)
+    lines.append('<Measurement SiteName={}>'.format(quoteattr(site)))
+    if units is None:
+        lines.append('<DataSource Name="WQ Sample" NumItems="0"><TSType>StdSeries</TSType><DataType>WQSample</DataType><Interpolation>Discrete</Interpolation></DataSource>')
+    else:
+        lines.append('<DataSource Name={0} NumItems="1"><TSType>StdSeries</TSType><DataType>WQData</DataType><Interpolation>Discrete</Interpolation>'
+                     '<ItemInfo ItemNumber="1"><ItemName>{1}</ItemName><ItemFormat>F</ItemFormat><Units>{2}</Units></ItemInfo></DataSource>'.format(quoteattr(measurement),escape(measurement),escape(units)))
+    lines.append('<Data DateFormat="Calendar" NumItems="{}">'.format(0 if units is None else 1))
+    # Results carry the sample parameters of their sample, then their own parameters
+    sample_df = sample_df.reindex(data_df.index) if units is not None else sample_df.iloc[:0]
+    parameters = [c for c in data_df.columns if c not in ['Value','QualityCode']]
+    for i, (date, row) in enumerate(data_df.iterrows()):
+        element = ['<E><T>{}</T>'.format(xml_value(date))]
+        if units is not None:
+            element.append('<I1>{}</I1>'.format(xml_value(row['Value'])))
+            if quality_codes and pd.notna(row['QualityCode']):
+                element.append('<Q1>{}</Q1>'.format(xml_value(row['QualityCode'])))
+            sample_row = sample_df.iloc[i]
+            element.extend(['<Parameter Name={} Value={}/>'.format(quoteattr(str(p)),quoteattr(xml_value(v))) for p, v in sample_row.items() if pd.notna(v) and p not in parameters])
+        element.extend(['<Parameter Name={} Value={}/>'.format(quoteattr(str(p)),quoteattr(xml_value(row[p]))) for p in parameters if pd.notna(row[p])])
+        element.append('</E>')
+        lines.append(''.join(element))
+    lines.extend(['</Data>','</Measurement>','</Hilltop>'])
+    return '\n'.join(lines)
+
+def query_date(value, default):
+    '''
+    Convert a request date to a timestamp. Dates outside the pandas range
+    (e.g. '1001-01-01' or '9999-01-01') are clipped to the range
+    '''
+    if not value:
+        return default
+    try:
+        return pd.Timestamp(value)
+    except pd.errors.OutOfBoundsDatetime:
+        return pd.Timestamp.min if value < '1677' else pd.Timestamp.max
+
+def error_xml(message):
+    '''
+    Create a Hilltop error response
+    '''
+    return '<?xml version="1.0" ?>\n<HilltopServer>\n<Error>{}</Error>\n</HilltopServer>'.format(escape(message))
+
+class MockHilltopHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of MockHilltopServer
+    """
+
+    def log_message(self, format, *args):
+        '''
+        Requests are recorded in the server log rather than printed
+        '''
+        pass
+
+    def do_GET(self):
+        '''
+        Answer a Hilltop web service request, after the configured latency and
+        with the configured chance of an injected error
+        '''
+        server = self.server
+        start = time.monotonic()
+        url = urlparse(self.path)
+        hts = url.path.strip('/')
+        # Query keys are case insensitive on a Hilltop server
+        query = {k.lower(): v for k, v in parse_qsl(url.query,keep_blank_values=True)}
+        delay, error = server.draw()
+        if delay > 0:
+            time.sleep(delay)
+        if error == 'reset':
+            # Close the connection without a response
+            self.close_connection = True
+            server.record(hts,query,None,time.monotonic()-start)
+            return
+        if error == 'timeout':
+            time.sleep(server.timeout_delay)
+        if error in ['http500','http503']:
+            status, body = int(error[4:]), 'Server error'
+        elif error == 'hilltop':
+            status, body = 200, error_xml('Injected server error')
+        else:
+            status, body = server.respond(hts,query)
+        content = body.encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type','text/xml; charset=utf-8')
+            self.send_header('Content-Length',str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        # The client may have given up on a slow response
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        server.record(hts,query,status,time.monotonic()-start)
+
+class MockHilltopServer(ThreadingHTTPServer):
+    """
+    Local Hilltop web service serving fixture data, with configurable latency
+    and error injection. Each request is answered in its own thread.
+
+    Parameters
+    ----------
+    data : DataFrame or dictionary
+        dataframe in the format output from hilltop_data(), served for any hts
+        file name, or a dictionary matching hts file names to dataframes
+    host : str
+        host name to serve on
+    port : int
+        port to serve on. 0 to use a free port
+    latency : float
+        seconds added to every response
+    jitter : float
+        maximum random seconds added to the latency of each response
+    error_rate : float
+        chance of each request returning an injected error
+    errors : list of str
+        injected error types, chosen at random for each error.
+        'http500' and 'http503' return server errors, 'hilltop' returns a
+        Hilltop <Error> response, 'timeout' waits timeout_delay seconds
+        before answering and 'reset' closes the connection without a response
+    timeout_delay : float
+        seconds waited by 'timeout' errors
+    seed : int
+        seed of the random latency and errors, so load tests are repeatable
+    locations : DataFrame or None
+        indexed by site with Easting and Northing columns. Repeatable
+        locations are made up from the site names if None
+    agency : str
+        agency name in the responses
+    quality_code : int or None
+        quality code of results without a 'QualityCode' measurement parameter
+    """
+
+    daemon_threads = True
+
+    def __init__(self, data, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, errors=['http503'],
+                 timeout_delay=30.0, seed=0, locations=None, agency='Mock Hilltop', quality_code=600):
+        super().__init__((host,port),MockHilltopHandler)
+        files = data if isinstance(data, dict) else {None: data}
+        self.files = {hts: fixture_data(df,quality_code) for hts, df in files.items()}
+        self.locations = {hts: site_locations(list(sites.keys())) if locations is None else locations for hts, sites in self.files.items()}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.errors = errors
+        self.timeout_delay = timeout_delay
+        self.agency = agency
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.log = []
+        self.thread = None
+
+    @property
+    def base_url(self):
+        '''
+        Root url of the server to pass to hilltoppy in place of the live server
+        '''
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host,port)
+
+    def start(self):
+        '''
+        Serve requests in a background thread
+        '''
+        self.thread = threading.Thread(target=self.serve_forever,daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop serving requests and close the server
+        '''
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def draw(self):
+        '''
+        Draw the delay and injected error (or None) of a request
+        '''
+        with self.lock:
+            delay = self.latency + (self.rng.uniform(0,self.jitter) if self.jitter > 0 else 0)
+            error = None
+            if (self.error_rate > 0) and (self.rng.random() < self.error_rate):
+                error = self.errors[self.rng.integers(len(self.errors))]
+        return delay, error
+
+    def record(self, hts, query, status, duration):
+        '''
+        Record a request in the server log
+        '''
+        with self.lock:
+            self.log.append([time.time(),hts,query.get('request'),query.get('site'),query.get('measurement'),status,duration])
+
+    def requests_df(self):
+        '''
+        Return the server log as a dataframe
+        '''
+        with self.lock:
+            return pd.DataFrame(self.log,columns=['Time','hts','Request','Site','Measurement','Status','Duration'])
+
+    def respond(self, hts, query):
+        '''
+        Create the status and XML response of a request
+        '''
+        if query.get('service','').lower() != 'hilltop':
+            return 400, error_xml('Unknown service')
+        sites = self.files.get(hts,self.files.get(None))
+        if sites is None:
+            return 404, error_xml('Unknown file {}'.format(hts))
+        request = query.get('request','').lower()
+        if request == 'sitelist':
+            locations = self.locations.get(hts,self.locations.get(None))
+            if query.get('location','').lower() not in ['yes','true','1']:
+                locations = locations.iloc[:,:0]
+            return 200, site_list_xml(self.agency,locations)
+        site = query.get('site')
+        if site not in sites:
+            return 200, error_xml('Site {} not found'.format(site))
+        if request == 'measurementlist':
+            # The sample parameters are listed when requesting the 'WQ Sample' measurement
+            if query.get('measurement') == 'WQ Sample':
+                if 'WQ Sample' not in sites[site]:
+                    return 200, error_xml('No sample parameters for {}'.format(site))
+                return 200, sample_parameter_list_xml(self.agency,site,sites[site]['WQ Sample'])
+            return 200, measurement_list_xml(self.agency,site,sites[site])
+        if request == 'getdata':
+            try:
+                from_date = query_date(query.get('from'),pd.Timestamp.min)
+                to_date = query_date(query.get('to'),pd.Timestamp.max)
+            except ValueError:
+                return 200, error_xml('Invalid date')
+            quality_codes = any([query.get(k,'').lower() in ['yes','true','1'] for k in ['showquality','qualitycodes']])
+            return 200, get_data_xml(self.agency,site,query.get('measurement'),sites[site],from_date,to_date,quality_codes)
+        return 200, error_xml('Unknown request {}'.format(query.get('request')))
+
+if __name__ == '__main__':
+    ##############################################################################
+    '''
+    Set fixture data and server behaviour
+    '''
+
+    # Set file with data stored by the indicator scripts, or None to serve
+    # synthetic data with the number of sites and seed below. The indicator
+    # scripts only store their data if data_file is set (i.e.,
+    # 'GW-HilltopData.parquet')
+    fixture_file = None
+    synthetic_sites = 1000
+
+    # Set port to serve on (base_url = 'http://127.0.0.1:port')
+    port = 8080
+
+    # Set latency and jitter in seconds, and the chance and types of injected errors
+    latency = 0.05
+    jitter = 0.05
+    error_rate = 0.0
+    errors = ['http503','timeout']
+    seed = 0
+
+    ##############################################################################
+    '''
+    Serve until interrupted
+    '''
+
+    if fixture_file:
+        data = pd.read_parquet(fixture_file)
+    else:
+        from SyntheticData import synthetic_wq_data
+        data = synthetic_wq_data(synthetic_sites,seed=seed)
+    server = MockHilltopServer(data,port=port,latency=latency,jitter=jitter,error_rate=error_rate,errors=errors,seed=seed)
+    print('Serving {} sites at {}'.format(len(server.locations[None]),server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    requests_df = server.requests_df()
+    print('{} requests, {} errors'.format(len(requests_df),(requests_df['Status']!=200).sum()))
+    server.server_close()
@@ -12,7 +12,8 @@ from hilltoppy import web_service as ws
 import pandas as pd
 import numpy as np
 import os
-from Functions import hilltop_data,stacked_data,sample_freq,round_half_up,annual_max,grades,reduce_to_monthly,annual_percentile,grade_check,multiyear_percentile
+import time
+from Functions import WebServiceCache,request,hilltop_data,hilltop_data_update,stacked_data,sample_freq,ResultCollector,indicator_results,export_results,excel_summary,store_results,results_view,start_profile,profile_stage,stop_profile,hilltop_store,read_hilltop_store,columnar_table
 
 ##############################################################################
 '''
@@ -23,6 +24,18 @@ measurements = ['Chlorophyll a (planktonic)','Chlorophyll a (benthic)','Chloroph
                 'Total Nitrogen','Ammoniacal Nitrogen','Nitrate-N Nitrite-N',
                 'Total Phosphorus','Dissolved Reactive Phosphorus','E. coli']
 
+##############################################################################
+'''
+Set run profiling
+'''
+
+# Set file to write a profile of the run to (.json or .csv, None for no
+# profiling), and file to dump cProfile statistics to (None for no cProfile)
+profile_file = None
+cprofile_file = None
+if profile_file:
+    start_profile(cprofile_file)
+
 ##############################################################################
 '''
 Choose Hilltop file
@@ -35,20 +48,62 @@ base_url = 'http://wateruse.ecan.govt.nz'
 # WQGroundwater.hts = \Hilltop01\Data\WQGroundwaterCombined.dsn
 hts = 'SWQlongTerm.hts'
 
+# Set number of sites requested from the server at the same time and the
+# maximum number of requests per second
+workers = 8
+rate_limit = 20
+
+# Set folder to cache server data responses in (None to always use the
+# server), how long responses are kept in seconds, and the maximum cache size
+# in bytes. Site and measurement lists are always requested from the server
+cache_dir = None
+cache_ttl = 7*24*60*60
+cache_size = 5e9
+cache = WebServiceCache(cache_dir,ttl=cache_ttl,max_size=cache_size) if cache_dir else None
+
+# Set file to store the pulled data in between runs (None to always pull the
+# full record). If the file exists, only results added to the server since
+# the last run are pulled and merged into it. Backdated, edited and deleted
+# results are only picked up by a full pull, which is made when the file is
+# older than the maximum age in seconds
+data_file = None
+data_max_age = 7*24*60*60
+
+# Set file to stream a full pull into (None to pull into memory). Each site is
+# written to the file as it is pulled, so memory is bounded by the largest
+# sites rather than the whole hts file
+records_file = None
+
 ##############################################################################
 '''
 Set site list as sites within Hilltop file
 '''
 
 # Generate a list of all sites in the server file
-sites = sorted(ws.site_list(base_url,hts).SiteName.tolist(),key=str.lower)
+profile_stage('Site list')
+sites = sorted(request(None,None,ws.site_list,base_url,hts).SiteName.tolist(),key=str.lower)
 
 ##############################################################################
 '''
 Create WQ table with format to match view in Hilltop Manager on site basis
 '''
 
-WQData_df = hilltop_data(base_url,hts,sites,measurements)
+profile_stage('Hilltop data',len(sites))
+# Only pull new results if the last full pull is within the maximum age
+update = data_file and os.path.isfile(data_file) and time.time()-os.path.getmtime(data_file) < data_max_age
+if update:
+    pulled = os.path.getmtime(data_file)
+    WQData_df = hilltop_data_update(base_url,hts,sites,measurements,pd.read_parquet(data_file),workers=workers,rate_limit=rate_limit)
+elif records_file:
+    hilltop_store(base_url,hts,sites,measurements,records_file,workers=workers,rate_limit=rate_limit,cache=cache)
+    WQData_df = read_hilltop_store(records_file,measurements)
+else:
+    WQData_df = hilltop_data(base_url,hts,sites,measurements,workers=workers,rate_limit=rate_limit,cache=cache)
+# Store the data for the next run, keeping the time of the last full pull
+if data_file:
+    columnar_table(WQData_df).to_parquet(data_file)
+    if update:
+        os.utime(data_file,(pulled,pulled))
 
 ##############################################################################
 '''
@@ -65,6 +120,7 @@ Stack measurement results and create Hydro Year, censor, and numeric values
 '''
 
 # Take relevant data and append to StatsData_df
+profile_stage('Stacked data',len(WQData_df))
 StatsData_df = stacked_data(WQData_df,measurements,units_dict)
 
 
@@ -78,6 +134,7 @@ For each hydro year, determine number of samples, days sampled, months sampled,
 and quarters sampled. From this, estimate a sampling frequency.
 '''
 
+profile_stage('Sample frequency',len(StatsData_df))
 Frequency_df = sample_freq(StatsData_df,semiannual=False)
 # Use estimated frequency to create a table with one column for each year
 Unstacked_df = Frequency_df['Frequency'].unstack(level=2)
@@ -87,404 +144,128 @@ Unstacked_df = Frequency_df['Frequency'].unstack(level=2)
 Initiate Indicator Dataframe
 '''
 
-IndicatorResults_df = pd.DataFrame(columns=['FreshwaterBodyType','Measurement','Units','Indicator','Site','HydroYear','Result','Censor','Numeric','GradeRange','Grade','SamplesOrIntervals','Frequency','SpecialConsiderations'])
-IndicatorResults_df['HydroYear'] = IndicatorResults_df['HydroYear'].astype(int)
-IndicatorResults_df['SamplesOrIntervals'] = IndicatorResults_df['SamplesOrIntervals'].astype(int)
+# Collect indicator results and combine them into one table once calculated
+IndicatorResults = ResultCollector(['FreshwaterBodyType','Measurement','Units','Indicator','Site','HydroYear','Result','Censor','Numeric','GradeRange','Grade','SamplesOrIntervals','Frequency','SpecialConsiderations'],
+                                   {'HydroYear':int,'Censor':'int8','Numeric':float,'SamplesOrIntervals':int})
 
 ##############################################################################
 '''
-Chlorophyll-a Annual Maximum indicator
-'''
-
-# Set measurement parameter
-measurement = 'Chlorophyll a (planktonic)'
-# Save sample values in case result is censored value with detection limit
-# in grade B or C range. Depending on the lower ranked detections, the result
-# could be indetermined grade (i.e., A/B, A/B/C, or B/C)
-sample_df = StatsData_df[StatsData_df['Measurement']==measurement][['Site','HydroYear','Censor','Numeric']].copy()
-# Use annual_max function to generate annual max dataframe
-indicator_df = annual_max(StatsData_df[StatsData_df['Measurement']==measurement].copy())
-# Define waterbody, indicator, and special considerations
-indicator_df['FreshwaterBodyType'] = 'Lakes'
-indicator_df['Indicator'] = 'Annual Maximum'
-indicator_df['SpecialConsiderations'] = None
-# Set sample frequency as 'All' to indicate all samples are used
-indicator_df['Frequency'] = 'All'
-# Set bins for grades
-bins = [0,10,25,60,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-#indicator_df = grade_check(indicator_df,sample_df,bins,'All')
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
-
-##############################################################################
-'''
-Chlorophyll-a Annual Median indicator
-'''
-
-# Set measurement parameter
-measurement = 'Chlorophyll a (planktonic)'
-# Use reduce_to_monthly function to generate monthly values dataframe
-indicator_df = reduce_to_monthly(StatsData_df[(StatsData_df['Measurement'] == measurement)].copy())
-# Save monthly values in case result is censored value with detection limit
-# in grade B or C range. Depending on the lower ranked detections, the result
-# could be indetermined grade (i.e., A/B, A/B/C, or B/C)
-monthly_df = indicator_df[['Site','HydroYear','MonthCensor','MonthNumeric']].copy()
-# Use annual_percetnile function to generate annual medians from monthly data
-indicator_df = annual_percentile(indicator_df,50)
-# Define waterbody, indicator, and special considerations
-indicator_df['FreshwaterBodyType'] = 'Lakes'
-indicator_df['Indicator'] = 'Annual Median'
-indicator_df['SpecialConsiderations'] = None
-# Set sample frequency used to calculate median
-indicator_df['Frequency'] = 'Monthly'
-# Round median numeric result to nearest 0.1
-indicator_df['Numeric'] = indicator_df['Numeric'].apply(lambda x : round_half_up(x,1))
-# Convert result to a string
-indicator_df['Result'] = indicator_df['Censor'].fillna('')+indicator_df['Numeric'].astype(str)
-# Set bins for grades
-bins = [0,2,5,12,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-#indicator_df = grade_check(indicator_df,monthly_df,bins,'Monthly')
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
+Set indicator specifications
+'''
+
+# Ladders to round results to match measurement precision in that range
+# Round to nearest 0.001, reduced precision for higher concentrations
+rounding_3dp = [[None,3],[0.2,2],[2.0,1]]
+# Round to nearest 0.0001, reduced precision for higher concentrations
+rounding_4dp = [[None,4],[0.02,3],[0.2,2],[2.0,1]]
+
+# Each indicator is described by the keys listed in indicator_results().
+# Data used by more than one indicator is only calculated once
+indicators = [
+    # Chlorophyll-a Annual Maximum indicator
+    {'Measurement':'Chlorophyll a (planktonic)','Indicator':'Annual Maximum','FreshwaterBodyType':['Lakes'],
+     'Statistic':'annual_max','Frequency':'All','Bins':[0,10,25,60,np.inf],'GradeCheck':'All'},
+    # Chlorophyll-a Annual Median indicator
+    {'Measurement':'Chlorophyll a (planktonic)','Indicator':'Annual Median','FreshwaterBodyType':['Lakes'],
+     'Statistic':'annual_percentile','Parameters':{'percentile':50},'Frequency':'Monthly',
+     'Rounding':[[None,1]],'Bins':[0,2,5,12,np.inf],'GradeCheck':'Monthly'},
+    # Total Nitrogen Annual Median indicator for seasonally stratified and brackish lakes
+    {'Measurement':'Total Nitrogen','Indicator':'Annual Median','FreshwaterBodyType':['Lakes'],
+     'Statistic':'annual_percentile','Parameters':{'percentile':50},'Frequency':'Monthly',
+     'Rounding':rounding_3dp,'Bins':[0,0.160,0.350,0.750,np.inf],'GradeCheck':'Monthly','SpecialConsiderations':'Seasonally stratified and brackish'},
+    # Total Nitrogen Annual Median indicator for polymictic lakes
+    {'Measurement':'Total Nitrogen','Indicator':'Annual Median','FreshwaterBodyType':['Lakes'],
+     'Statistic':'annual_percentile','Parameters':{'percentile':50},'Frequency':'Monthly',
+     'Rounding':rounding_3dp,'Bins':[0,0.300,0.500,0.800,np.inf],'GradeCheck':'Monthly','SpecialConsiderations':'Polymictic'},
+    # Total Phosphorus Annual Median indicator
+    {'Measurement':'Total Phosphorus','Indicator':'Annual Median','FreshwaterBodyType':['Lakes'],
+     'Statistic':'annual_percentile','Parameters':{'percentile':50},'Frequency':'Monthly',
+     'Rounding':rounding_3dp,'Bins':[0,0.010,0.020,0.050,np.inf],'GradeCheck':'Monthly'},
+    # Ammonia Annual Maximum indicator
+    {'Measurement':'Ammoniacal Nitrogen','Indicator':'Annual Maximum','FreshwaterBodyType':['Rivers','Lakes'],
+     'Statistic':'annual_max','Frequency':'All','Bins':[0,0.05,0.40,2.20,np.inf],'GradeCheck':'All'},
+    # Ammonia Annual Median indicator
+    {'Measurement':'Ammoniacal Nitrogen','Indicator':'Annual Median','FreshwaterBodyType':['Rivers','Lakes'],
+     'Statistic':'annual_percentile','Parameters':{'percentile':50},'Frequency':'Monthly',
+     'Rounding':rounding_3dp,'Bins':[0,0.05,0.40,2.20,np.inf],'GradeCheck':'Monthly'},
+    # Nitrate Annual Median indicator
+    {'Measurement':'Nitrate-N Nitrite-N','Indicator':'Annual Median','FreshwaterBodyType':['Rivers'],
+     'Statistic':'annual_percentile','Parameters':{'percentile':50},'Frequency':'Monthly',
+     'Rounding':rounding_4dp,'Bins':[0,1.0,2.4,6.9,np.inf],'GradeCheck':'Monthly'},
+    # Nitrate 95th percentile indicator
+    {'Measurement':'Nitrate-N Nitrite-N','Indicator':'95th Percentile','FreshwaterBodyType':['Rivers'],
+     'Statistic':'annual_percentile','Parameters':{'percentile':95},'Frequency':'Monthly',
+     'Rounding':rounding_4dp,'Bins':[0,1.5,3.5,9.8,np.inf],'GradeCheck':'Monthly'},
+    # DRP 5-yr median
+    {'Measurement':'Dissolved Reactive Phosphorus','Indicator':'5-yr Median','FreshwaterBodyType':['Rivers'],
+     'Statistic':'multiyear_percentile','Parameters':{'percentile':50,'years':5,'frequency':['Monthly'],'requirements':[48]},
+     'Rounding':rounding_4dp,'Bins':[0,0.006,0.010,0.018,np.inf],'GradeCheck':'Monthly'},
+    # DRP 5-yr 95th Percentile
+    {'Measurement':'Dissolved Reactive Phosphorus','Indicator':'95th percentile','FreshwaterBodyType':['Rivers'],
+     'Statistic':'multiyear_percentile','Parameters':{'percentile':95,'years':5,'frequency':['Monthly'],'requirements':[48]},
+     'Rounding':rounding_4dp,'Bins':[0,0.021,0.030,0.054,np.inf],'GradeCheck':'Monthly'},
+    ]
+
+# Set number of indicator calculations to run at the same time
+indicator_workers = 4
 
 ##############################################################################
 '''
-Total Nitrogen Annual Median indicator
+Calculate indicator results
 '''
 
-# Set measurement parameter
-measurement = 'Total Nitrogen'
-# Use reduce_to_monthly function to generate monthly values dataframe
-indicator_df = reduce_to_monthly(StatsData_df[(StatsData_df['Measurement'] == measurement)].copy())
-# Save monthly values in case result is censored value with detection limit
-# in grade B or C range. Depending on the lower ranked detections, the result
-# could be indetermined grade (i.e., A/B, A/B/C, or B/C)
-monthly_df = indicator_df[['Site','HydroYear','MonthCensor','MonthNumeric']].copy()
-# Use annual_percentile function to generate annual medians from monthly data
-indicator_df = annual_percentile(indicator_df,50)
-# Define waterbody, indicator, and special considerations
-indicator_df['FreshwaterBodyType'] = 'Lakes'
-indicator_df['Indicator'] = 'Annual Median'
-#indicator_df['SpecialConsiderations'] = 'Separate analysis for open/closed to sea periods'
-# Set sample frequency used to calculate median
-indicator_df['Frequency'] = 'Monthly'
-# Round median numeric result to nearest 0.001, reduced precision for higher concentrations
-indicator_df['Numeric'] = indicator_df['Numeric'].apply(lambda x : round_half_up(x,3))
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>0.2,indicator_df['Numeric'].apply(lambda x : round_half_up(x,2)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>2.0,indicator_df['Numeric'].apply(lambda x : round_half_up(x,1)),indicator_df['Numeric'])
-# Convert result to a string
-indicator_df['Result'] = indicator_df['Censor'].fillna('')+indicator_df['Numeric'].astype(str)
-# Generate results for Polymictic vs seasonally stratified and brackish sites
-# Copy data
-indicator_copy_df = indicator_df.copy()
-# Start with Seasonally stratified & brackish
-indicator_df['SpecialConsiderations'] = 'Seasonally stratified and brackish'
-# Set bins for grades
-bins = [0,0.160,0.350,0.750,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-#indicator_df = grade_check(indicator_df,monthly_df,bins,'Monthly')
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
-# Repeat for Polymictic
-indicator_df = indicator_copy_df.copy()
-indicator_df['SpecialConsiderations'] = 'Polymictic'
-# Set bins for grades
-bins = [0,0.300,0.500,0.800,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-#indicator_df = grade_check(indicator_df,monthly_df,bins,'Monthly')
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
+# Use indicator_results function to calculate all indicators and append to indicator results table
+profile_stage('Indicator results',len(StatsData_df))
+IndicatorResults.append(indicator_results(StatsData_df,indicators,workers=indicator_workers))
+IndicatorResults_df = IndicatorResults.frame()
 
 ##############################################################################
 '''
-Total Phosphorus Annual Median indicator
-'''
-
-# Set measurement parameter
-measurement = 'Total Phosphorus'
-# Use reduce_to_monthly function to generate monthly values dataframe
-indicator_df = reduce_to_monthly(StatsData_df[(StatsData_df['Measurement'] == measurement)].copy())
-# Save monthly values in case result is censored value with detection limit
-# in grade B or C range. Depending on the lower ranked detections, the result
-# could be indetermined grade (i.e., A/B, A/B/C, or B/C)
-monthly_df = indicator_df[['Site','HydroYear','MonthCensor','MonthNumeric']].copy()
-# Use annual_percentile function to generate annual medians from monthly data
-indicator_df = annual_percentile(indicator_df,50)
-# Define waterbody, indicator, and special considerations
-indicator_df['FreshwaterBodyType'] = 'Lakes'
-indicator_df['Indicator'] = 'Annual Median'
-indicator_df['SpecialConsiderations'] = None
-# Set sample frequency used to calculate median
-indicator_df['Frequency'] = 'Monthly'
-# Round median numeric result to nearest 0.001, reduced precision for higher concentrations
-indicator_df['Numeric'] = indicator_df['Numeric'].apply(lambda x : round_half_up(x,3))
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>0.2,indicator_df['Numeric'].apply(lambda x : round_half_up(x,2)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>2.0,indicator_df['Numeric'].apply(lambda x : round_half_up(x,1)),indicator_df['Numeric'])
-# Convert result to a string
-indicator_df['Result'] = indicator_df['Censor'].fillna('')+indicator_df['Numeric'].astype(str)
-# Set bins for grades
-bins = [0,0.010,0.020,0.050,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-#indicator_df = grade_check(indicator_df,monthly_df,bins,'Monthly')
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
-
-##############################################################################
-'''
-Ammonia Annual Maximum indicator
-'''
-
-# Set measurement parameter
-measurement = 'Ammoniacal Nitrogen'
-# Save sample values in case result is censored value with detection limit
-# in grade B or C range. Depending on the lower ranked detections, the result
-# could be indetermined grade (i.e., A/B, A/B/C, or B/C)
-sample_df = StatsData_df[StatsData_df['Measurement']==measurement][['Site','HydroYear','Censor','Numeric']].copy()
-# Use annual_max function to generate annual max dataframe
-indicator_df = annual_max(StatsData_df[StatsData_df['Measurement']==measurement].copy())
-# Define indicator and special considerations
-indicator_df['FreshwaterBodyType'] = 'Rivers'
-indicator_df['Indicator'] = 'Annual Maximum'
-indicator_df['SpecialConsiderations'] = None
-# Set sample frequency as 'All' to indicate all samples are used
-indicator_df['Frequency'] = 'All'
-# Set bins for grades
-bins = [0,0.05,0.40,2.20,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-#indicator_df = grade_check(indicator_df,sample_df,bins,'All')
-# Append twice for Lakes and Rivers
-for FWType in ['Rivers','Lakes']:
-    # Set freshwater type
-    indicator_df['FreshwaterBodyType'] = FWType
-    # Append to indicator results table
-    IndicatorResults_df = IndicatorResults_df.append(indicator_df)
-
-##############################################################################
-'''
-Ammonia Annual Median indicator
-'''
-
-# Set measurement parameter
-measurement = 'Ammoniacal Nitrogen'
-# Use reduce_to_monthly function to generate monthly values dataframe
-indicator_df = reduce_to_monthly(StatsData_df[(StatsData_df['Measurement'] == measurement)].copy())
-# Save monthly values in case result is censored value with detection limit
-# in grade B or C range. Depending on the lower ranked detections, the result
-# could be indetermined grade (i.e., A/B, A/B/C, or B/C)
-monthly_df = indicator_df[['Site','HydroYear','MonthCensor','MonthNumeric']].copy()
-# Use annual_percentile function to generate annual medians from monthly data
-indicator_df = annual_percentile(indicator_df,50)
-# Define indicator and special considerations
-indicator_df['Indicator'] = 'Annual Median'
-indicator_df['SpecialConsiderations'] = None
-# Set sample frequency used to calculate median
-indicator_df['Frequency'] = 'Monthly'
-# Round median numeric result to nearest 0.001, reduced precision for higher concentrations
-indicator_df['Numeric'] = indicator_df['Numeric'].apply(lambda x : round_half_up(x,3))
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>0.2,indicator_df['Numeric'].apply(lambda x : round_half_up(x,2)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>2.0,indicator_df['Numeric'].apply(lambda x : round_half_up(x,1)),indicator_df['Numeric'])
-# Convert result to a string
-indicator_df['Result'] = indicator_df['Censor'].fillna('')+indicator_df['Numeric'].astype(str)
-# Set bins for grades
-bins = [0,0.05,0.40,2.20,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-#indicator_df = grade_check(indicator_df,monthly_df,bins,'Monthly')
-# Append twice for Lakes and Rivers
-for FWType in ['Rivers','Lakes']:
-    # Set freshwater type
-    indicator_df['FreshwaterBodyType'] = FWType
-    # Append to indicator results table
-    IndicatorResults_df = IndicatorResults_df.append(indicator_df)
-
-##############################################################################
-'''
-Nitrate Annual Median indicator
-'''
-
-# Set measurement parameter
-measurement = 'Nitrate-N Nitrite-N'
-# Use reduce_to_monthly function to generate monthly values dataframe
-indicator_df = reduce_to_monthly(StatsData_df[(StatsData_df['Measurement'] == measurement)].copy())
-# Save monthly values in case result is censored value with detection limit
-# in grade B or C range. Depending on the lower ranked detections, the result
-# could be indetermined grade (i.e., A/B, A/B/C, or B/C)
-monthly_df = indicator_df[['Site','HydroYear','MonthCensor','MonthNumeric']].copy()
-# Use annual_percentile function to generate annual medians from monthly data
-indicator_df = annual_percentile(indicator_df,50)
-# Define waterbody, indicator, and special considerations
-indicator_df['FreshwaterBodyType'] = 'Rivers'
-indicator_df['Indicator'] = 'Annual Median'
-indicator_df['SpecialConsiderations'] = None
-# Set sample frequency used to calculate median
-indicator_df['Frequency'] = 'Monthly'
-# Round median numeric result to nearest 0.0001, reduced precision for higher concentrations
-indicator_df['Numeric'] = indicator_df['Numeric'].apply(lambda x : round_half_up(x,4))
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>0.02,indicator_df['Numeric'].apply(lambda x : round_half_up(x,3)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>0.2,indicator_df['Numeric'].apply(lambda x : round_half_up(x,2)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>2.0,indicator_df['Numeric'].apply(lambda x : round_half_up(x,1)),indicator_df['Numeric'])
-# Convert result to a string
-indicator_df['Result'] = indicator_df['Censor'].fillna('')+indicator_df['Numeric'].astype(str)
-# Set bins for grades
-bins = [0,1.0,2.4,6.9,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-#indicator_df = grade_check(indicator_df,monthly_df,bins,'Monthly')
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
-
-##############################################################################
-'''
-Nitrate 95th percentile indicator
-'''
-
-# Set measurement parameter
-measurement = 'Nitrate-N Nitrite-N'
-# Use reduce_to_monthly function to generate monthly values dataframe
-indicator_df = reduce_to_monthly(StatsData_df[(StatsData_df['Measurement'] == measurement)].copy())
-# Save monthly values in case result is censored value with detection limit
-# in grade B or C range. Depending on the lower ranked detections, the result
-# could be indetermined grade (i.e., A/B, A/B/C, or B/C)
-monthly_df = indicator_df[['Site','HydroYear','MonthCensor','MonthNumeric']].copy()
-# Use annual_percentile function to generate annual medians from monthly data
-indicator_df = annual_percentile(indicator_df,95)
-# Define waterbody, indicator, and special considerations
-indicator_df['FreshwaterBodyType'] = 'Rivers'
-indicator_df['Indicator'] = '95th Percentile'
-indicator_df['SpecialConsiderations'] = None
-# Set sample frequency used to calculate median
-indicator_df['Frequency'] = 'Monthly'
-# Round median numeric result to nearest 0.0001, reduced precision for higher concentrations
-indicator_df['Numeric'] = indicator_df['Numeric'].apply(lambda x : round_half_up(x,4))
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>0.02,indicator_df['Numeric'].apply(lambda x : round_half_up(x,3)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>0.2,indicator_df['Numeric'].apply(lambda x : round_half_up(x,2)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>2.0,indicator_df['Numeric'].apply(lambda x : round_half_up(x,1)),indicator_df['Numeric'])
-# Convert result to a string
-indicator_df['Result'] = indicator_df['Censor'].fillna('')+indicator_df['Numeric'].astype(str)
-# Set bins for grades
-bins = [0,1.5,3.5,9.8,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-#indicator_df = grade_check(indicator_df,monthly_df,bins,'Monthly')
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
-
-##############################################################################
-'''
-DRP 5-yr median
+Export the Results
 '''
 
-# Set measurement parameter
-measurement = 'Dissolved Reactive Phosphorus'
-# Use reduce_to_monthly function to generate monthly values dataframe
-indicator_df = reduce_to_monthly(StatsData_df[(StatsData_df['Measurement'] == measurement)].copy())
-# Save monthly values in case result is censored value with detection limit
-# in grade B or C range. Depending on the lower ranked detections, the result
-# could be indetermined grade (i.e., A/B, A/B/C, or B/C)
-monthly_df = indicator_df[['Site','HydroYear','MonthCensor','MonthNumeric']].copy()
-# Use multi_year function to generate 5-yr medians
-indicator_df = multiyear_percentile(indicator_df,50,5,['Monthly'],[48])
-# Define waterbody, indicator, and special considerations
-indicator_df['FreshwaterBodyType'] = 'Rivers'
-indicator_df['Indicator'] = '5-yr Median'
-indicator_df['SpecialConsiderations'] = None
-# Round median numeric result to nearest 0.0001, reduced precision for higher concentrations
-indicator_df['Numeric'] = indicator_df['Numeric'].apply(lambda x : round_half_up(x,4))
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>0.02,indicator_df['Numeric'].apply(lambda x : round_half_up(x,3)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>0.2,indicator_df['Numeric'].apply(lambda x : round_half_up(x,2)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>2.0,indicator_df['Numeric'].apply(lambda x : round_half_up(x,1)),indicator_df['Numeric'])
-# Convert result to a string
-indicator_df['Result'] = indicator_df['Censor'].fillna('')+indicator_df['Numeric'].astype(str)
-# Set bins for grades
-bins = [0,0.006,0.010,0.018,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-#indicator_df = grade_check(indicator_df,monthly_df,bins,'Monthly')
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
+# Set export folder and format (parquet or arrow). Parquet tables are
+# partitioned into folders by the listed columns
+export_folder = 'SW-Results'
+export_format = 'parquet'
+partitions = {'CleanedData':['Measurement','HydroYear'],'SampleFrequency':['Measurement'],'IndicatorResults':['Measurement']}
+# Set Excel summary file (None for no Excel export) and the small result
+# tables to include in it
+excel_file = 'SW-Results.xlsx'
+excel_sheets = ['UnstackedFrequency','IndicatorResults']
+
+# Export all tables to columnar files and the result tables to Excel
+profile_stage('Export',len(IndicatorResults_df))
+tables = {
+    'HilltopData':WQData_df,
+    'CleanedData':StatsData_df,
+    'SampleFrequency':Frequency_df.reset_index(),
+    'UnstackedFrequency':Unstacked_df.reset_index(),
+    'IndicatorResults':IndicatorResults_df,
+    }
+export_results(tables,export_folder,export_format,partitions,excel_file,excel_sheets)
 
 ##############################################################################
 '''
-DRP 5-yr 95th Percentile
+Combine GW and SW indicator results
 '''
 
-# Set measurement parameter
-measurement = 'Dissolved Reactive Phosphorus'
-# Use reduce_to_monthly function to generate monthly values dataframe
-indicator_df = reduce_to_monthly(StatsData_df[(StatsData_df['Measurement'] == measurement)].copy())
-# Save monthly values in case result is censored value with detection limit
-# in grade B or C range. Depending on the lower ranked detections, the result
-# could be indetermined grade (i.e., A/B, A/B/C, or B/C)
-monthly_df = indicator_df[['Site','HydroYear','MonthCensor','MonthNumeric']].copy()
-# Use multi_year function to generate 5-yr medians
-indicator_df = multiyear_percentile(indicator_df,95,5,['Monthly'],[48])
-# Define waterbody, indicator, and special considerations
-indicator_df['FreshwaterBodyType'] = 'Rivers'
-indicator_df['Indicator'] = '95th percentile'
-indicator_df['SpecialConsiderations'] = None
-# Round median numeric result to nearest 0.0001, reduced precision for higher concentrations
-indicator_df['Numeric'] = indicator_df['Numeric'].apply(lambda x : round_half_up(x,4))
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>0.02,indicator_df['Numeric'].apply(lambda x : round_half_up(x,3)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>0.2,indicator_df['Numeric'].apply(lambda x : round_half_up(x,2)),indicator_df['Numeric'])
-indicator_df['Numeric'] = np.where(indicator_df['Numeric']>2.0,indicator_df['Numeric'].apply(lambda x : round_half_up(x,1)),indicator_df['Numeric'])
-# Convert result to a string
-indicator_df['Result'] = indicator_df['Censor'].fillna('')+indicator_df['Numeric'].astype(str)
-# Set bins for grades
-bins = [0,0.021,0.030,0.054,np.inf]
-# Use grades function to set grades and grade range
-indicator_df = grades(indicator_df,bins)
-# Use  grade_check to adjust grade results for detected values
-#indicator_df = grade_check(indicator_df,monthly_df,bins,'Monthly')
-# Append to indicator results table
-IndicatorResults_df = IndicatorResults_df.append(indicator_df)
-
-##############################################################################
-'''
-Export the Results
-'''
+# Set results store shared with the GW script and the combined Excel file
+# (None for no Excel export)
+results_store = 'Results'
+combined_excel = 'Results.xlsx'
 
-# Export results to Excel
-with pd.ExcelWriter('SW-Results.xlsx') as writer:  
-    WQData_df.to_excel(writer, sheet_name='HilltopData',index=True)
-    StatsData_df.to_excel(writer, sheet_name='CleanedData',index=False)
-    Frequency_df.reset_index().to_excel(writer, sheet_name='SampleFrequency',index=False)
-    Unstacked_df.reset_index().to_excel(writer, sheet_name='UnstackedFrequency',index=False)
-    IndicatorResults_df.to_excel(writer, sheet_name='IndicatorResults',index=False)
+# Add the results of this run to the results store
+profile_stage('Combine results',len(IndicatorResults_df))
+store_results({'IndicatorResults':IndicatorResults_df},results_store,'SW',
+              partitions={'IndicatorResults':['FreshwaterBodyType','Measurement'],'TrendData':['Measurement'],'TrendResults':['Measurement']})
 
-##############################################################################
-'''
-Combine GW and SW indicator results
-'''
+# Combine the latest GW and SW results in the store. Only primary results are
+# combined and tables that have not been stored by either script are skipped
+Combined = {table:results_view(results_store,table) for table in ['IndicatorResults','TrendData','TrendResults']}
+Combined = {table:df for table,df in Combined.items() if df is not None}
+if combined_excel is not None:
+    excel_summary(Combined,combined_excel)
 
-# Check if GW results exist otherwise don't merge
-if os.path.isfile('GW-Results.xlsx'):
-    with pd.ExcelWriter('Results.xlsx') as writer:
-        # Only merge primary results in output
-        for sheet in ['IndicatorResults','TrendData','TrendResults']:
-            try:
-                GW_df = pd.read_excel('GW-Results.xlsx',sheet_name=sheet)
-                SW_df = pd.read_excel('SW-Results.xlsx',sheet_name=sheet)
-                df = pd.concat([GW_df,SW_df])
-                df.to_excel(writer,sheet_name=sheet,index=False)
-            except NameError:
-                continue
-            except ValueError:
-                continue
\ No newline at end of file
+# Write the run profile
+stop_profile(profile_file)
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Python Script with functions to generate synthetic water quality data in the
+format output from hilltop_data(), for benchmarking the indicator functions
+at regional scale
+
+Sites are sampled under irregular annual, semi-annual, quarterly and monthly
+regimes that change over the record, with missed years and samples, NEMS
+same-day duplicate samples, detection limits that fall over time, greater
+than results and '*' results. The same seed always gives the same data.
+
+Created on Sat Oct 17 01:18:51 2026
+"""
+
+# import python modules
+import pandas as pd
+import numpy as np
+from MockHilltop import fixture_data, site_locations, site_list_xml, measurement_list_xml, sample_parameter_list_xml, get_data_xml
+
+# Measurement settings of the synthetic results
+#   Units: units stored in Hilltop
+#   Median, Spread: median and log standard deviation of site medians
+#   Noise: log standard deviation of results about the site median
+#   DetectionLimits: [first hydro year, detection limit] laboratory history
+#   UpperLimit: greater than results above this value (None for no limit)
+#   Decimals: decimals of the results
+#   Coverage: chance of the measurement being sampled at a site
+measurement_specs = {
+    'Nitrate Nitrogen':{'Units':'mg/L','Median':2.0,'Spread':1.2,'Noise':0.35,'DetectionLimits':[[0,0.1],[2000,0.01],[2010,0.001]],'UpperLimit':None,'Decimals':3,'Coverage':0.98},
+    'E. coli':{'Units':'MPN/100mL','Median':10,'Spread':1.5,'Noise':1.4,'DetectionLimits':[[0,1]],'UpperLimit':2420,'Decimals':0,'Coverage':0.75},
+    'Chlorophyll a (planktonic)':{'Units':'mg/m3','Median':2.0,'Spread':0.8,'Noise':0.7,'DetectionLimits':[[0,0.5],[2008,0.1]],'UpperLimit':None,'Decimals':1,'Coverage':0.4},
+    'Total Nitrogen':{'Units':'g/m3','Median':0.6,'Spread':1.0,'Noise':0.4,'DetectionLimits':[[0,0.1],[2005,0.01]],'UpperLimit':None,'Decimals':3,'Coverage':0.9},
+    'Ammoniacal Nitrogen':{'Units':'g/m3','Median':0.01,'Spread':1.0,'Noise':0.8,'DetectionLimits':[[0,0.01],[2005,0.005]],'UpperLimit':None,'Decimals':3,'Coverage':0.9},
+    'Nitrate-N Nitrite-N':{'Units':'g/m3','Median':0.4,'Spread':1.2,'Noise':0.45,'DetectionLimits':[[0,0.01],[2005,0.001]],'UpperLimit':None,'Decimals':3,'Coverage':0.9},
+    'Total Phosphorus':{'Units':'g/m3','Median':0.02,'Spread':0.9,'Noise':0.6,'DetectionLimits':[[0,0.01],[2005,0.004]],'UpperLimit':None,'Decimals':3,'Coverage':0.9},
+    'Dissolved Reactive Phosphorus':{'Units':'g/m3','Median':0.006,'Spread':0.9,'Noise':0.5,'DetectionLimits':[[0,0.005],[2005,0.001]],'UpperLimit':None,'Decimals':4,'Coverage':0.9},
+    }
+
+# Sampling regimes with their chance of being chosen and the months (from
+# the start of the hydro year) sampled in each period of the regime
+regimes = {'Annual':[0.15,12],'Semi-annual':[0.15,6],'Quarterly':[0.35,3],'Monthly':[0.35,1]}
+
+def site_names(n_sites, site_type='Groundwater'):
+    """
+    Function to create Canterbury style site names
+
+    Parameters
+    ----------
+    n_sites : int
+        number of sites
+    site_type : str
+        'Groundwater' for well numbers (e.g. M35/1234) or 'Surface Water'
+        for stream site numbers (e.g. SQ30641)
+
+    Returns
+    -------
+    list of str
+    """
+    if site_type == 'Groundwater':
+        # Spread wells over map sheets, numbered within each sheet
+        return ['{}{}/{:04d}'.format('HIJKLMNOP'[(i//9999)%9],35+(i//9999)//9,i%9999+1) for i in range(n_sites)]
+    return ['SQ{:05d}'.format(30000+i) for i in range(n_sites)]
+
+def sample_dates(n_sites, first_year, last_year, rng, missed_year=0.05, missed_sample=0.08, extra_sample=0.03):
+    """
+    Function to create the sample dates of each site under irregular
+    sampling regimes
+
+    Each site starts its record in a random hydro year (most from the first
+    year) and may close early. The record is split into up to three periods
+    with their own sampling regime and month offset.
+
+    Parameters
+    ----------
+    n_sites : int
+        number of sites
+    first_year, last_year : int
+        first and last hydro years of the data
+    rng : Generator
+        numpy random generator
+    missed_year : float
+        chance of a site not being sampled in a hydro year
+    missed_sample : float
+        chance of a scheduled sample being missed
+    extra_sample : float
+        chance of an unscheduled sample in a month
+
+    Returns
+    -------
+    tuple of arrays
+        site numbers, hydro years and sample datetimes
+    """
+    years = np.arange(first_year,last_year+1)
+    n_years = len(years)
+    # Set the start and end of each site record
+    start = np.where(rng.random(n_sites) < 0.5,first_year,first_year+rng.integers(0,max(n_years-4,1),n_sites))
+    end = np.where(rng.random(n_sites) < 0.85,last_year,np.minimum(start+rng.integers(4,n_years+4,n_sites),last_year))
+    # Set the regime and month offset of up to three periods in each record
+    breaks = np.sort(rng.integers(first_year,last_year+1,(n_sites,2)),axis=1)
+    breaks[rng.random((n_sites,2)) < 0.4] = last_year+1
+    names = list(regimes.keys())
+    period_regime = rng.choice(len(names),(n_sites,3),p=[regimes[name][0] for name in names])
+    period_offset = rng.integers(0,12,(n_sites,3))
+    period = (years[None,:,None] >= np.sort(breaks,axis=1)[:,None,:]).sum(axis=2)
+    spacing = np.array([regimes[name][1] for name in names])[np.take_along_axis(period_regime,period,axis=1)]
+    offset = np.take_along_axis(period_offset,period,axis=1)
+    # Find the months sampled in each site hydro year
+    months = np.arange(12)
+    sampled = ((months[None,None,:] - offset[:,:,None]) % spacing[:,:,None]) == 0
+    sampled &= rng.random(sampled.shape) >= missed_sample
+    sampled |= rng.random(sampled.shape) < extra_sample
+    active = (years[None,:] >= start[:,None]) & (years[None,:] <= end[:,None]) & (rng.random((n_sites,n_years)) >= missed_year)
+    sampled &= active[:,:,None]
+    site, year, month = np.nonzero(sampled)
+    year = years[year]
+    # Hydro years start in July
+    calendar_month = (month + 6) % 12 + 1
+    calendar_year = np.where(calendar_month >= 7,year-1,year)
+    dates = pd.to_datetime(pd.DataFrame({'year':calendar_year,'month':calendar_month,'day':rng.integers(1,29,len(site))}))
+    # Samples are taken during working hours
+    dates = dates + pd.to_timedelta(rng.integers(8*60,17*60,len(site)),unit='m')
+    return site, year, dates.to_numpy()
+
+def observations(values, detection_limits, upper_limit, decimals):
+    '''
+    Format results as Hilltop observations, with less than results below the
+    detection limit and greater than results above the upper limit
+    '''
+    values = np.round(values,decimals)
+    if decimals == 0:
+        text = values.astype(np.int64).astype(str).astype(object)
+    else:
+        text = values.astype(str).astype(object)
+    below = values < detection_limits
+    text[below] = pd.Series(detection_limits[below]).map('<{:g}'.format).to_numpy(dtype=object)
+    if upper_limit is not None:
+        text[values > upper_limit] = '>{}'.format(upper_limit)
+    return text
+
+def synthetic_wq_data(n_sites=1000, first_year=1990, last_year=2021, measurements=None, site_type='Groundwater', seed=0,
+                      duplicates=0.05, resamples=0.01, missing=0.05, stars=0.002, soe=0.9):
+    """
+    Function to generate synthetic water quality data in the format output
+    from hilltop_data()
+
+    Parameters
+    ----------
+    n_sites : int
+        number of sites
+    first_year, last_year : int
+        first and last hydro years of the data
+    measurements : list of str or None
+        measurements from measurement_specs to generate. None for
+        Nitrate Nitrogen and E. coli (groundwater)
+    site_type : str
+        'Groundwater' or 'Surface Water' site names
+    seed : int
+        seed of the random generator
+    duplicates : float
+        chance of a sample having a NEMS duplicate taken later the same day
+    resamples : float
+        chance of a sample being taken again within the following week
+    missing : float
+        chance of a measurement not being analysed in a sample
+    stars : float
+        chance of a result being '*' (not reported)
+    soe : float
+        chance of a sample having an SoE project code ('SOE'). Other samples
+        have project codes 'CRCGWREGS' or 'Investigation', or none
+
+    Returns
+    -------
+    DataFrame
+        indexed by Site and DateTime
+    """
+    if measurements is None:
+        measurements = ['Nitrate Nitrogen','E. coli']
+    rng = np.random.default_rng(seed)
+    sites = np.array(site_names(n_sites,site_type),dtype=object)
+    site, year, dates = sample_dates(n_sites,first_year,last_year,rng)
+
+    # Add NEMS duplicates later the same day and resamples within a week
+    duplicate = np.flatnonzero(rng.random(len(site)) < duplicates)
+    resample = np.flatnonzero(rng.random(len(site)) < resamples)
+    source = np.concatenate([np.arange(len(site)),duplicate,resample])
+    dates = np.concatenate([dates,
+                            dates[duplicate] + pd.to_timedelta(rng.integers(5,60,len(duplicate)),unit='m').to_numpy(),
+                            dates[resample] + pd.to_timedelta(rng.integers(1,8,len(resample)),unit='D').to_numpy()])
+    site = site[source]
+    # Resamples can fall in the next hydro year
+    month = pd.DatetimeIndex(dates).month.to_numpy()
+    year = np.where(month >= 7,pd.DatetimeIndex(dates).year.to_numpy()+1,pd.DatetimeIndex(dates).year.to_numpy())
+    # Keep one sample per site and time
+    order = np.lexsort((dates,site))
+    keep = np.ones(len(order),dtype=bool)
+    keep[1:] = (site[order][1:] != site[order][:-1]) | (dates[order][1:] != dates[order][:-1])
+    order = order[keep]
+    site, year, month, dates, source = site[order], year[order], month[order], dates[order], source[order]
+    n = len(site)
+    # Find the sample each duplicate or resample was taken from
+    first = np.unique(source,return_index=True,return_inverse=True)
+    first = first[1][first[2]]
+    original = first == np.arange(n)
+
+    # Set the sample parameters, shared by duplicates and resamples
+    project = np.where(rng.random(n) < soe,'SOE',rng.choice(np.array(['CRCGWREGS','Investigation',None],dtype=object),n)).astype(object)
+    technicians = np.array(['Zella Smith','Field Team A','Field Team B','Field Team C'],dtype=object)
+    columns = {('Sample Parameters','Project'):project[first],
+               ('Sample Parameters','Field Technician'):technicians[rng.integers(0,len(technicians),n)][first],
+               ('Sample Parameters','Lab'):np.where(year < 2005,'Lab A','Lab B').astype(object)}
+
+    for measurement in measurements:
+        spec = measurement_specs[measurement]
+        # Each site has its own median, seasonal cycle and trend
+        site_median = np.log(spec['Median']) + spec['Spread']*rng.standard_normal(n_sites)
+        site_season = 0.3*spec['Noise']*rng.random(n_sites)
+        site_trend = 0.02*rng.standard_normal(n_sites)
+        site_sampled = rng.random(n_sites) < spec['Coverage']
+        log_values = (site_median[site] + site_season[site]*np.cos(2*np.pi*(month-1)/12)
+                      + site_trend[site]*(year-first_year) + spec['Noise']*rng.standard_normal(n))
+        # Duplicates and resamples have nearly the same result as the sample
+        log_values = np.where(original,log_values,log_values[first]+0.05*rng.standard_normal(n))
+        # Detection limits fall over time as laboratory methods improve
+        limits = np.array(spec['DetectionLimits'])
+        detection_limits = limits[np.searchsorted(limits[:,0],year,side='right')-1,1]
+        results = observations(np.exp(log_values),detection_limits,spec['UpperLimit'],spec['Decimals'])
+        results[rng.random(n) < stars] = '*'
+        results[(rng.random(n) < missing) | ~site_sampled[site]] = np.nan
+        columns[(measurement,'({})'.format(spec['Units']))] = results
+        columns[(measurement,'Method')] = np.where(pd.isna(results),None,np.where(year < 2005,'Method 1','Method 2')).astype(object)
+
+    index = pd.MultiIndex.from_arrays([sites[site],pd.DatetimeIndex(dates)],names=['Site','DateTime'])
+    WQData_df = pd.DataFrame(columns,index=index)
+    WQData_df.columns = pd.MultiIndex.from_tuples(WQData_df.columns)
+    # Samples without any result are not held in the measurement tables
+    WQData_df = WQData_df[WQData_df.drop(columns='Sample Parameters',level=0).notna().any(axis=1)]
+
+    return WQData_df
+
+def hilltop_responses(WQData_df, agency='Mock Hilltop'):
+    """
+    Function to create the raw Hilltop web service responses (XML) of
+    synthetic data, as served by MockHilltopServer
+
+    Parameters
+    ----------
+    WQData_df : DataFrame
+        dataframe in the format output from hilltop_data() or synthetic_wq_data()
+    agency : str
+        agency name in the responses
+
+    Returns
+    -------
+    dictionary
+        matching (request, site, measurement) to the XML response, with
+        'SiteList', 'MeasurementList' (measurement 'WQ Sample' for the
+        sample parameter list) and 'GetData' requests of the full record
+    """
+    sites = fixture_data(WQData_df)
+    responses = {('SiteList',None,None):site_list_xml(agency,site_locations(list(sites.keys())))}
+    for site, site_tables in sites.items():
+        responses['MeasurementList',site,None] = measurement_list_xml(agency,site,site_tables)
+        if 'WQ Sample' in site_tables:
+            responses['MeasurementList',site,'WQ Sample'] = sample_parameter_list_xml(agency,site,site_tables['WQ Sample'])
+        for measurement in site_tables.keys():
+            responses['GetData',site,measurement] = get_data_xml(agency,site,measurement,site_tables,pd.Timestamp.min,pd.Timestamp.max,True)
+    return responses
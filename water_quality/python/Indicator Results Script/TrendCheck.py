@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Python Script to check the trend results of trends() against pymannkendall
+using the TrendData table exported by the indicator scripts
+
+Created on Sat Oct 17 00:53:11 2026
+"""
+
+# import python modules
+import pandas as pd
+import numpy as np
+import pymannkendall as mk
+from Functions import read_results,trends
+
+##############################################################################
+'''
+Set results file and trend settings
+'''
+
+# Set results folder and format with a TrendData table written by export_results()
+results_folder = 'GW-Results'
+results_format = 'parquet'
+
+# Set trend periods, hydroyears, and data requirement used by the indicator script
+trend_periods = [i for i in range(5,31)]
+final_year = [2021]
+requirement = 0.80
+
+# Set relative tolerance for comparing results
+tolerance = 1e-9
+
+##############################################################################
+'''
+Calculate trend results
+'''
+
+# Import trend data
+TrendData_df = read_results(results_folder,'TrendData',results_format)
+
+# Run trends() for each measurement
+TrendResults = []
+for measurement in TrendData_df['Measurement'].unique():
+    measurement_df = TrendData_df[TrendData_df['Measurement']==measurement]
+    trend_results_df = trends(measurement_df,trend_periods,final_year,requirement)
+    trend_results_df['Measurement'] = measurement
+    TrendResults.append(trend_results_df)
+TrendResults_df = pd.concat(TrendResults,ignore_index=True)
+
+##############################################################################
+'''
+Check trend results against pymannkendall
+'''
+
+# Set trend results columns to check
+checks = ['MK_S','MK_VarS','MK_Tau','MK_Zscore','MK_pvalue','Slope','TrendLineStartValue']
+Mismatches = []
+for i, row in TrendResults_df.iterrows():
+    # Only consider data with the chosen frequency and within the trend period
+    trend_data = TrendData_df[(TrendData_df['Measurement']==row['Measurement'])&(TrendData_df['Site']==row['Site'])&
+                              (TrendData_df['Frequency']==row['DataFrequency'])&(TrendData_df['HydroYear']<=row['HydroYear'])&
+                              (TrendData_df['HydroYear']>(row['HydroYear']-row['TrendLength']))][['HydroYear','Interval','Censor','Numeric']].copy()
+    # Convert data below the maximum detection limit
+    if ~np.isnan(row['MaxDetectionLimit']):
+        trend_data['Numeric'] = np.where((trend_data['Censor']==-1)|(trend_data['Numeric']<row['MaxDetectionLimit']),0.5*row['MaxDetectionLimit'],trend_data['Numeric'])
+    # Convert data above the minimum quantification limit
+    if ~np.isnan(row['MinQuantLimit']):
+        trend_data['Numeric'] = np.where((trend_data['Censor']==1)|(trend_data['Numeric']>row['MinQuantLimit']),1.1*row['MinQuantLimit'],trend_data['Numeric'])
+    # Set each hydroyear and interval to have a value (np.nan for intervals without data)
+    periods = {'Monthly':12,'Quarterly':4,'Annual':1}[row['DataFrequency']]
+    trend_data['HydroYear'] = pd.Categorical(trend_data['HydroYear'],categories=[(row['HydroYear']-row['TrendLength']+1)+i for i in range(row['TrendLength'])])
+    trend_data['Interval'] = pd.Categorical(trend_data['Interval'],categories=[i+1 for i in range(periods)])
+    trend_data = trend_data.groupby(['HydroYear','Interval'])['Numeric'].first()
+    # Run the Mann-Kendall test used for the trend result
+    if row['Seasonality'] == 'Seasonal':
+        MK = mk.seasonal_test(trend_data,period=periods)
+        slope = MK.slope
+    else:
+        MK = mk.original_test(trend_data)
+        slope = MK.slope*periods
+    expected = {'MK_S':MK.s,'MK_VarS':MK.var_s,'MK_Tau':MK.Tau,'MK_Zscore':MK.z,'MK_pvalue':MK.p,'Slope':slope,'TrendLineStartValue':MK.intercept}
+    # Record results that do not match
+    for column in checks:
+        if not np.isclose(row[column],expected[column],rtol=tolerance,atol=tolerance,equal_nan=True):
+            Mismatches.append([row['Measurement'],row['Site'],row['HydroYear'],row['TrendLength'],row['DataFrequency'],column,row[column],expected[column]])
+Mismatches_df = pd.DataFrame(Mismatches,columns=['Measurement','Site','HydroYear','TrendLength','DataFrequency','Result','trends','pymannkendall'])
+
+# Report the check
+print('{} trend results checked, {} mismatched values'.format(len(TrendResults_df),len(Mismatches_df)))
+if len(Mismatches_df) > 0:
+    print(Mismatches_df.to_string(index=False))